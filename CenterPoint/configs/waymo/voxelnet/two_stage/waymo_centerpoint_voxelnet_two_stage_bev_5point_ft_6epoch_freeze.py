@@ -90,7 +90,8 @@ model = dict(
     ),
     NMS_POST_MAXSIZE=500,
     num_point=5,
-    freeze=True
+    freeze=True,
+    batched_roi=False
 )
 
 assigner = dict(
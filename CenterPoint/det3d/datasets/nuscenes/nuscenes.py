@@ -66,6 +66,11 @@ class NuScenesDataset(PointCloudDataset):
 
         self.version = version
         self.eval_version = "detection_cvpr_2019"
+
+        if self.pipeline is not None:
+            for transform in self.pipeline.transforms:
+                if hasattr(transform, "fill_point_cache"):
+                    transform.fill_point_cache(self._nusc_infos, painted=self.painted)
         if self.with_info:
             self.data_info = NuScenes(version=version, dataroot=root_path, verbose=True)
 
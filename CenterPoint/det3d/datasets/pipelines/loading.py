@@ -12,9 +12,11 @@ from det3d.core import box_np_ops
 import pickle 
 import os
 from skimage import io
+from PIL import Image
 import cv2
 from ..registry import PIPELINES
 from ..nuscenes.nusc_common import get_lidar2cam_matrix
+from ..utils.shared_point_cache import SharedPointCache
 
 try:
     from nuscenes import NuScenes
@@ -55,6 +57,27 @@ def get_image(path):
     image /= 255.0
     return image
 
+def get_image_uint8(path, image_scale=1, reduced_decode=False):
+    """
+    Loads image for a sample at the resolution of image_scale, without the float conversion.
+    Args:
+        path: image file
+        image_scale: resize factor of the image
+        reduced_decode: decode JPEGs at 1/2, 1/4 or 1/8 of the resolution (the smallest one not below
+            image_scale) instead of decoding the full image and resizing it
+    Returns:
+        image: (H * image_scale, W * image_scale, 3), uint8 RGB Image
+    """
+    assert osp.exists(path)
+    with Image.open(path) as img:
+        new_shape = (int(img.size[0] * image_scale), int(img.size[1] * image_scale))
+        if reduced_decode and image_scale < 1:
+            img.draft('RGB', new_shape)
+        image = np.array(img.convert('RGB'))
+    if image.shape[1::-1] != new_shape:
+        image = cv2.resize(image, new_shape)
+    return image
+
 def remove_close(points, radius: float) -> None:
     """
     Removes point too close within a certain radius from origin.
@@ -67,9 +90,14 @@ def remove_close(points, radius: float) -> None:
     return points
 
 
-def read_sweep(sweep, painted=False):
+def read_cached_file(point_cache, path, painted=False):
+    if point_cache is None:
+        return read_file(path, painted=painted)
+    return point_cache.get((path, painted), lambda: read_file(path, painted=painted))
+
+def read_sweep(sweep, painted=False, point_cache=None):
     min_distance = 1.0
-    points_sweep = read_file(str(sweep["lidar_path"]), painted=painted).T
+    points_sweep = read_cached_file(point_cache, str(sweep["lidar_path"]), painted=painted).T
     points_sweep = remove_close(points_sweep, min_distance)
 
     nbr_points = points_sweep.shape[1]
@@ -92,15 +120,26 @@ def read_single_waymo(obj):
     
     return points 
 
-def read_single_waymo_sweep(sweep):
-    obj = get_obj(sweep['path'])
-
-    points_xyz = obj["lidars"]["points_xyz"]
-    points_feature = obj["lidars"]["points_feature"]
+def read_packed_waymo(reader, path):
+    points = reader.read_frame(path)
 
     # normalize intensity 
-    points_feature[:, 0] = np.tanh(points_feature[:, 0])
-    points_sweep = np.concatenate([points_xyz, points_feature], axis=-1).T # 5 x N
+    points[:, 3] = np.tanh(points[:, 3])
+
+    return points 
+
+def read_single_waymo_sweep(sweep, reader=None):
+    if reader is not None:
+        points_sweep = read_packed_waymo(reader, sweep['path']).T # 5 x N
+    else:
+        obj = get_obj(sweep['path'])
+
+        points_xyz = obj["lidars"]["points_xyz"]
+        points_feature = obj["lidars"]["points_feature"]
+
+        # normalize intensity 
+        points_feature[:, 0] = np.tanh(points_feature[:, 0])
+        points_sweep = np.concatenate([points_xyz, points_feature], axis=-1).T # 5 x N
 
     nbr_points = points_sweep.shape[1]
 
@@ -126,6 +165,31 @@ class LoadPointCloudFromFile(object):
         self.type = dataset
         self.random_select = kwargs.get("random_select", False)
         self.npoints = kwargs.get("npoints", 16834)
+        # read the waymo frames and sweeps from the packed sequences (see waymo_packed.py)
+        self.packed_reader = None
+        if kwargs.get("packed", False):
+            # imported here, importing the waymo package at module level is circular (waymo.py imports custom)
+            from ..waymo.waymo_packed import PackedSequenceReader
+            self.packed_reader = PackedSequenceReader()
+
+        # cache the nuscenes keyframes and sweeps in shared memory, shared by the workers and ranks of a node
+        shared_memory_gb = kwargs.get("shared_memory_gb", 0)
+        self.point_cache = SharedPointCache(
+            "det3d_points_{}".format(kwargs.get("shared_memory_name", self.type)), shared_memory_gb * 1024 ** 3
+        ) if shared_memory_gb > 0 else None
+        self.shared_memory_eager = kwargs.get("shared_memory_eager", False)
+
+    def fill_point_cache(self, infos, painted=False):
+        """loads the keyframes and sweeps of infos into the point cache, called by the dataset with
+        shared_memory_eager"""
+        if self.point_cache is None or not self.shared_memory_eager:
+            return
+
+        paths = [str(info["lidar_path"]) for info in infos]
+        paths += [str(sweep["lidar_path"]) for info in infos for sweep in info["sweeps"]]
+        items = [((path, painted), lambda path=path: read_file(path, painted=painted)) for path in dict.fromkeys(paths)]
+        num_cached = self.point_cache.fill(items)
+        print("{} point files have been loaded to shared memory".format(num_cached))
 
     def __call__(self, res, info):
 
@@ -136,7 +200,7 @@ class LoadPointCloudFromFile(object):
             nsweeps = res["lidar"]["nsweeps"]
 
             lidar_path = Path(info["lidar_path"])
-            points = read_file(str(lidar_path), painted=res["painted"])
+            points = read_cached_file(self.point_cache, str(lidar_path), painted=res["painted"])
 
             sweep_points_list = [points]
             sweep_times_list = [np.zeros((points.shape[0], 1))]
@@ -149,7 +213,7 @@ class LoadPointCloudFromFile(object):
 
             for i in np.random.choice(len(info["sweeps"]), nsweeps - 1, replace=False):
                 sweep = info["sweeps"][i]
-                points_sweep, times_sweep = read_sweep(sweep, painted=res["painted"])
+                points_sweep, times_sweep = read_sweep(sweep, painted=res["painted"], point_cache=self.point_cache)
                 sweep_points_list.append(points_sweep)
                 sweep_times_list.append(times_sweep)
 
@@ -163,8 +227,11 @@ class LoadPointCloudFromFile(object):
         elif self.type == "WaymoDataset":
             path = info['path']
             nsweeps = res["lidar"]["nsweeps"]
-            obj = get_obj(path)
-            points = read_single_waymo(obj)
+            if self.packed_reader is not None:
+                points = read_packed_waymo(self.packed_reader, path)
+            else:
+                obj = get_obj(path)
+                points = read_single_waymo(obj)
             res["lidar"]["points"] = points
 
             if nsweeps > 1: 
@@ -179,7 +246,7 @@ class LoadPointCloudFromFile(object):
 
                 for i in range(nsweeps - 1):
                     sweep = info["sweeps"][i]
-                    points_sweep, times_sweep = read_single_waymo_sweep(sweep)
+                    points_sweep, times_sweep = read_single_waymo_sweep(sweep, self.packed_reader)
                     sweep_points_list.append(points_sweep)
                     sweep_times_list.append(times_sweep)
 
@@ -204,6 +271,31 @@ class LoadPointCloudImageFromFile(object):
         self.image_scale = kwargs.get("image_scale", 1)
         self.image_list = kwargs.get("image_list", [])
         self.with_info = kwargs.get("with_info", False)
+        # uint8 images are converted to float (and normalized) by the image network on the gpu
+        self.keep_uint8 = kwargs.get("keep_uint8", False)
+        self.reduced_decode = kwargs.get("reduced_decode", False)
+        # node-wide cache of the decoded (and resized) uint8 images, 0 disables it
+        image_cache_gb = kwargs.get("image_cache_gb", 0)
+        self.image_cache = SharedPointCache(
+            "det3d_images_{}".format(kwargs.get("image_cache_name", self.type)), image_cache_gb * 1024 ** 3
+        ) if image_cache_gb > 0 else None
+
+    def load_image(self, path):
+        if not self.keep_uint8 and not self.reduced_decode and self.image_cache is None:
+            cam_img = get_image(path)
+            if self.image_scale != 1:
+                new_shape = [int(cam_img.shape[1]*self.image_scale), int(cam_img.shape[0]*self.image_scale)]
+                cam_img = cv2.resize(cam_img, new_shape)
+            return cam_img
+
+        load_func = lambda: get_image_uint8(path, self.image_scale, self.reduced_decode)
+        if self.image_cache is not None:
+            cam_img = self.image_cache.get((path, self.image_scale, self.reduced_decode), load_func)
+        else:
+            cam_img = load_func()
+        if not self.keep_uint8:
+            cam_img = cam_img.astype(np.float32) / 255.0
+        return cam_img
 
     def __call__(self, res, info):
 
@@ -247,10 +339,7 @@ class LoadPointCloudImageFromFile(object):
                 for cam_channel in self.image_list:
                     camera_token = sample_record['data'][cam_channel]
                     cam = data_info.get('sample_data', camera_token)
-                    cam_img = get_image(osp.join(data_info.dataroot, cam['filename']))
-                    if self.image_scale != 1:
-                        new_shape = [int(cam_img.shape[1]*self.image_scale), int(cam_img.shape[0]*self.image_scale)]
-                        cam_img = cv2.resize(cam_img, new_shape)
+                    cam_img = self.load_image(osp.join(data_info.dataroot, cam['filename']))
                     res['image_scale'] = self.image_scale
                     res['cam'][cam_channel.lower()] = cam_img
                     res['image_shape'][cam_channel.lower()] = cam_img.shape
@@ -14,7 +14,7 @@ from det3d.core.utils.center_utils import (
 from det3d.datasets.nuscenes.nusc_common import get_lidar2cam_matrix, view_points
 from ..registry import PIPELINES
 from .loading import get_image
-import copy, random
+import copy
 
 def _dict_select(dict_, inds):
     for k, v in dict_.items():
@@ -29,6 +29,36 @@ def drop_arrays_by_name(gt_names, used_classes):
     inds = np.array(inds, dtype=np.int64)
     return inds
 
+
+def plane_homographies(lidar2cams, cam_intrinsics, aug_mat, aug_trans=None, plane_depth=20.0, image_scale=1):
+    """
+    Closed-form homographies of the images of all the cameras for the augmentation p' = aug_mat @ p + aug_trans
+    of the points, the scene is approximated by a fronto-parallel plane at plane_depth in front of every camera.
+    For the camera points c = R @ p + t the augmentation is c' = M @ c + m with M = R @ aug_mat @ R^T and
+    m = t - M @ t + R @ aug_trans, which is c' = (M + m @ [0, 0, 1] / plane_depth) @ c on the plane.
+    Args:
+        lidar2cams: (C, 4, 4)
+        cam_intrinsics: (C, 3, 3)
+        aug_mat: (3, 3)
+        aug_trans: (3,)
+        plane_depth: float or (C,)
+        image_scale: resize factor of the images
+    Returns:
+        homographies: (C, 3, 3), map the pixels of the augmented images to the pixels of the images
+            (cv2.WARP_INVERSE_MAP)
+    """
+    R, t = lidar2cams[:, :3, :3], lidar2cams[:, :3, 3]
+    M = R @ aug_mat @ R.transpose(0, 2, 1)
+    m = t - np.einsum('cij,cj->ci', M, t)
+    if aug_trans is not None:
+        m = m + R @ np.asarray(aug_trans)
+    N = M.copy()
+    N[:, :, 2] += m / np.reshape(plane_depth, (-1, 1))
+
+    K = cam_intrinsics * np.array([image_scale, image_scale, 1]).reshape(1, 3, 1)
+    homographies = K @ np.linalg.inv(N) @ np.linalg.inv(K)
+    return homographies / homographies[:, 2:3, 2:3]
+
 @PIPELINES.register_module
 class Preprocess(object):
     def __init__(self, cfg=None, **kwargs):
@@ -53,36 +83,28 @@ class Preprocess(object):
         self.with_info = cfg.get('with_info', False) # load nuScenes information
         self.sample_method = cfg.get('sample_method', 'by_depth')
         self.keep_raw = cfg.get('keep_raw', True)
+        # warp the images like the global scaling instead of undoing the scaling of the points in the fusion
+        self.warp_images = cfg.get('warp_images', False)
+        self.warp_plane_depth = cfg.get('warp_plane_depth', 20.0)
+        self.warp_on_device = cfg.get('warp_on_device', False)
         if len(self.augmentation) == 0:
             print("NO AUGMENTATION.....")
 
-    def _warp_images(self, res, points_before_aug, points_after_aug):
+    def _warp_images(self, res, scale_noise):
+        """warps the images of the cameras like the global scaling of the points, see plane_homographies"""
         cam_images = res['cam']
-        image_shape = res['image_shape']
-        ransacReprojThreshold = 10
-        sample_points = 1000
-
-        for _key in cam_images:
-            lidar2cam, cam_intrinsic = res['calib']['lidar2cam_%s'%_key.lstrip('cam_')], res['calib']['cam_intrinsic_%s'%_key.lstrip('cam_')]
-            # get points_img before
-            points_3d_before_aug = np.concatenate([points_before_aug[:, :3], np.ones((points_before_aug.shape[0], 1))], axis=-1)
-            points_cam_before_aug = (points_3d_before_aug @ lidar2cam.T).T
-            point_img_before_aug = view_points(points_cam_before_aug[:3, :], np.array(cam_intrinsic), normalize=True)
-            point_img_before_aug = point_img_before_aug.transpose()[..., :2] * res['image_scale']
-
-            # get points_img
-            points_3d = np.concatenate([points_after_aug[:, :3], np.ones((points_after_aug.shape[0], 1))], axis=-1)
-            points_cam = (points_3d @ lidar2cam.T).T
-            point_img = view_points(points_cam[:3, :], np.array(cam_intrinsic), normalize=True)
-            point_img = point_img.transpose()[..., :2] * res['image_scale']
-
-            #_mask_before_aug = (point_img_before_aug[:, 0] > 0) * (point_img_before_aug[:, 1] > 0) * (point_img_before_aug[:, 0] < image_shape[_key][1]) * (point_img_before_aug[:, 1] < image_shape[_key][0])
-            _mask = (point_img[:, 0] > 0) * (point_img[:, 1] > 0) * (point_img[:, 0] < image_shape[_key][1]) * (point_img[:, 1] < image_shape[_key][0])
-            point_img_key_before_aug = point_img_before_aug[_mask]
-            point_img_key = point_img[_mask]
-            indexes = random.sample(range(point_img_key_before_aug.shape[0]), sample_points)
-            H, status = cv2.findHomography(point_img_key[indexes], point_img_key_before_aug[indexes], cv2.RANSAC, ransacReprojThreshold)
-            cam_images[_key] = cv2.warpPerspective(cam_images[_key], H, (cam_images[_key].shape[1], cam_images[_key].shape[0]), flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
+        cam_keys = list(cam_images.keys())
+        lidar2cams = np.stack([res['calib']['lidar2cam_%s'%_key.lstrip('cam_')] for _key in cam_keys])
+        cam_intrinsics = np.stack([res['calib']['cam_intrinsic_%s'%_key.lstrip('cam_')] for _key in cam_keys])
+        homographies = plane_homographies(lidar2cams, cam_intrinsics, scale_noise * np.eye(3),
+                                          plane_depth=self.warp_plane_depth, image_scale=res['image_scale'])
+
+        for _key, H in zip(cam_keys, homographies):
+            if self.warp_on_device:
+                # applied to the batch by the detector before the image network
+                res['calib']['image_warp_%s'%_key.lstrip('cam_')] = H.astype(np.float32)
+            else:
+                cam_images[_key] = cv2.warpPerspective(cam_images[_key], H, (cam_images[_key].shape[1], cam_images[_key].shape[0]), flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
 
         return cam_images
 
@@ -265,6 +287,9 @@ class Preprocess(object):
                                 img_crop = sample_crops[_count]
                                 if len(img_crop) == 0: continue
                                 img_crop = cv2.resize(img_crop, tuple(_box[[2,3]]-_box[[0,1]]))
+                                if cam_images[_key].dtype == np.uint8 and img_crop.dtype != np.uint8:
+                                    # the crops of the sampled objects are float, the images kept uint8
+                                    img_crop = np.clip(img_crop * 255.0 + 0.5, 0, 255).astype(np.uint8)
                                 cam_images[_key][_box[1]:_box[3],_box[0]:_box[2]] = img_crop
                                 paste_mask[_box[1]:_box[3],_box[0]:_box[2]] = _count
                                 # foreground area of original point cloud in image plane
@@ -326,23 +351,17 @@ class Preprocess(object):
                 res['aug_matrix_inv']['rotate'] = rot_mat_T_inv
 
             if 'rescale' in self.augmentation:
-                '''
-                points_before_aug = copy.deepcopy(points)
                 gt_dict["gt_boxes"], points, scale_noise = prep.global_scaling_v2(
                     gt_dict["gt_boxes"], points, *self.global_scaling_noise, return_scale_noise=True
                 )
-                points_after_aug = copy.deepcopy(points)
-                res['cam'] = self._warp_images(res, points_before_aug, points_after_aug)
-                '''
-
-                gt_dict["gt_boxes"], points, scale_noise = prep.global_scaling_v2(
-                    gt_dict["gt_boxes"], points, *self.global_scaling_noise, return_scale_noise=True
-                )
-                scale_mat_T_inv = np.array(
-                    [[1/scale_noise, 0, 0], [0, 1/scale_noise, 0], [0, 0, 1/scale_noise]],
-                    dtype=points.dtype,
-                )
-                res['aug_matrix_inv']['rescale'] = scale_mat_T_inv
+                if self.warp_images and self.with_info:
+                    res['cam'] = self._warp_images(res, scale_noise)
+                else:
+                    scale_mat_T_inv = np.array(
+                        [[1/scale_noise, 0, 0], [0, 1/scale_noise, 0], [0, 0, 1/scale_noise]],
+                        dtype=points.dtype,
+                    )
+                    res['aug_matrix_inv']['rescale'] = scale_mat_T_inv
 
             if 'translate' in self.augmentation:
                 gt_dict["gt_boxes"], points, translate_mat_T = prep.global_translate_(
@@ -0,0 +1,204 @@
+import atexit
+import hashlib
+import os
+import time
+
+import numpy as np
+import torch.distributed as dist
+
+SHM_DIR = "/dev/shm"
+
+
+def _get_dist_info():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+class SharedPointCache(object):
+    """LRU cache of point files (or decoded images) in shared memory, shared by the dataloader workers and the ranks
+    of a node.
+
+    Every file is stored as an .npy segment /dev/shm/<prefix>_<md5 of the key> (tmpfs, so in RAM), a hit
+    copies the points out of the segment instead of reading the file. Segments are touched on every hit and the
+    least recently used ones are deleted down to low_water * max_bytes once the segments of the prefix exceed
+    max_bytes, so the scan of /dev/shm is paid once for many new files. The size of the cache is taken from
+    /dev/shm at most every scan_interval seconds (or when a new file would not fit) since the other processes
+    add segments as well. Every process creating the cache registers as a user of the prefix, the segments are
+    deleted by the last user exiting (other jobs of the node may share the prefix).
+
+    Args:
+        prefix: name of the cache, caches with the same prefix share their segments
+        max_bytes: size of the cache
+        low_water: fraction of max_bytes kept when the cache is full
+    """
+    def __init__(self, prefix, max_bytes, scan_interval=1.0, low_water=0.9):
+        self.prefix = prefix
+        self.max_bytes = int(max_bytes)
+        self.low_water = low_water
+        self.scan_interval = scan_interval
+        self.used_bytes = None
+        self.last_scan_time = 0
+        self.owner_pid = os.getpid()
+        self.register_user()
+        atexit.register(self.clean_at_exit)
+
+    def get_user_file(self, pid):
+        # not matched by list_segments, the segments of the prefix start with prefix + "_"
+        return os.path.join(SHM_DIR, "{}.user.{}".format(self.prefix, pid))
+
+    def register_user(self):
+        with open(self.get_user_file(self.owner_pid), "w"):
+            pass
+
+    def get_other_users(self):
+        """live processes using the prefix besides this one, the files of exited users are removed"""
+        pids = []
+        for entry in os.scandir(SHM_DIR):
+            if not entry.name.startswith(self.prefix + ".user."):
+                continue
+            pid = int(entry.name.rsplit(".", 1)[1])
+            if pid == self.owner_pid:
+                continue
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                # killed without cleaning up
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+                continue
+            except PermissionError:
+                pass  # alive, owned by another user
+            pids.append(pid)
+        return pids
+
+    def get_name(self, key):
+        return "{}_{}".format(self.prefix, hashlib.md5(str(key).encode()).hexdigest())
+
+    def get(self, key, load_func):
+        """
+        Args:
+            key: file path (and options) of the points
+            load_func: called without arguments on a miss, returns the points
+        Returns:
+            points: a copy of the cached array
+        """
+        name = self.get_name(key)
+        try:
+            points = np.load(os.path.join(SHM_DIR, name))
+        except (FileNotFoundError, ValueError):
+            # not cached or evicted while being read
+            points = load_func()
+            self.put(name, points)
+            return points
+
+        try:
+            os.utime(os.path.join(SHM_DIR, name))
+        except OSError:
+            pass  # evicted by another process meanwhile
+        return points
+
+    def put(self, name, points, evict=True):
+        """
+        Returns:
+            cached: False if the points do not fit (without evicting other files for evict=False)
+        """
+        size = points.nbytes
+        if size > self.max_bytes:
+            return False
+
+        if self.used_bytes is None or self.used_bytes + size > self.max_bytes or \
+                time.time() - self.last_scan_time > self.scan_interval:
+            if evict:
+                self.used_bytes = self.evict(self.max_bytes - size, int(self.max_bytes * self.low_water) - size)
+            else:
+                self.used_bytes = self.evict(self.max_bytes)
+        if self.used_bytes + size > self.max_bytes:
+            return False
+
+        # written under a temporary name and renamed, so other processes never read a partial segment
+        tmp_name = "{}.{}.tmp".format(name, os.getpid())
+        try:
+            with open(os.path.join(SHM_DIR, tmp_name), "wb") as f:
+                np.save(f, points)
+            os.rename(os.path.join(SHM_DIR, tmp_name), os.path.join(SHM_DIR, name))
+            self.used_bytes += os.stat(os.path.join(SHM_DIR, name)).st_size
+        except OSError:
+            return False  # /dev/shm is full or the file was deleted by clean in another process
+        return True
+
+    def list_segments(self, with_tmp=False):
+        """
+        Returns:
+            segments: [(mtime, size, name)] of the segments of the prefix (and the ones being written for with_tmp)
+        """
+        segments = []
+        for entry in os.scandir(SHM_DIR):
+            if not entry.name.startswith(self.prefix + "_") or (not with_tmp and entry.name.endswith(".tmp")):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            segments.append((stat.st_mtime, stat.st_size, entry.name))
+        return segments
+
+    def evict(self, max_bytes, target_bytes=None):
+        """deletes the least recently used segments down to target_bytes (max_bytes by default) once more than
+        max_bytes are used, returns the used bytes"""
+        segments = sorted(self.list_segments())
+        used_bytes = sum([size for _, size, _ in segments])
+        if target_bytes is None or used_bytes <= max_bytes:
+            target_bytes = max_bytes
+        for _, size, name in segments:
+            if used_bytes <= target_bytes:
+                break
+            try:
+                os.remove(os.path.join(SHM_DIR, name))
+            except OSError:
+                pass
+            used_bytes -= size
+
+        self.last_scan_time = time.time()
+        return used_bytes
+
+    def fill(self, items):
+        """eagerly loads the (key, load_func) items, split over the ranks, until the cache is full
+        Returns:
+            num_cached: number of files loaded by this rank
+        """
+        rank, world_size = _get_dist_info()
+        num_cached = 0
+        for key, load_func in items[rank::world_size]:
+            name = self.get_name(key)
+            if os.path.exists(os.path.join(SHM_DIR, name)):
+                continue
+            if not self.put(name, load_func(), evict=False):
+                break
+            num_cached += 1
+
+        if world_size > 1:
+            dist.barrier()
+        return num_cached
+
+    def clean(self):
+        """unregisters this process, the segments are deleted when no other process uses the prefix anymore"""
+        try:
+            os.remove(self.get_user_file(self.owner_pid))
+        except OSError:
+            pass  # already cleaned
+        if len(self.get_other_users()) > 0:
+            return
+
+        for _, _, name in self.list_segments(with_tmp=True):
+            try:
+                os.remove(os.path.join(SHM_DIR, name))
+            except OSError:
+                pass
+
+    def clean_at_exit(self):
+        # the forked dataloader workers share the atexit handlers of the main process
+        if os.getpid() == self.owner_pid:
+            self.clean()
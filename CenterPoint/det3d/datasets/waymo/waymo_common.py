@@ -206,6 +206,7 @@ def _fill_infos(root_path, frames, split='train', nsweeps=1):
             "anno_path": ref_path, 
             "token": frame_name,
             "timestamp": ref_time,
+            "veh_to_global": ref_pose, 
             "sweeps": []
         }
 
@@ -304,6 +305,32 @@ def get_available_frames(root, split):
     return sorted_frames
 
 
+def _pack_sequence(args):
+    from .waymo_packed import pack_sequence_pickles
+    pack_sequence_pickles(*args)
+
+def create_waymo_packed_sequences(root_path, split='train', num_workers=8):
+    """packs the lidar pickles of every sequence of the split, see waymo_packed.py"""
+    import multiprocessing
+
+    sequences = {}
+    for frame_name in get_available_frames(root_path, split):
+        sequences.setdefault(int(frame_name.split("_")[1]), []).append(frame_name)
+
+    packed_dir = os.path.join(root_path, split, 'lidar_packed')
+    jobs = []
+    for sequence_id, frames in sequences.items():
+        assert [int(f.split("_")[3][:-4]) for f in frames] == list(range(len(frames))), \
+            "sequence {} is incomplete".format(sequence_id)
+        jobs.append((
+            [os.path.join(root_path, split, 'lidar', f) for f in frames],
+            [os.path.join(root_path, split, 'annos', f) for f in frames],
+            packed_dir, sequence_id
+        ))
+
+    with multiprocessing.Pool(num_workers) as p:
+        list(tqdm(p.imap(_pack_sequence, jobs), total=len(jobs)))
+
 def create_waymo_infos(root_path, split='train', nsweeps=1):
     frames = get_available_frames(root_path, split)
 
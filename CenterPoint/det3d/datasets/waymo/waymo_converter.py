@@ -11,6 +11,7 @@ from __future__ import print_function
 import glob, argparse, tqdm, pickle, os 
 
 import waymo_decoder 
+import waymo_packed
 import tensorflow.compat.v2 as tf
 from waymo_open_dataset import dataset_pb2
 
@@ -21,11 +22,13 @@ tf.enable_v2_behavior()
 fnames = None 
 LIDAR_PATH = None
 ANNO_PATH = None 
+PACKED_PATH = None
 
 def convert(idx):
     global fnames
     fname = fnames[idx]
     dataset = tf.data.TFRecordDataset(fname, compression_type='')
+    lidars, veh_to_globals, timestamps = [], [], []
     for frame_id, data in enumerate(dataset):
         frame = dataset_pb2.Frame()
         frame.ParseFromString(bytearray(data.numpy()))
@@ -38,6 +41,14 @@ def convert(idx):
         with open(os.path.join(ANNO_PATH, 'seq_{}_frame_{}.pkl'.format(idx, frame_id)), 'wb') as f:
             pickle.dump(decoded_annos, f)
 
+        if PACKED_PATH is not None:
+            lidars.append(decoded_frame['lidars'])
+            veh_to_globals.append(decoded_annos['veh_to_global'])
+            timestamps.append(frame.timestamp_micros)
+
+    if PACKED_PATH is not None:
+        waymo_packed.write_packed_sequence(PACKED_PATH, idx, lidars, veh_to_globals, timestamps)
+
 
 def main(args):
     global fnames 
@@ -53,6 +64,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Waymo Data Converter')
     parser.add_argument('--root_path', type=str, required=True)
     parser.add_argument('--record_path', type=str, required=True)
+    parser.add_argument('--packed', action='store_true',
+                        help='also save the points of every sequence into lidar_packed (see waymo_packed.py)')
 
     args = parser.parse_args()
 
@@ -67,5 +80,8 @@ if __name__ == '__main__':
 
     if not os.path.isdir(ANNO_PATH):
         os.mkdir(ANNO_PATH)
+
+    if args.packed:
+        PACKED_PATH = os.path.join(args.root_path, 'lidar_packed')
     
     main(args)
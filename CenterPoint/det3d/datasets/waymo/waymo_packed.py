@@ -0,0 +1,105 @@
+"""Packed Waymo point storage.
+
+The points of all the frames of a sequence are concatenated into one (N, 5) float32 array
+(x, y, z, intensity, elongation as decoded, intensity not normalized) saved as
+
+    ROOT/SPLIT/lidar_packed/seq_{sequence_id}.npy
+    ROOT/SPLIT/lidar_packed/seq_{sequence_id}_index.npy
+
+The index holds the point range, the vehicle pose and the timestamp of every frame, so the points of a
+frame or a sweep are a slice of the memory mapped sequence, no pickle is loaded.
+The frames keep the names of the per frame pickles (seq_{sequence_id}_frame_{frame_id}.pkl), which
+are mapped to their packed sequence by packed_sequence_path.
+"""
+import os
+
+import numpy as np
+
+PACKED_INDEX_DTYPE = np.dtype([
+    ('start', np.int64),
+    ('end', np.int64),
+    ('veh_to_global', np.float64, (4, 4)),
+    ('timestamp', np.int64),  # micro seconds
+])
+
+
+def packed_sequence_path(lidar_path):
+    """
+    Args:
+        lidar_path: ROOT/SPLIT/lidar/seq_{sequence_id}_frame_{frame_id}.pkl
+    Returns:
+        points_path, index_path of the packed sequence and the frame id
+    """
+    lidar_dir, frame_name = os.path.split(lidar_path)
+    _, sequence_id, _, frame_id = os.path.splitext(frame_name)[0].split('_')
+    packed_dir = os.path.join(os.path.dirname(lidar_dir), 'lidar_packed')
+
+    return os.path.join(packed_dir, 'seq_{}.npy'.format(sequence_id)), \
+        os.path.join(packed_dir, 'seq_{}_index.npy'.format(sequence_id)), int(frame_id)
+
+
+def write_packed_sequence(packed_dir, sequence_id, lidars, veh_to_globals, timestamps):
+    """
+    Args:
+        packed_dir: ROOT/SPLIT/lidar_packed
+        sequence_id:
+        lidars: decoded lidars (points_xyz, points_feature) of the frames 0, 1, ... of the sequence
+        veh_to_globals: pose of every frame, 16 values or 4x4
+        timestamps: micro seconds
+    """
+    num_points = [len(lidar['points_xyz']) for lidar in lidars]
+    offsets = np.concatenate([[0], np.cumsum(num_points)]).astype(np.int64)
+
+    index = np.zeros(len(lidars), dtype=PACKED_INDEX_DTYPE)
+    index['start'], index['end'] = offsets[:-1], offsets[1:]
+    index['veh_to_global'] = np.reshape(veh_to_globals, (-1, 4, 4))
+    index['timestamp'] = timestamps
+
+    points = np.zeros((offsets[-1], 5), dtype=np.float32)
+    for lidar, start, end in zip(lidars, offsets[:-1], offsets[1:]):
+        points[start:end, 0:3] = lidar['points_xyz']
+        points[start:end, 3:5] = lidar['points_feature']
+
+    os.makedirs(packed_dir, exist_ok=True)
+    np.save(os.path.join(packed_dir, 'seq_{}.npy'.format(sequence_id)), points)
+    # the index is written last, a sequence without index is incomplete
+    np.save(os.path.join(packed_dir, 'seq_{}_index.npy'.format(sequence_id)), index)
+
+
+class PackedSequenceReader(object):
+    """Memory maps the packed sequences on first use, once per process."""
+
+    def __init__(self):
+        self.sequences = {}
+
+    def read_frame(self, lidar_path):
+        """
+        Returns:
+            points: (N, 5) copy of the decoded points of the frame of lidar_path
+        """
+        points_path, index_path, frame_id = packed_sequence_path(lidar_path)
+        if points_path not in self.sequences:
+            self.sequences[points_path] = (np.load(points_path, mmap_mode='r'), np.load(index_path))
+
+        points, index = self.sequences[points_path]
+        return np.array(points[index['start'][frame_id]:index['end'][frame_id]])
+
+    def __getstate__(self):
+        # the memory maps are not sent to the dataloader workers
+        return {'sequences': {}}
+
+
+def pack_sequence_pickles(lidar_paths, anno_paths, packed_dir, sequence_id):
+    """packs the per frame pickles of a sequence written by waymo_converter.py"""
+    import pickle
+
+    lidars, veh_to_globals, timestamps = [], [], []
+    for lidar_path, anno_path in zip(lidar_paths, anno_paths):
+        with open(lidar_path, 'rb') as f:
+            lidars.append(pickle.load(f)['lidars'])
+        with open(anno_path, 'rb') as f:
+            anno = pickle.load(f)
+        veh_to_globals.append(np.reshape(anno['veh_to_global'], [4, 4]))
+        timestamps.append(int(anno['frame_name'].split("_")[-1]))
+
+    write_packed_sequence(packed_dir, sequence_id, lidars, veh_to_globals, timestamps)
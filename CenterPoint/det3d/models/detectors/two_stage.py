@@ -4,6 +4,7 @@ from .base import BaseDetector
 from .. import builder
 import torch 
 from torch import nn 
+from torch.nn.utils.rnn import pad_sequence
 
 @DETECTORS.register_module
 class TwoStageDetector(BaseDetector):
@@ -15,6 +16,7 @@ class TwoStageDetector(BaseDetector):
         NMS_POST_MAXSIZE,
         num_point=1,
         freeze=False,
+        batched_roi=False,
         **kwargs
     ):
         super(TwoStageDetector, self).__init__()
@@ -36,6 +38,7 @@ class TwoStageDetector(BaseDetector):
         self.roi_head = builder.build_roi_head(roi_head)
 
         self.num_point = num_point
+        self.batched_roi = batched_roi
 
     def combine_loss(self, one_stage_loss, roi_loss, tb_dict):
         one_stage_loss['loss'][0] += (roi_loss)
@@ -75,6 +78,63 @@ class TwoStageDetector(BaseDetector):
 
         return centers
 
+    def get_box_center_batched(self, boxes):
+        """
+        Args:
+            boxes: (B, N, 7 + C), padded first stage boxes with rotation last
+        Returns:
+            centers: (B, N, num_point, 3), [center, front, back, left, right] middles for 5 points
+        """
+        if self.num_point == 1:
+            return boxes[:, :, None, :3]
+        elif self.num_point == 5:
+            batch_size, num_box = boxes.shape[:2]
+            corners = box_torch_ops.center_to_corner_box2d(boxes[..., :2].reshape(-1, 2),
+                boxes[..., 3:5].reshape(-1, 2), boxes[..., -1].reshape(-1)).view(batch_size, num_box, 4, 2)
+
+            middles = (corners[:, :, [0, 2, 0, 1]] + corners[:, :, [1, 3, 3, 2]]) / 2
+            height = boxes[:, :, None, 2:3].expand(-1, -1, 4, -1)
+
+            return torch.cat([boxes[:, :, None, :3], torch.cat([middles, height], dim=-1)], dim=2)
+        else:
+            raise NotImplementedError()
+
+    def pad_first_stage_pred(self, first_pred, example):
+        """
+        Writes the first stage predictions of all samples into the NMS_POST_MAXSIZE padded roi buffers
+        Returns:
+            boxes: (B, NMS_POST_MAXSIZE, 7 + C), padded boxes in the first stage layout
+            valid_mask: (B, NMS_POST_MAXSIZE)
+        """
+        batch_size = len(first_pred)
+        box_length = first_pred[0]['box3d_lidar'].shape[1]
+        num_obj = max([len(pred['box3d_lidar']) for pred in first_pred])
+
+        boxes = first_pred[0]['box3d_lidar'].new_zeros((batch_size, self.NMS_POST_MAXSIZE, box_length))
+        roi_scores = first_pred[0]['scores'].new_zeros((batch_size, self.NMS_POST_MAXSIZE))
+        roi_labels = first_pred[0]['label_preds'].new_zeros((batch_size, self.NMS_POST_MAXSIZE), dtype=torch.long)
+        valid_mask = first_pred[0]['scores'].new_zeros((batch_size, self.NMS_POST_MAXSIZE), dtype=torch.bool)
+
+        if num_obj > 0:
+            boxes[:, :num_obj] = pad_sequence([pred['box3d_lidar'] for pred in first_pred], batch_first=True)
+            roi_scores[:, :num_obj] = pad_sequence([pred['scores'] for pred in first_pred], batch_first=True)
+            roi_labels[:, :num_obj] = pad_sequence([pred['label_preds'] + 1 for pred in first_pred], batch_first=True)
+            valid_mask[:, :num_obj] = pad_sequence([pred['scores'].new_ones(len(pred['scores']), dtype=torch.bool)
+                for pred in first_pred], batch_first=True)
+
+        rois = boxes
+        if self.roi_head.code_size == 9:
+            # x, y, z, w, l, h, rotation_y, velocity_x, velocity_y
+            rois = boxes[:, :, [0, 1, 2, 3, 4, 5, 8, 6, 7]]
+
+        example['rois'] = rois
+        example['roi_labels'] = roi_labels
+        example['roi_scores'] = roi_scores
+
+        example['has_class_labels']= True
+
+        return boxes, valid_mask
+
     def reorder_first_stage_pred_and_feature(self, first_pred, example, features):
         batch_size = len(first_pred)
         box_length = first_pred[0]['box3d_lidar'].shape[1] 
@@ -164,23 +224,32 @@ class TwoStageDetector(BaseDetector):
 
         # N C H W -> N H W C 
         example['bev_feature'] = bev_feature.permute(0, 2, 3, 1).contiguous()
-        
-        centers_vehicle_frame = self.get_box_center(one_stage_pred)
 
         if self.roi_head.code_size == 7 and return_loss is True:
             # drop velocity 
             example['gt_boxes_and_cls'] = example['gt_boxes_and_cls'][:, :, [0, 1, 2, 3, 4, 5, 6, -1]]
 
-        features = [] 
+        if self.batched_roi:
+            boxes, valid_mask = self.pad_first_stage_pred(one_stage_pred, example)
+            centers_vehicle_frame = self.get_box_center_batched(boxes)
+
+            # each module returns a (B, NMS_POST_MAXSIZE, C) tensor, padded rois get zero features
+            features = [module.forward_batched(example, centers_vehicle_frame, self.num_point)
+                for module in self.second_stage]
+            example['roi_features'] = torch.cat(features, dim=-1) * valid_mask.unsqueeze(-1).type_as(features[0])
+        else:
+            centers_vehicle_frame = self.get_box_center(one_stage_pred)
+
+            features = [] 
 
-        for module in self.second_stage:
-            feature = module.forward(example, centers_vehicle_frame, self.num_point)
-            features.append(feature)
-            # feature is two level list 
-            # first level is number of two stage information streams
-            # second level is batch 
+            for module in self.second_stage:
+                feature = module.forward(example, centers_vehicle_frame, self.num_point)
+                features.append(feature)
+                # feature is two level list 
+                # first level is number of two stage information streams
+                # second level is batch 
 
-        example = self.reorder_first_stage_pred_and_feature(first_pred=one_stage_pred, example=example, features=features)
+            example = self.reorder_first_stage_pred_and_feature(first_pred=one_stage_pred, example=example, features=features)
 
         # final classification / regression 
         batch_dict = self.roi_head(example, training=return_loss)
@@ -1,6 +1,7 @@
 from ..registry import DETECTORS
 from .. import builder
 from .single_stage import SingleStageDetector
+from ..utils import warp_perspective
 from det3d.torchie.trainer import load_checkpoint
 import torch 
 from copy import deepcopy 
@@ -72,10 +73,17 @@ class VoxelFocal(SingleStageDetector):
         )
         batch_dict = {}
         if self.network2d is not None and self.fusion is not None:
-            batch_dict["images"] = example['cam']
+            images = {}
+            for cam_key, cam_images in example['cam'].items():
+                warp_key = 'image_warp_%s' % cam_key.lstrip('cam_')
+                if warp_key in example['calib']:
+                    # image augmentation left to the gpu by Preprocess (warp_on_device=True)
+                    cam_images = warp_perspective(cam_images, example['calib'][warp_key])
+                images[cam_key] = cam_images
+            batch_dict["images"] = images
             batch_dict['image_shape'] = example["image_shape"]
             batch_dict['calib'] = example['calib']
-            batch_dict['img_feat'] = self.extract_feat2d(example['cam'])
+            batch_dict['img_feat'] = self.extract_feat2d(images)
             if 'aug_matrix_inv' in example:
                 batch_dict['aug_matrix_inv'] = example['aug_matrix_inv']
 
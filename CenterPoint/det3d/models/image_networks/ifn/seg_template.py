@@ -160,7 +160,10 @@ class SegTemplate(nn.Module):
             x: (N, 3, H, W), Preprocessed images
         """
         x = images
+        if x.dtype == torch.uint8:
+            # uint8 images (LoadPointCloudImageFromFile with keep_uint8=True) are converted on the gpu
+            x = x.cuda().float().div_(255.0)
         if self.pretrained:
             # Match ResNet pretrained preprocessing
-            x = normalize(x, mean=self.norm_mean, std=self.norm_std)
+            x = normalize(x, mean=self.norm_mean.to(x.device), std=self.norm_std.to(x.device))
         return x.cuda()
@@ -1,5 +1,6 @@
 import torch
 from torch import nn
+from torch.nn import functional as F
 
 from ..registry import SECOND_STAGE
 from det3d.core.utils.center_utils import (
@@ -38,4 +39,32 @@ class BEVFeatureExtractor(nn.Module):
 
             ret_maps.append(feature_map)
 
-        return ret_maps 
\ No newline at end of file
+        return ret_maps 
+
+    def forward_batched(self, example, batch_centers, num_point):
+        """
+        Samples the features of all boxes of the batch with a single grid_sample
+        Args:
+            batch_centers: (B, N, num_point, 3), padded box centers
+        Returns:
+            feature_map: (B, N, num_point * C)
+        """
+        # B H W C -> B C H W
+        bev_feature = example['bev_feature'].permute(0, 3, 1, 2)
+        height, width = bev_feature.shape[2:]
+        batch_size, num_box = batch_centers.shape[:2]
+
+        xs, ys = self.absl_to_relative(batch_centers)
+        # align_corners=True maps -1 / 1 onto the centers of the first / last cell like bilinear_interpolate_torch
+        grid = torch.stack([xs / (width - 1) * 2 - 1, ys / (height - 1) * 2 - 1], dim=-1)
+
+        # B C N P -> B N P C
+        feature_map = F.grid_sample(bev_feature, grid.type_as(bev_feature), mode='bilinear',
+            padding_mode='zeros', align_corners=True).permute(0, 2, 3, 1)
+
+        # bilinear_interpolate_torch clamps both corners onto the same cell outside [0, W - 1) x [0, H - 1),
+        # so its weights cancel and the centers in the last row / column or outside the map get zero features
+        inside = (xs >= 0) & (xs < width - 1) & (ys >= 0) & (ys < height - 1)
+        feature_map = feature_map * inside.unsqueeze(-1).type_as(feature_map)
+
+        return feature_map.reshape(batch_size, num_box, -1)
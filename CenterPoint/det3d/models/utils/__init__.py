@@ -20,7 +20,7 @@ from .weight_init import (
     uniform_init,
     xavier_init,
 )
-from .transform_utils import project_to_image, normalize_coords
+from .transform_utils import project_to_image, normalize_coords, warp_perspective
 
 __all__ = [
     "conv_ws_2d",
@@ -45,4 +45,5 @@ __all__ = [
     "get_paddings_indicator",
     "project_to_image",
     "normalize_coords",
+    "warp_perspective",
 ]
@@ -1,5 +1,6 @@
 import math
 import torch
+import torch.nn.functional as F
 
 try:
     from kornia.geometry.conversions import (
@@ -73,4 +74,31 @@ def normalize_coords(coords, shape):
 
     # Subtract 1 since pixel indexing from [0, shape - 1]
     norm_coords = coords / (shape - 1) * (max_n - min_n) + min_n
-    return norm_coords
\ No newline at end of file
+    return norm_coords
+
+
+def warp_perspective(images, homographies):
+    """
+    Warps images like cv2.warpPerspective with flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP
+    Args:
+        images [torch.Tensor(B, H, W, C)]: uint8 or float images
+        homographies [torch.Tensor(B, 3, 3)]: Map the pixels of the warped images to the pixels of images
+    Returns:
+        warped [torch.Tensor(B, H, W, C)]: Float images in [0, 1] on the device of homographies
+    """
+    images = images.to(homographies.device)
+    if images.dtype == torch.uint8:
+        images = images.float() / 255.0
+    B, H, W, _ = images.shape
+
+    xs = torch.arange(W, dtype=torch.float32, device=images.device).view(1, W).expand(H, W)
+    ys = torch.arange(H, dtype=torch.float32, device=images.device).view(H, 1).expand(H, W)
+    pixels = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1).view(1, H * W, 3)
+    src = pixels @ homographies.float().transpose(1, 2)
+    src = src[..., :2] / src[..., 2:]
+
+    # Normalize with pixel centers at -1 and 1 (align_corners=True)
+    src = src / torch.tensor([W - 1, H - 1], dtype=src.dtype, device=src.device) * 2 - 1
+    warped = F.grid_sample(images.permute(0, 3, 1, 2), src.view(B, H, W, 2), mode='bilinear',
+                           padding_mode='zeros', align_corners=True)
+    return warped.permute(0, 2, 3, 1).contiguous()
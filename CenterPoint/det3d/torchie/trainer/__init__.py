@@ -1,4 +1,5 @@
 from .checkpoint import (
+    CheckpointWriter,
     load_checkpoint,
     load_state_dict,
     save_checkpoint,
@@ -47,6 +48,7 @@ __all__ = [
     "load_checkpoint",
     "weights_to_cpu",
     "save_checkpoint",
+    "CheckpointWriter",
     "parallel_test",
     "Priority",
     "get_priority",
@@ -4,6 +4,7 @@ import pkgutil
 import time
 import warnings
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from importlib import import_module
 
 import torch
@@ -188,7 +189,75 @@ def weights_to_cpu(state_dict):
     return state_dict_cpu
 
 
-def save_checkpoint(model, filename, optimizer=None, meta=None):
+def state_to_cpu(state):
+    """Copy every tensor of a (nested) checkpoint to cpu memory.
+
+    Unlike :func:`weights_to_cpu` the tensors are always copied, so the
+    snapshot is not changed by the following training steps.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    elif isinstance(state, dict):
+        state_cpu = type(state)((key, state_to_cpu(val)) for key, val in state.items())
+        if hasattr(state, "_metadata"):
+            state_cpu._metadata = state._metadata
+        return state_cpu
+    elif isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(val) for val in state)
+    return state
+
+
+def atomic_save(obj, filename):
+    """``torch.save`` to a temporary file which is renamed to ``filename``,
+    so an interrupted save never leaves a truncated checkpoint behind."""
+    tmp_filename = filename + ".tmp"
+    torch.save(obj, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+class CheckpointWriter(object):
+    """Write checkpoints on a background thread.
+
+    :meth:`write` snapshots the checkpoint to cpu memory and returns, the
+    serialization runs while training goes on. At most one checkpoint is in
+    flight, so the memory of only one snapshot is held.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def write(self, checkpoint, filename, callback=None):
+        """
+        Args:
+            checkpoint (dict): checkpoint to save.
+            filename (str): checkpoint filename.
+            callback (callable, optional): called on the writer thread after
+                the file is in place.
+        """
+        self.wait()
+        checkpoint = state_to_cpu(checkpoint)
+
+        def _write():
+            atomic_save(checkpoint, filename)
+            if callback is not None:
+                callback()
+
+        self._pending = self._executor.submit(_write)
+
+    def wait(self):
+        """Block until the pending checkpoint is written, errors of the
+        writer thread are raised here."""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+
+def save_checkpoint(model, filename, optimizer=None, meta=None, writer=None, callback=None):
     """Save checkpoint to file.
 
     The checkpoint will have 3 fields: ``meta``, ``state_dict`` and
@@ -199,6 +268,9 @@ def save_checkpoint(model, filename, optimizer=None, meta=None):
         filename (str): Checkpoint filename.
         optimizer (:obj:`Optimizer`, optional): Optimizer to be saved.
         meta (dict, optional): Metadata to be saved in checkpoint.
+        writer (:obj:`CheckpointWriter`, optional): Write the checkpoint in
+            the background instead of blocking.
+        callback (callable, optional): Called once the file is written.
     """
     if meta is None:
         meta = {}
@@ -209,8 +281,17 @@ def save_checkpoint(model, filename, optimizer=None, meta=None):
     if hasattr(model, "module"):
         model = model.module
 
-    checkpoint = {"meta": meta, "state_dict": weights_to_cpu(model.state_dict())}
+    if writer is not None:
+        # the writer copies the tensors itself
+        checkpoint = {"meta": meta, "state_dict": model.state_dict()}
+    else:
+        checkpoint = {"meta": meta, "state_dict": weights_to_cpu(model.state_dict())}
     if optimizer is not None:
         checkpoint["optimizer"] = optimizer.state_dict()
 
-    torch.save(checkpoint, filename)
+    if writer is not None:
+        writer.write(checkpoint, filename, callback=callback)
+    else:
+        atomic_save(checkpoint, filename)
+        if callback is not None:
+            callback()
@@ -1,13 +1,16 @@
+from ..checkpoint import CheckpointWriter
 from ..utils import master_only
 from .hook import Hook
 
 
 class CheckpointHook(Hook):
-    def __init__(self, interval=1, save_optimizer=True, out_dir=None, **kwargs):
+    def __init__(self, interval=1, save_optimizer=True, out_dir=None, async_save=False, **kwargs):
         self.interval = interval
         self.save_optimizer = save_optimizer
         self.out_dir = out_dir
         self.args = kwargs
+        # serialize the checkpoints on a background thread instead of blocking training
+        self.writer = CheckpointWriter() if async_save else None
 
     @master_only
     def after_train_epoch(self, trainer):
@@ -18,5 +21,10 @@ class CheckpointHook(Hook):
             self.out_dir = trainer.work_dir
 
         trainer.save_checkpoint(
-            self.out_dir, save_optimizer=self.save_optimizer, **self.args
+            self.out_dir, save_optimizer=self.save_optimizer, writer=self.writer, **self.args
         )
+
+    @master_only
+    def after_run(self, trainer):
+        if self.writer is not None:
+            self.writer.close()
@@ -158,6 +158,7 @@ class Trainer(object):
         self.optimizer = optimizer
         self.lr_scheduler = lr_scheduler
         self.max_save_num = max_save_num
+        self._ckpt_list = None
 
         self.batch_processor = batch_processor
 
@@ -339,26 +340,36 @@ class Trainer(object):
         return load_checkpoint(self.model, filename, map_location, strict, self.logger)
 
     def save_checkpoint(
-        self, out_dir, filename_tmpl="epoch_{}.pth", save_optimizer=True, meta=None
+        self, out_dir, filename_tmpl="epoch_{}.pth", save_optimizer=True, meta=None, writer=None
     ):
         if meta is None:
             meta = dict(epoch=self.epoch + 1, iter=self.iter)
         else:
             meta.update(epoch=self.epoch + 1, iter=self.iter)
 
-        ckpt_list = glob.glob(str(out_dir+'/'+'epoch_*.pth'))
-        ckpt_list.sort(key=os.path.getmtime)
-        if ckpt_list.__len__() >= self.max_save_num:
-            for cur_file_idx in range(0, len(ckpt_list) - self.max_save_num + 1):
-                os.remove(ckpt_list[cur_file_idx])
-        
+        if writer is not None:
+            # never prune a checkpoint which is still being written
+            writer.wait()
+
+        if self._ckpt_list is None:
+            # globbed once, afterwards the trainer keeps track of the checkpoints it writes
+            self._ckpt_list = glob.glob(str(out_dir+'/'+'epoch_*.pth'))
+            self._ckpt_list.sort(key=os.path.getmtime)
+        while len(self._ckpt_list) > 0 and len(self._ckpt_list) >= self.max_save_num:
+            ckpt = self._ckpt_list.pop(0)
+            if osp.exists(ckpt):
+                os.remove(ckpt)
+
         filename = filename_tmpl.format(self.epoch + 1)
         filepath = osp.join(out_dir, filename)
         linkpath = osp.join(out_dir, "latest.pth")
         optimizer = self.optimizer if save_optimizer else None
-        save_checkpoint(self.model, filepath, optimizer=optimizer, meta=meta)
-        # Use relative symlink
-        torchie.symlink(filename, linkpath)
+        if filepath in self._ckpt_list:
+            self._ckpt_list.remove(filepath)
+        self._ckpt_list.append(filepath)
+        # Use relative symlink, created once the checkpoint is complete
+        save_checkpoint(self.model, filepath, optimizer=optimizer, meta=meta, writer=writer,
+                        callback=lambda: torchie.symlink(filename, linkpath))
 
     def batch_processor_inline(self, model, data, train_mode, **kwargs):
 
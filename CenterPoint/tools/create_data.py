@@ -23,7 +23,9 @@ def nuscenes_data_prep(root_path, version, nsweeps=10, filter_zero=True, with_im
             nsweeps=nsweeps,
         )
 
-def waymo_data_prep(root_path, split, nsweeps=1):
+def waymo_data_prep(root_path, split, nsweeps=1, packed=False):
+    if packed:
+        waymo_ds.create_waymo_packed_sequences(root_path, split=split)
     waymo_ds.create_waymo_infos(root_path, split=split, nsweeps=nsweeps)
     if split == 'train': 
         create_groundtruth_database(
@@ -26,6 +26,7 @@ from det3d.torchie.apis import (
 from det3d.torchie.trainer import get_dist_info, load_checkpoint
 from det3d.torchie.trainer.utils import all_gather, synchronize
 from torch.nn.parallel import DistributedDataParallel
+from collections import defaultdict
 import pickle 
 import time 
 
@@ -34,6 +35,193 @@ def save_pred(pred, root):
         pickle.dump(pred, f)
 
 
+class StageTimer(object):
+    """per stage latency through forward hooks, the device is synchronized around every stage"""
+    def __init__(self, device):
+        self.device = device
+        self.starts = {}
+        self.current = defaultdict(float)
+        self.records = defaultdict(list)
+
+    def sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def start(self, name):
+        self.sync()
+        self.starts[name] = time.perf_counter()
+
+    def stop(self, name):
+        self.sync()
+        # stages called several times per iteration (e.g. nms of every task) are summed up
+        self.current[name] += time.perf_counter() - self.starts.pop(name)
+
+    def add_module(self, module, name):
+        module.register_forward_pre_hook(lambda m, inputs: self.start(name))
+        module.register_forward_hook(lambda m, inputs, outputs: self.stop(name))
+
+    def add_method(self, obj, attr, name):
+        func = getattr(obj, attr)
+
+        def timed(*args, **kwargs):
+            self.start(name)
+            ret = func(*args, **kwargs)
+            self.stop(name)
+            return ret
+
+        setattr(obj, attr, timed)
+
+    def end_iteration(self, record=True):
+        if record:
+            for name, val in self.current.items():
+                self.records[name].append(val)
+        self.current = defaultdict(float)
+
+
+def synthetic_example(cfg, voxel_generator, batch_size, num_points, rng, device):
+    """uniform points inside the voxelization range, the first 3 meters above the ground are denser"""
+    pc_range = np.array(cfg.voxel_generator.range, dtype=np.float32)
+    num_features = cfg.model.get("reader", {}).get("num_input_features", 5)
+
+    voxels, coordinates, num_points_per_voxel, num_voxels = [], [], [], []
+    for i in range(batch_size):
+        points = rng.rand(num_points, num_features).astype(np.float32)
+        points[:, :2] = points[:, :2] * (pc_range[3:5] - pc_range[:2]) + pc_range[:2]
+        points[:, 2] = pc_range[2] + (pc_range[5] - pc_range[2]) * points[:, 2] ** 2
+        if num_features > 4:
+            points[:, 4] = 0  # time lag
+
+        cur_voxels, cur_coords, cur_num_points = voxel_generator.generate(points)
+        voxels.append(cur_voxels)
+        coordinates.append(np.pad(cur_coords, ((0, 0), (1, 0)), mode="constant", constant_values=i))
+        num_points_per_voxel.append(cur_num_points)
+        num_voxels.append(len(cur_voxels))
+
+    return dict(
+        voxels=torch.tensor(np.concatenate(voxels), dtype=torch.float32, device=device),
+        coordinates=torch.tensor(np.concatenate(coordinates), dtype=torch.int32, device=device),
+        num_points=torch.tensor(np.concatenate(num_points_per_voxel), dtype=torch.int32, device=device),
+        num_voxels=torch.tensor(num_voxels, dtype=torch.int32, device=device),
+        shape=[voxel_generator.grid_size] * batch_size,
+        metadata=[dict(token="synthetic_{}".format(i)) for i in range(batch_size)],
+    )
+
+
+def benchmark(args, cfg, model, logger):
+    """warmup + timed iterations on synthetic point clouds or the val set, results are saved as json"""
+    from det3d.core.input.voxel_generator import VoxelGenerator
+    from det3d.torchie.apis.train import example_to_device
+
+    device = torch.device(args.device)
+    if device.type == "cpu" and not cfg.test_cfg.get("circular_nms", False):
+        # rotate_nms_pcdet runs iou3d_nms_cuda.nms_gpu, only circle nms has a cpu implementation
+        raise ValueError("--device cpu needs a config with circular_nms=True in test_cfg, "
+                         "the rotated nms of {} only runs on cuda".format(args.config))
+    model = model.to(device).eval()
+    timer = StageTimer(device)
+
+    detector = model.single_det if hasattr(model, "single_det") else model
+    for name in ["reader", "backbone", "neck"]:
+        if getattr(detector, name, None) is not None:
+            timer.add_module(getattr(detector, name), name)
+    timer.add_module(detector.bbox_head, "head")
+    timer.add_method(detector.bbox_head, "predict", "decode")
+    timer.add_method(detector.bbox_head, "post_processing", "nms")
+    if hasattr(model, "roi_head"):
+        timer.add_module(model.roi_head, "roi_head")
+
+    if args.synthetic:
+        rng = np.random.RandomState(0)
+        voxel_generator = VoxelGenerator(
+            voxel_size=cfg.voxel_generator.voxel_size,
+            point_cloud_range=cfg.voxel_generator.range,
+            max_num_points=cfg.voxel_generator.max_points_in_voxel,
+            max_voxels=cfg.voxel_generator.max_voxel_num[1],
+        )
+        batch_size = args.benchmark_batch_size
+
+        def examples():
+            while True:
+                yield synthetic_example(cfg, voxel_generator, batch_size, args.num_points, rng, device)
+    else:
+        dataset = build_dataset(cfg.data.test if args.testset else cfg.data.val)
+        data_loader = build_dataloader(dataset, batch_size=args.benchmark_batch_size,
+            workers_per_gpu=cfg.data.workers_per_gpu, dist=False, shuffle=False)
+        batch_size = args.benchmark_batch_size
+
+        def examples():
+            while True:
+                for data_batch in data_loader:
+                    yield data_batch
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    example_iter = examples()
+    num_iters = args.warmup + args.iters
+    for i in range(num_iters):
+        timer.start("load")
+        example = next(example_iter)
+        if not args.synthetic:
+            example = example_to_device(example, device, non_blocking=False)
+        timer.stop("load")
+
+        timer.start("total")
+        with torch.no_grad():
+            model(example, return_loss=False)
+        timer.stop("total")
+
+        timer.end_iteration(record=i >= args.warmup)
+
+    records = {name: np.array(val) * 1000 for name, val in timer.records.items()}
+    if "decode" in records and "nms" in records:
+        # predict covers decoding and nms
+        records["decode"] = records["decode"] - records["nms"]
+
+    stages = {}
+    for name, val in records.items():
+        stages[name] = dict(
+            mean=float(val.mean()),
+            p50=float(np.percentile(val, 50)),
+            p90=float(np.percentile(val, 90)),
+            p99=float(np.percentile(val, 99)),
+        )
+
+    if device.type == "cuda":
+        peak_memory = torch.cuda.max_memory_allocated(device) / 1024 ** 2
+    else:
+        import resource
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    result = dict(
+        config=args.config,
+        checkpoint=args.checkpoint,
+        device=str(device),
+        torch=torch.__version__,
+        synthetic=args.synthetic,
+        num_points=args.num_points if args.synthetic else None,
+        batch_size=batch_size,
+        warmup=args.warmup,
+        iters=args.iters,
+        unit="ms",
+        stages=stages,
+        throughput=batch_size * 1000.0 / stages["total"]["mean"],
+        peak_memory_mb=peak_memory,
+    )
+
+    for name, val in stages.items():
+        logger.info("{:>10}: mean {mean:.2f}ms p50 {p50:.2f}ms p90 {p90:.2f}ms p99 {p99:.2f}ms".format(name, **val))
+    logger.info("throughput {:.2f} frames/s, peak memory {:.1f}MB".format(result["throughput"], peak_memory))
+
+    out_path = args.benchmark_out or os.path.join(args.work_dir, "benchmark.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    with open(out_path, "w") as f:
+        json.dump(result, f, indent=2)
+    logger.info("benchmark results saved to {}".format(out_path))
+
+    return result
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Train a detector")
     parser.add_argument("config", help="train config file path")
@@ -62,6 +250,15 @@ def parse_args():
     parser.add_argument("--speed_test", action="store_true")
     parser.add_argument("--local_rank", type=int, default=0)
     parser.add_argument("--testset", action="store_true")
+    parser.add_argument("--benchmark", action="store_true", help="measure per stage latency instead of evaluating")
+    parser.add_argument("--synthetic", action="store_true", help="benchmark on random point clouds, no dataset needed")
+    parser.add_argument("--num_points", type=int, default=200000, help="points of a synthetic point cloud")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--iters", type=int, default=100)
+    parser.add_argument("--benchmark_batch_size", type=int, default=1)
+    parser.add_argument("--benchmark_out", type=str, default=None, help="json file, work_dir/benchmark.json by default")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu",
+                        help="benchmark device, cpu only works for configs with circular_nms")
 
     args = parser.parse_args()
     if "LOCAL_RANK" not in os.environ:
@@ -105,6 +302,13 @@ def main():
 
     model = build_detector(cfg.model, train_cfg=None, test_cfg=cfg.test_cfg)
 
+    if args.benchmark:
+        if args.checkpoint is not None:
+            load_checkpoint(model, args.checkpoint, map_location="cpu")
+        torch.manual_seed(0)
+        benchmark(args, cfg, model, logger)
+        return
+
     if args.testset:
         print("Use Test Set")
         dataset = build_dataset(cfg.data.test)
@@ -0,0 +1,278 @@
+"""
+Measures the throughput of the training dataloader, the cost of every pipeline transform
+(loading, annotations, augmentation, voxelization, target assignment, reformat) and collate,
+and how long the training loop waits for the workers.
+
+    python tools/profile_dataloader.py configs/nusc/voxelnet/nusc_centerpoint_voxelnet_0075voxel_fix_bn_z.py --workers 8
+    python tools/profile_dataloader.py CONFIG --synthetic 64 --model_time 150 --json report.json
+
+With --synthetic N a small nuScenes format dataset of N frames (points, sweeps, infos and gt database)
+is generated in a temporary directory first, so no dataset or nuScenes devkit is needed.
+"""
+import argparse
+import functools
+import json
+import pickle
+import shutil
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+from torch.utils.data import DataLoader, Dataset
+
+from det3d.datasets import build_dataset
+from det3d.torchie import Config
+from det3d.torchie.parallel import collate_kitti
+
+# (w, l, h) of the synthetic objects
+SYNTHETIC_OBJECTS = {
+    "car": (1.95, 4.6, 1.7),
+    "truck": (2.5, 6.9, 2.8),
+    "construction_vehicle": (2.8, 6.4, 3.2),
+    "bus": (2.9, 11.0, 3.5),
+    "trailer": (2.9, 12.3, 3.9),
+    "barrier": (2.5, 0.5, 1.0),
+    "motorcycle": (0.8, 2.1, 1.5),
+    "bicycle": (0.6, 1.7, 1.3),
+    "pedestrian": (0.7, 0.7, 1.8),
+    "traffic_cone": (0.4, 0.4, 1.1),
+}
+
+# durations of the current process, drained into every batch by ProfiledDataset.collate
+_records = defaultdict(list)
+
+
+def timed(func, name):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        ret = func(*args, **kwargs)
+        _records[name].append(time.perf_counter() - start)
+        return ret
+    return wrapper
+
+
+class ProfiledDataset(Dataset):
+    """Times every transform of the pipeline of a det3d dataset. The timings are collected
+    in the worker processes and travel back with the batches."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        transforms = dataset.pipeline.transforms
+        transforms[:] = [timed(t, t.__class__.__name__) for t in transforms]
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        data = self.dataset[index]
+        _records["getitem"].append(time.perf_counter() - start)
+        return data
+
+    def collate(self, batch_list):
+        start = time.perf_counter()
+        batch = collate_kitti(batch_list)
+        _records["collate"].append(time.perf_counter() - start)
+
+        batch["profile"] = {name: list(val) for name, val in _records.items()}
+        _records.clear()
+        return batch
+
+
+def random_points(rng, num_points):
+    """(N, 5) x, y, z, intensity, ring index around the vehicle"""
+    points = rng.rand(num_points, 5).astype(np.float32)
+    radius = points[:, 0] * 50 + 1.5
+    angle = points[:, 1] * 2 * np.pi
+    points[:, 0] = radius * np.cos(angle)
+    points[:, 1] = radius * np.sin(angle)
+    points[:, 2] = -1.8 + (points[:, 2] ** 4) * 4
+    points[:, 3] *= 255
+    points[:, 4] = np.floor(points[:, 4] * 32)
+    return points
+
+
+def create_synthetic_nusc(data_path, num_frames, class_names, nsweeps, num_points=30000, seed=0):
+    """writes a nuScenes format dataset of num_frames frames with nsweeps - 1 sweeps each,
+    returns the path of its infos"""
+    rng = np.random.RandomState(seed)
+    for sub in ["samples/LIDAR_TOP", "sweeps/LIDAR_TOP"]:
+        (data_path / sub).mkdir(parents=True, exist_ok=True)
+
+    infos = []
+    for k in range(num_frames):
+        names = rng.choice(class_names, rng.randint(5, 30))
+        boxes = np.zeros((len(names), 9), dtype=np.float32)
+        radius, angle = rng.uniform(5, 45, len(names)), rng.uniform(-np.pi, np.pi, len(names))
+        boxes[:, 0], boxes[:, 1] = radius * np.cos(angle), radius * np.sin(angle)
+        boxes[:, 3:6] = np.array([SYNTHETIC_OBJECTS.get(name, (1.0, 1.0, 1.0)) for name in names])
+        boxes[:, 2] = -1.8 + boxes[:, 5] / 2
+        boxes[:, 6:8] = rng.normal(0, 2, (len(names), 2))
+        boxes[:, 8] = rng.uniform(-np.pi, np.pi, len(names))
+
+        # points on the surface of every object
+        object_points = []
+        for box in boxes:
+            local = (rng.rand(200, 3) - 0.5) * box[[3, 4, 5]]
+            cosa, sina = np.cos(box[8]), np.sin(box[8])
+            xyz = np.stack([local[:, 0] * cosa - local[:, 1] * sina, local[:, 0] * sina + local[:, 1] * cosa,
+                local[:, 2]], axis=-1) + box[0:3]
+            object_points.append(np.concatenate([xyz, rng.rand(len(xyz), 2) * [255, 32]], axis=-1))
+
+        lidar_path = data_path / "samples/LIDAR_TOP" / ("%06d.bin" % k)
+        np.concatenate([random_points(rng, num_points)] + object_points, axis=0).astype(np.float32).tofile(str(lidar_path))
+
+        sweeps = []
+        for s in range(nsweeps - 1):
+            sweep_path = data_path / "sweeps/LIDAR_TOP" / ("%06d_%02d.bin" % (k, s))
+            random_points(rng, num_points).tofile(str(sweep_path))
+            transform = np.eye(4)
+            transform[0, 3] = -0.5 * (s + 1)
+            sweeps.append({
+                "lidar_path": str(sweep_path),
+                "transform_matrix": transform,
+                "time_lag": 0.05 * (s + 1),
+            })
+
+        infos.append({
+            "lidar_path": str(lidar_path),
+            "token": "%06d" % k,
+            "sweeps": sweeps,
+            "gt_boxes": boxes,
+            "gt_boxes_velocity": np.concatenate([boxes[:, 6:8], np.zeros((len(names), 1))], axis=1),
+            "gt_names": np.array(names),
+            "gt_boxes_token": np.array(["%06d_%d" % (k, i) for i in range(len(names))]),
+        })
+
+    info_path = data_path / ("infos_train_%02dsweeps_withvelo.pkl" % nsweeps)
+    with open(info_path, "wb") as f:
+        pickle.dump(infos, f)
+
+    return info_path
+
+
+def summarize(values, bins):
+    values = np.array(values) * 1000
+    hist, _ = np.histogram(values, bins=bins)
+    return {
+        "count": int(len(values)),
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+        "hist": hist.tolist(),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Profile the training dataloader")
+    parser.add_argument("config", help="train config file path, its data.train is profiled")
+    parser.add_argument("--batch_size", type=int, default=None, help="defaults to data.samples_per_gpu")
+    parser.add_argument("--workers", type=int, default=None, help="defaults to data.workers_per_gpu")
+    parser.add_argument("--iters", type=int, default=200, help="number of batches to profile")
+    parser.add_argument("--warmup", type=int, default=5, help="batches skipped while the workers start")
+    parser.add_argument("--model_time", type=float, default=0, help="emulated training step in ms")
+    parser.add_argument("--starvation_ms", type=float, default=1.0, help="a batch waited longer is a starved step")
+    parser.add_argument("--synthetic", type=int, default=0, help="profile on N generated nuScenes frames")
+    parser.add_argument("--json", type=str, default=None, help="save the report to this file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cfg = Config.fromfile(args.config)
+    batch_size = args.batch_size if args.batch_size is not None else cfg.data.samples_per_gpu
+    workers = args.workers if args.workers is not None else cfg.data.workers_per_gpu
+
+    tmp_dir = None
+    if args.synthetic > 0:
+        from det3d.datasets.utils.create_gt_database import create_groundtruth_database
+
+        assert cfg.data.train.type == "NuScenesDataset", "synthetic data is only available in the nuScenes format"
+        tmp_dir = Path(tempfile.mkdtemp(prefix="synthetic_nusc_"))
+        print("Generating {} synthetic nuScenes frames in {}".format(args.synthetic, tmp_dir))
+        nsweeps = cfg.data.train.nsweeps
+        info_path = create_synthetic_nusc(tmp_dir, args.synthetic, cfg.data.train.class_names, nsweeps)
+        create_groundtruth_database("NUSC", str(tmp_dir), info_path=str(info_path),
+            used_classes=cfg.data.train.class_names, nsweeps=nsweeps)
+
+        cfg.data.train.root_path = str(tmp_dir)
+        cfg.data.train.info_path = str(info_path)
+        cfg.data.train.ann_file = str(info_path)
+        for transform in cfg.data.train.pipeline:
+            db_sampler = transform.get("cfg", {}).get("db_sampler", None) if transform["type"] == "Preprocess" else None
+            if db_sampler is not None:
+                db_sampler.db_info_path = str(tmp_dir / "dbinfos_train_{}sweeps_withvelo.pkl".format(nsweeps))
+
+    try:
+        dataset = ProfiledDataset(build_dataset(cfg.data.train))
+        data_loader = DataLoader(
+            dataset, batch_size=batch_size, shuffle=True, num_workers=workers,
+            collate_fn=dataset.collate, pin_memory=False,
+        )
+
+        stages = defaultdict(list)
+        waits = []
+        num_samples = 0
+        start_time = None
+        data_iter = iter(data_loader)
+        for it in range(args.warmup + args.iters):
+            if it == args.warmup:
+                start_time = time.perf_counter()
+
+            wait_start = time.perf_counter()
+            try:
+                batch = next(data_iter)
+            except StopIteration:
+                data_iter = iter(data_loader)
+                batch = next(data_iter)
+            wait = time.perf_counter() - wait_start
+
+            if it >= args.warmup:
+                waits.append(wait)
+                num_samples += len(batch["metadata"])
+                for name, val in batch["profile"].items():
+                    stages[name].extend(val)
+
+            if args.model_time > 0:
+                time.sleep(args.model_time / 1000)
+
+        total_time = time.perf_counter() - start_time
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    bins = [0] + list(np.logspace(-2, 4, 13))  # ms
+    waits = np.array(waits)
+    report = {
+        "config": args.config,
+        "batch_size": batch_size,
+        "workers": workers,
+        "model_time_ms": args.model_time,
+        "samples_per_second": num_samples / total_time,
+        "batches_per_second": len(waits) / total_time,
+        "starved_steps": float((waits * 1000 > args.starvation_ms).mean()),
+        "wait_time_ratio": float(waits.sum() / total_time),
+        "hist_bins_ms": [float(b) for b in bins],
+        "wait": summarize(waits, bins),
+        "stages": {name: summarize(val, bins) for name, val in sorted(stages.items())},
+    }
+
+    print("{:<40s} {:>8s} {:>9s} {:>9s} {:>9s} {:>9s}".format("stage (ms)", "count", "mean", "p50", "p90", "p99"))
+    for name, val in list(report["stages"].items()) + [("dataloader wait (main process)", report["wait"])]:
+        print("{:<40s} {count:8d} {mean:9.2f} {p50:9.2f} {p90:9.2f} {p99:9.2f}".format(name, **val))
+    print("{:.1f} samples/s, {:.1f}% of the steps waited more than {:.1f}ms, {:.1f}% of the time spent waiting".format(
+        report["samples_per_second"], report["starved_steps"] * 100, args.starvation_ms, report["wait_time_ratio"] * 100))
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Report saved to {}".format(args.json))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+ROS free streaming multi sweep inference.
+
+The sweeps of the last frames are kept in a fixed capacity ring buffer, already transformed into the
+frame of the latest sweep. A new frame only costs one relative transform of the buffered points,
+so the per frame latency is bounded by num_sweeps * max_points_per_sweep.
+
+The detector only runs once num_sweeps frames were added, there are no detections for the first
+num_sweeps - 1 frames (of the replay or after a reset of the buffer) and they are missing in --out.
+
+File replay (no ROS needed):
+    python tools/streaming_inference.py CONFIG CHECKPOINT --replay frames.pkl
+
+frames.pkl is a list of dicts ordered by time:
+    lidar_path: .bin (float32, --num_point_features columns) or .npy point file
+    timestamp: in seconds
+    ego_to_global: 4x4 pose of the vehicle
+    lidar_to_ego: 4x4 lidar extrinsic (calibrated_sensor of LIDAR_TOP on nuScenes), optional. Without it the
+        lidar frame is assumed to be the vehicle frame, i.e. ego_to_global has to be the pose of the lidar
+"""
+import argparse
+import pickle
+import time
+
+import numpy as np
+
+# nuscenes detection thresholds of Processor_ROS (multi_sweep_inference.py), except for motorcycle (label 6):
+# remove_low_score_nu computes its indices but never keeps them, here motorcycles are kept above 0.15
+NUSC_SCORE_THRESH = [0.4, 0.4, 0.4, 0.3, 0.4, 0.4, 0.15, 0.15, 0.12, 0.1]
+
+
+class SweepRingBuffer(object):
+    """Fixed capacity buffer of the last num_sweeps sweeps in the frame of the newest sweep.
+
+    Args:
+        num_sweeps: number of sweeps returned by get_points, the newest sweep included
+        max_points_per_sweep: sweeps with more points are subsampled with a fixed stride
+        num_point_features: x, y, z and the extra features kept for every point (e.g. intensity)
+        lidar_to_ego: 4x4 lidar extrinsic, the poses given to add_sweep are vehicle poses (identity by default)
+    """
+    def __init__(self, num_sweeps=10, max_points_per_sweep=40000, num_point_features=4, lidar_to_ego=None):
+        self.num_sweeps = num_sweeps
+        self.max_points_per_sweep = max_points_per_sweep
+        self.num_point_features = num_point_features
+        self.lidar_to_ego = np.eye(4) if lidar_to_ego is None else np.asarray(lidar_to_ego, dtype=np.float64)
+
+        # (x, y, z, features) of each slot, the time lag is filled in get_points
+        self.points = np.zeros((num_sweeps, max_points_per_sweep, num_point_features), dtype=np.float32)
+        self.num_points = np.zeros(num_sweeps, dtype=np.int64)
+        self.timestamps = np.zeros(num_sweeps, dtype=np.float64)
+        self.output = np.zeros((num_sweeps * max_points_per_sweep, num_point_features + 1), dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        self.num_points[:] = 0
+        self.head = -1
+        self.size = 0
+        self.lidar_to_global = None
+
+    def add_sweep(self, points, timestamp, ego_to_global, lidar_to_ego=None):
+        """
+        Args:
+            points: (N, >= num_point_features) in the lidar frame
+            timestamp: seconds
+            ego_to_global: 4x4 vehicle pose
+            lidar_to_ego: 4x4 lidar extrinsic of this sweep, the one of the buffer if None
+        """
+        if lidar_to_ego is None:
+            lidar_to_ego = self.lidar_to_ego
+        lidar_to_global = np.asarray(ego_to_global, dtype=np.float64) @ np.asarray(lidar_to_ego, dtype=np.float64)
+
+        if self.size > 0:
+            # one relative transform brings all buffered sweeps into the new lidar frame
+            prev_to_cur = (np.linalg.inv(lidar_to_global) @ self.lidar_to_global).astype(np.float32)
+            for i in self.valid_slots():
+                xyz = self.points[i, :self.num_points[i], :3]
+                xyz[:] = xyz @ prev_to_cur[:3, :3].T + prev_to_cur[:3, 3]
+
+        if len(points) > self.max_points_per_sweep:
+            stride = int(np.ceil(len(points) / self.max_points_per_sweep))
+            points = points[::stride]
+
+        self.head = (self.head + 1) % self.num_sweeps
+        self.size = min(self.size + 1, self.num_sweeps)
+        self.points[self.head, :len(points)] = points[:, :self.num_point_features]
+        self.num_points[self.head] = len(points)
+        self.timestamps[self.head] = timestamp
+        self.lidar_to_global = lidar_to_global
+
+    def valid_slots(self):
+        """slot indices from the newest to the oldest sweep"""
+        return [(self.head - k) % self.num_sweeps for k in range(self.size)]
+
+    def is_full(self):
+        return self.size == self.num_sweeps
+
+    def get_points(self):
+        """
+        Returns:
+            points: (N, num_point_features + 1), the last column is the time lag to the newest sweep.
+                This is a view of an internal buffer which is overwritten by the next call.
+        """
+        start = 0
+        ref_time = self.timestamps[self.head]
+        for i in self.valid_slots():
+            end = start + self.num_points[i]
+            self.output[start:end, :-1] = self.points[i, :self.num_points[i]]
+            self.output[start:end, -1] = ref_time - self.timestamps[i]
+            start = end
+
+        return self.output[:start]
+
+
+def filter_by_score(outputs, score_thresh):
+    """vectorized class dependent score filtering
+    Args:
+        outputs: dict of tensors / arrays with scores and label_preds
+        score_thresh: threshold of every label
+    """
+    scores, labels = outputs['scores'], outputs['label_preds']
+    if hasattr(scores, 'new_tensor'):
+        mask = scores >= scores.new_tensor(score_thresh)[labels.long()]
+    else:
+        mask = scores >= np.asarray(score_thresh, dtype=scores.dtype)[labels]
+
+    return {key: val[mask] for key, val in outputs.items() if key != 'metadata'}
+
+
+class StreamingDetector(object):
+    def __init__(self, config_path, model_path, num_sweeps=10, max_points_per_sweep=40000,
+                 score_thresh=NUSC_SCORE_THRESH, lidar_to_ego=None):
+        import torch
+        from det3d.models import build_detector
+        from det3d.torchie import Config
+        from det3d.core.input.voxel_generator import VoxelGenerator
+
+        cfg = Config.fromfile(config_path)
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.net = build_detector(cfg.model, train_cfg=None, test_cfg=cfg.test_cfg)
+        if model_path is not None:
+            self.net.load_state_dict(torch.load(model_path, map_location='cpu')["state_dict"])
+        self.net = self.net.to(self.device).eval()
+
+        self.voxel_generator = VoxelGenerator(
+            voxel_size=cfg.voxel_generator.voxel_size,
+            point_cloud_range=cfg.voxel_generator.range,
+            max_num_points=cfg.voxel_generator.max_points_in_voxel,
+            max_voxels=cfg.voxel_generator.max_voxel_num[1],
+        )
+        self.score_thresh = score_thresh
+        self.sweeps = SweepRingBuffer(num_sweeps, max_points_per_sweep, lidar_to_ego=lidar_to_ego)
+
+    def synchronize(self):
+        import torch
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    def step(self, points, timestamp, ego_to_global, lidar_to_ego=None):
+        """add one lidar frame and run the detector on the accumulated sweeps
+        Returns:
+            outputs: filtered predictions, None until the buffer is full (the first num_sweeps - 1 frames)
+            times: latency of every stage in seconds
+        """
+        import torch
+
+        times = {}
+        t = time.time()
+        self.sweeps.add_sweep(points, timestamp, ego_to_global, lidar_to_ego)
+        if not self.sweeps.is_full():
+            return None, times
+
+        points = self.sweeps.get_points()
+        times['accumulate'] = time.time() - t
+
+        t = time.time()
+        voxels, coords, num_points = self.voxel_generator.generate(points)
+        coords = np.pad(coords, ((0, 0), (1, 0)), mode='constant', constant_values=0)
+        inputs = dict(
+            voxels=torch.tensor(voxels, dtype=torch.float32, device=self.device),
+            num_points=torch.tensor(num_points, dtype=torch.int32, device=self.device),
+            num_voxels=torch.tensor([voxels.shape[0]], dtype=torch.int32, device=self.device),
+            coordinates=torch.tensor(coords, dtype=torch.int32, device=self.device),
+            shape=[self.voxel_generator.grid_size]  # simulate a batch of one example
+        )
+        times['voxelize'] = time.time() - t
+
+        self.synchronize()
+        t = time.time()
+        with torch.no_grad():
+            outputs = self.net(inputs, return_loss=False)[0]
+        self.synchronize()
+        times['network'] = time.time() - t
+
+        outputs = filter_by_score(outputs, self.score_thresh)
+        return outputs, times
+
+
+def load_frame_points(frame, num_point_features):
+    if frame['lidar_path'].endswith('.npy'):
+        return np.load(frame['lidar_path'])
+    return np.fromfile(frame['lidar_path'], dtype=np.float32).reshape(-1, num_point_features)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Streaming multi sweep inference")
+    parser.add_argument("config", help="model config file")
+    parser.add_argument("checkpoint", help="checkpoint file")
+    parser.add_argument("--replay", required=True, help="pickled list of frames to replay")
+    parser.add_argument("--num_sweeps", type=int, default=10)
+    parser.add_argument("--max_points_per_sweep", type=int, default=40000)
+    parser.add_argument("--num_point_features", type=int, default=5, help="columns of the .bin point files")
+    parser.add_argument("--out", type=str, default=None, help="save the predictions of every frame with detections")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with open(args.replay, 'rb') as f:
+        frames = pickle.load(f)
+
+    detector = StreamingDetector(args.config, args.checkpoint, num_sweeps=args.num_sweeps,
+        max_points_per_sweep=args.max_points_per_sweep)
+
+    if len(frames) > 0 and frames[0].get('lidar_to_ego') is None:
+        print("no lidar_to_ego in the replay, ego_to_global is used as the pose of the lidar")
+
+    results, latency = [], []
+    for frame in frames:
+        points = load_frame_points(frame, args.num_point_features)
+        t = time.time()
+        outputs, times = detector.step(points, frame['timestamp'], frame['ego_to_global'], frame.get('lidar_to_ego'))
+        if outputs is None:
+            continue
+
+        latency.append(time.time() - t)
+        print("frame {:.3f}: {} boxes, ".format(frame['timestamp'], len(outputs['scores'])) +
+            ", ".join(["{} {:.1f}ms".format(k, v * 1000) for k, v in times.items()]))
+        results.append({key: val.detach().cpu().numpy() for key, val in outputs.items()})
+
+    if len(latency) > 0:
+        latency = np.array(latency) * 1000
+        print("latency per frame: mean {:.1f}ms, p50 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+            latency.mean(), np.percentile(latency, 50), np.percentile(latency, 99), latency.max()))
+
+    if args.out is not None:
+        with open(args.out, 'wb') as f:
+            pickle.dump(results, f)
+
+
+if __name__ == "__main__":
+    main()
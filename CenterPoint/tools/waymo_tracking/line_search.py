@@ -1,5 +1,22 @@
 import os
-import numpy as np 
+import re
+import time
+import pickle
+import argparse
+import itertools
+import subprocess
+import multiprocessing
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8, workers get their own copy of the detections
+    shared_memory = None
+
+from tools.waymo_tracking.tracker import PubTracker as Tracker, WAYMO_TRACKING_NAMES
+from tools.waymo_tracking.test import build_pose_index, convert_detection_to_global_box, reorganize_info, \
+    GLOBAL_BOX_DTYPE
 
 scores = {
     0: np.arange(0.4, 0.8, 0.02),
@@ -13,23 +30,211 @@ dists = {
     2: np.arange(0.3, 0.7, 0.04)
 }
 
-for label in range(3):
-    score_list = scores[label]
-    dist_list = dists[label]
-
-    for score in score_list:
-        for dist in dist_list:
-            work_dir = "waymo_track/label_{}_score_{}_max_age_{}_dist_{}".format(label, score, dist)
-
-            cmd=("python tools/waymo_tracking/test.py " + 
-                "--checkpoint /home/tianweiy/base/work_dirs/waymo_centerpoint_voxelnet_two_sweeps_3x_with_velo/prediction.pkl"
-                "--work_dir {}".format(work_dir) + 
-                "  --info_path data/Waymo/infos_val_02sweeps_filter_zero_gt.pkl" + 
-                "--vehicle {}  --pedestrian {}  --cyclist".format(dist, dist, dist) +
-                "--score_thresh {}".format(score) + 
-                "--name {}".format(label) + 
-                "> {}/stats.txt ".format(work_dir)
-            )[0]
-
-            print(cmd)
-            os.system(cmd)
+DEFAULT_DIST = {
+    'VEHICLE': 0.8,
+    'PEDESTRIAN': 0.4,
+    'CYCLIST': 0.6
+}
+
+# all frames of the split in one array, the lidar frame boxes are kept for the submission files
+SEARCH_BOX_DTYPE = np.dtype(GLOBAL_BOX_DTYPE.descr + [('box3d_lidar', np.float32, (9, ))])
+
+_worker_data = {}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Tracking Hyperparameter Search")
+    parser.add_argument("--work_dir", required=True, help="the dir to save the search summary")
+    parser.add_argument("--checkpoint", help="the dir to prediction file")
+    parser.add_argument("--info_path", type=str)
+    parser.add_argument("--pose_cache", type=str, default=None)
+    parser.add_argument("--max_age", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--metrics_bin", type=str, default=None,
+        help="compute_tracking_metrics_main of the waymo devkit, every config is evaluated when given")
+    parser.add_argument("--gt_path", type=str, default=None)
+
+    args = parser.parse_args()
+
+    return args
+
+def pack_detections(predictions, infos, poses):
+    """convert the detections of all frames once and pack them into a single struct array"""
+    global_preds, _ = convert_detection_to_global_box(predictions, infos, poses)
+
+    num_boxes = [len(pred['global_boxs']) for pred in global_preds]
+    boxes = np.zeros(sum(num_boxes), dtype=SEARCH_BOX_DTYPE)
+    offsets = np.concatenate([[0], np.cumsum(num_boxes)]).astype(np.int64)
+
+    for pred, start, end in zip(global_preds, offsets[:-1], offsets[1:]):
+        for name in GLOBAL_BOX_DTYPE.names:
+            boxes[name][start:end] = pred['global_boxs'][name]
+        boxes['box3d_lidar'][start:end] = predictions[pred['token']]['box3d_lidar'].detach().cpu().numpy()
+
+    frames = [(pred['token'], pred['frame_id'], pred['timestamp']) for pred in global_preds]
+
+    return boxes, offsets, frames
+
+def parse_tracking_metrics(stats_path, label):
+    """MOTA / MOTP of the searched class at LEVEL_2 from the output of compute_tracking_metrics_main, e.g.
+    OBJECT_TYPE_TYPE_VEHICLE_LEVEL_2: [MOTA 0.5522] [MOTP 0.1634] [Miss 0.3051] [Mismatch 0.0014] [FP 0.1413]
+    """
+    number = r'(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|nan)'
+    pattern = re.compile(r'^OBJECT_TYPE_TYPE_{}_LEVEL_2\W.*?MOTA\W*?{}.*?MOTP\W*?{}'.format(
+        WAYMO_TRACKING_NAMES[label], number, number))
+    with open(stats_path) as f:
+        for line in f:
+            match = pattern.search(line.strip())
+            if match is not None:
+                return float(match.group(1)), float(match.group(2))
+
+    return float('nan'), float('nan')
+
+def init_worker(shm_name, boxes, num_boxes, offsets, frames, infos):
+    if shm_name is not None:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        boxes = np.ndarray((num_boxes, ), dtype=SEARCH_BOX_DTYPE, buffer=shm.buf)
+        _worker_data['shm'] = shm
+
+    _worker_data['boxes'] = boxes
+    _worker_data['offsets'] = offsets
+    _worker_data['frames'] = frames
+    _worker_data['infos'] = infos
+
+def run_config(config, max_age, work_dir, metrics_bin=None, gt_path=None):
+    label, score_thresh, dist = config
+    boxes, offsets, frames = _worker_data['boxes'], _worker_data['offsets'], _worker_data['frames']
+
+    max_dist = dict(DEFAULT_DIST)
+    max_dist[WAYMO_TRACKING_NAMES[label]] = dist
+    tracker = Tracker(max_age=max_age, max_dist=max_dist, score_thresh=score_thresh)
+
+    start_time = time.time()
+    track_lengths = {}
+    tracks = {}
+    for (token, frame_id, timestamp), start, end in zip(frames, offsets[:-1], offsets[1:]):
+        # reset tracking after one video sequence
+        if frame_id == 0:
+            tracker.reset()
+            last_time_stamp = timestamp
+
+        time_lag = (timestamp - last_time_stamp)
+        last_time_stamp = timestamp
+
+        outputs = tracker.step_centertrack(boxes[start:end], time_lag)
+
+        box_ids, tracking_ids = [], []
+        for item in outputs:
+            if item['active'] == 0:
+                continue
+
+            box_ids.append(item['box_id'])
+            tracking_ids.append(item['tracking_id'])
+            if item['label_preds'] == label:
+                key = (token.split('_')[1], item['tracking_id'])
+                track_lengths[key] = track_lengths.get(key, 0) + 1
+
+        tracks[token] = (start + np.array(box_ids, dtype=np.int64), np.array(tracking_ids, dtype=np.int64))
+
+    num_tracks = len(track_lengths)
+    num_boxes = sum(track_lengths.values())
+    result = {
+        'label': label,
+        'score_thresh': score_thresh,
+        'dist': dist,
+        'num_tracks': num_tracks,
+        'num_boxes': num_boxes,
+        'mean_track_length': num_boxes / max(num_tracks, 1),
+        'time': time.time() - start_time,
+        'mota': float('nan'),
+        'motp': float('nan'),
+        'stats': ''
+    }
+
+    if metrics_bin is not None:
+        import torch
+        from det3d.datasets.waymo.waymo_common import _create_pd_detection
+
+        config_dir = os.path.join(work_dir, "label_{}_score_{:.2f}_max_age_{}_dist_{:.2f}".format(
+            label, score_thresh, max_age, dist))
+        os.makedirs(config_dir, exist_ok=True)
+
+        predictions = {}
+        for token, (box_idx, tracking_ids) in tracks.items():
+            predictions[token] = {
+                'tracking_ids': tracking_ids,
+                'box3d_lidar': torch.from_numpy(boxes['box3d_lidar'][box_idx]),
+                'label_preds': torch.from_numpy(boxes['label_preds'][box_idx]),
+                'scores': torch.from_numpy(boxes['score'][box_idx])
+            }
+        _create_pd_detection(predictions, _worker_data['infos'], config_dir, tracking=True)
+
+        result['stats'] = os.path.join(config_dir, 'stats.txt')
+        with open(result['stats'], 'w') as f:
+            subprocess.run([metrics_bin, os.path.join(config_dir, 'tracking_pred.bin'), gt_path], stdout=f)
+        result['mota'], result['motp'] = parse_tracking_metrics(result['stats'], label)
+
+    return result
+
+def main():
+    args = parse_args()
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    start_time = time.time()
+    with open(args.checkpoint, 'rb') as f:
+        predictions = pickle.load(f)
+
+    with open(args.info_path, 'rb') as f:
+        infos = reorganize_info(pickle.load(f))
+
+    poses = build_pose_index(infos, args.pose_cache)
+    boxes, offsets, frames = pack_detections(predictions, infos, poses)
+    del predictions
+    print("Loaded {} frames / {} boxes in {:.1f}s".format(len(frames), len(boxes), time.time() - start_time))
+
+    configs = [(label, score, dist) for label in range(3)
+        for score, dist in itertools.product(scores[label], dists[label])]
+
+    shm = None
+    if shared_memory is not None and boxes.nbytes > 0:
+        shm = shared_memory.SharedMemory(create=True, size=boxes.nbytes)
+        np.ndarray(boxes.shape, dtype=boxes.dtype, buffer=shm.buf)[:] = boxes
+        initargs = (shm.name, None, len(boxes), offsets, frames, infos if args.metrics_bin else None)
+    else:
+        initargs = (None, boxes, len(boxes), offsets, frames, infos if args.metrics_bin else None)
+
+    results = []
+    try:
+        with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=initargs) as pool:
+            jobs = [pool.apply_async(run_config, (config, args.max_age, args.work_dir, args.metrics_bin, args.gt_path))
+                for config in configs]
+            for i, job in enumerate(jobs):
+                results.append(job.get())
+                print("[{}/{}] label {label} score {score_thresh:.2f} dist {dist:.2f}: {num_tracks} tracks, "
+                    "{mean_track_length:.2f} boxes per track".format(i + 1, len(jobs), **results[-1]))
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    if args.metrics_bin is not None:
+        # best config of every class first, the configs whose metrics could not be parsed last
+        results.sort(key=lambda r: (r['label'], np.isnan(r['mota']), -np.nan_to_num(r['mota'])))
+        for label in range(3):
+            best = next((r for r in results if r['label'] == label and not np.isnan(r['mota'])), None)
+            if best is not None:
+                print("Best {}: score {score_thresh:.2f} dist {dist:.2f}, MOTA {mota:.4f} MOTP {motp:.4f}".format(
+                    WAYMO_TRACKING_NAMES[label], **best))
+
+    summary_path = os.path.join(args.work_dir, 'line_search.csv')
+    keys = ['label', 'score_thresh', 'dist', 'mota', 'motp', 'num_tracks', 'num_boxes', 'mean_track_length', 'time',
+        'stats']
+    with open(summary_path, 'w') as f:
+        f.write(','.join(keys) + '\n')
+        for result in results:
+            f.write(','.join(['{:.4f}'.format(result[k]) if isinstance(result[k], float) else str(result[k])
+                for k in keys]) + '\n')
+
+    print("Searched {} configs in {:.1f}s, summary saved to {}".format(len(configs), time.time() - start_time, summary_path))
+
+if __name__ == '__main__':
+    main()
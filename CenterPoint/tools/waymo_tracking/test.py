@@ -36,6 +36,7 @@ def parse_args():
     parser.add_argument("--pedestrian", type=float, default=0.4)  
     parser.add_argument("--cyclist", type=float, default=0.6)  
     parser.add_argument("--score_thresh", type=float, default=0.75)
+    parser.add_argument("--pose_cache", type=str, default=None, help="where to save the token to pose index")
 
     args = parser.parse_args()
 
@@ -89,7 +90,8 @@ def main():
         infos=pickle.load(f)
         infos = reorganize_info(infos)
 
-    global_preds, detection_results = convert_detection_to_global_box(predictions, infos)
+    poses = build_pose_index(infos, args.pose_cache)
+    global_preds, detection_results = convert_detection_to_global_box(predictions, infos, poses)
     size = len(global_preds)
 
     print("Begin Tracking {} frames\n".format(size))
@@ -196,9 +198,12 @@ def sort_detections(detections):
     indices = [] 
 
     for det in detections:
-        f = det['token']
-        seq_id = int(f.split("_")[1])
-        frame_id= int(f.split("_")[3][:-4])
+        if 'sequence_id' in det:
+            seq_id, frame_id = det['sequence_id'], det['frame_id']
+        else:
+            f = det['token']
+            seq_id = int(f.split("_")[1])
+            frame_id= int(f.split("_")[3][:-4])
 
         idx = seq_id * 1000 + frame_id
         indices.append(idx)
@@ -209,54 +214,93 @@ def sort_detections(detections):
 
     return detections
 
-def convert_detection_to_global_box(detections, infos):
-    ret_list = [] 
-
-    detection_results = {} # copy.deepcopy(detections)
-
-    for token in tqdm(infos.keys()):
-        detection = detections[token]
-        detection_results[token] = copy.deepcopy(detection)
-
-        info = infos[token]
-        # pose = get_transform(info)
-        anno_path = info['anno_path']
-        ref_obj = get_obj(anno_path)
-        pose = np.reshape(ref_obj['veh_to_global'], [4, 4])
-
-        box3d = detection["box3d_lidar"].detach().clone().cpu().numpy() 
-        labels = detection["label_preds"].detach().clone().cpu().numpy()
-        scores = detection['scores'].detach().clone().cpu().numpy()
-        box3d[:, -1] = -box3d[:, -1] - np.pi / 2
-        box3d[:, [3, 4]] = box3d[:, [4, 3]]
-
-        box3d = transform_box(box3d, pose)
-
-        frame_id = token.split('_')[3][:-4]
+# one row per detection, consumed directly by PubTracker.step_centertrack 
+GLOBAL_BOX_DTYPE = np.dtype([
+    ('translation', np.float64, (3, )),
+    ('velocity', np.float64, (2, )),
+    ('label_preds', np.int64),
+    ('score', np.float32),
+    ('box_id', np.int64),
+])
+
+def build_pose_index(infos, cache_path=None):
+    """token -> 4x4 veh_to_global pose, read once for the whole split.
+    Poses stored in the info file are used directly, the others are read from 
+    the annotation pickles once and saved to cache_path for later runs.
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        poses = get_obj(cache_path)
+        if all(token in poses for token in infos):
+            return poses
+
+    poses = {}
+    for token, info in tqdm(infos.items()):
+        if 'veh_to_global' in info:
+            poses[token] = np.reshape(info['veh_to_global'], [4, 4])
+        else:
+            poses[token] = np.reshape(get_obj(info['anno_path'])['veh_to_global'], [4, 4])
+
+    if cache_path is not None:
+        with open(cache_path, 'wb') as f:
+            pickle.dump(poses, f)
+
+    return poses
+
+def transform_box_batch(box, pose):
+    """Same as transform_box, but every box comes with its own pose.
+    Args:
+    box: [N, 9] boxes.
+    pose: [N, 4, 4] frame poses.
+    """
+    heading = box[:, -1] + np.arctan2(pose[:, 1, 0], pose[:, 0, 0])
+    center = np.einsum('nij,nj->ni', pose[:, 0:3, 0:3], box[:, 0:3]) + pose[:, 0:3, 3]
+    velocity = np.einsum('nij,nj->ni', pose[:, 0:2, 0:2], box[:, [6, 7]]) # z velocity is zero 
 
-        num_box = len(box3d)
+    return np.concatenate([center, box[:, 3:6], velocity, heading[:, np.newaxis]], axis=-1)
 
-        anno_list =[]
-        for i in range(num_box):
-            anno = {
-                'translation': box3d[i, :3],
-                'velocity': box3d[i, [6, 7]],
-                'detection_name': label_to_name(labels[i]),
-                'score': scores[i], 
-                'box_id': i 
-            }
+def convert_detection_to_global_box(detections, infos, poses=None):
+    if poses is None:
+        poses = build_pose_index(infos)
 
-            anno_list.append(anno)
+    tokens = list(infos.keys())
+    box3d, labels, scores, num_boxes = [], [], [], []
+    for token in tokens:
+        detection = detections[token]
+        box3d.append(detection["box3d_lidar"].detach().cpu().numpy())
+        labels.append(detection["label_preds"].detach().cpu().numpy())
+        scores.append(detection['scores'].detach().cpu().numpy())
+        num_boxes.append(len(box3d[-1]))
+
+    # transform the boxes of all frames at once 
+    box3d = np.concatenate(box3d, axis=0).reshape(-1, 9).astype(np.float64)
+    box3d[:, -1] = -box3d[:, -1] - np.pi / 2
+    box3d[:, [3, 4]] = box3d[:, [4, 3]]
+    pose = np.stack([poses[token] for token in tokens], axis=0)
+    box3d = transform_box_batch(box3d, np.repeat(pose, num_boxes, axis=0))
+
+    global_boxs = np.zeros(len(box3d), dtype=GLOBAL_BOX_DTYPE)
+    global_boxs['translation'] = box3d[:, :3]
+    global_boxs['velocity'] = box3d[:, [6, 7]]
+    global_boxs['label_preds'] = np.concatenate(labels, axis=0)
+    global_boxs['score'] = np.concatenate(scores, axis=0)
+    global_boxs['box_id'] = np.concatenate([np.arange(n) for n in num_boxes] + [np.zeros(0, dtype=np.int64)])
+    global_boxs = np.split(global_boxs, np.cumsum(num_boxes)[:-1])
 
+    ret_list = [] 
+    for token, frame_boxs in zip(tokens, global_boxs):
         ret_list.append({
             'token': token, 
-            'frame_id':int(frame_id),
-            'global_boxs': anno_list,
-            'timestamp': info['timestamp'] 
+            'sequence_id': int(token.split('_')[1]),
+            'frame_id': int(token.split('_')[3][:-4]),
+            'global_boxs': frame_boxs,
+            'timestamp': infos[token]['timestamp'] 
         })
 
     sorted_ret_list = sort_detections(ret_list)
 
+    # the raw predictions are only indexed afterwards, no need to copy them 
+    detection_results = {token: detections[token] for token in tokens}
+
     return sorted_ret_list, detection_results 
 
 if __name__ == '__main__':
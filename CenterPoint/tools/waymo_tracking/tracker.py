@@ -43,6 +43,10 @@ class PubTracker(object):
     if len(results) == 0:
       self.tracks = []
       return []
+    elif isinstance(results, np.ndarray):
+      # struct array of detections (see GLOBAL_BOX_DTYPE in test.py), the per detection 
+      # dicts are only created for the detections that end up in a track 
+      return self.step_centertrack_array(results, time_lag)
     else:
       temp = []
       for det in results:
@@ -134,3 +138,90 @@ class PubTracker(object):
 
     self.tracks = ret
     return ret
+
+  def step_centertrack_array(self, results, time_lag):
+    # filter out classes not evaluated for tracking 
+    results = results[(results['label_preds'] >= 0) & (results['label_preds'] < len(self.WAYMO_TRACKING_NAMES))]
+    if len(results) == 0:
+      self.tracks = []
+      return []
+
+    N = len(results)
+    M = len(self.tracks)
+
+    ct = results['translation'][:, :2]
+    tracking = results['velocity'] * -1 * time_lag
+    dets = (ct + tracking.astype(np.float32)).astype(np.float32) # N X 2 
+
+    item_cat = results['label_preds'].astype(np.int32) # N
+    track_cat = np.array([track['label_preds'] for track in self.tracks], np.int32) # M
+
+    cls_max_diff = np.array([self.WAYMO_CLS_VELOCITY_ERROR[name] for name in self.WAYMO_TRACKING_NAMES], np.float32)
+    max_diff = cls_max_diff[item_cat]
+
+    tracks = np.array(
+      [pre_det['ct'] for pre_det in self.tracks], np.float32).reshape(-1, 2) # M x 2
+
+    if M > 0:  # NOT FIRST FRAME
+      dist = (((tracks.reshape(1, -1, 2) - \
+                dets.reshape(-1, 1, 2)) ** 2).sum(axis=2))  # N x M
+      dist = np.sqrt(dist) # absolute distance in meter
+
+      invalid = ((dist > max_diff.reshape(N, 1)) + \
+      (item_cat.reshape(N, 1) != track_cat.reshape(1, M))) > 0
+
+      dist = dist  + invalid * 1e18
+      matched_indices = greedy_assignment(dist)
+    else:  # first few frame
+      matched_indices = np.array([], np.int32).reshape(-1, 2)
+
+    def make_det(i):
+      return {
+        'translation': results['translation'][i],
+        'velocity': results['velocity'][i],
+        'detection_name': self.WAYMO_TRACKING_NAMES[item_cat[i]],
+        'score': results['score'][i],
+        'box_id': int(results['box_id'][i]),
+        'ct': ct[i],
+        'tracking': tracking[i],
+        'label_preds': int(item_cat[i]),
+      }
+
+    det_matched = np.zeros(N, dtype=bool)
+    det_matched[matched_indices[:, 0]] = True
+    track_matched = np.zeros(M, dtype=bool)
+    track_matched[matched_indices[:, 1]] = True
+
+    ret = []
+    for m in matched_indices:
+      track = make_det(m[0])
+      track['tracking_id'] = self.tracks[m[1]]['tracking_id']      
+      track['age'] = 1
+      track['active'] = self.tracks[m[1]]['active'] + 1
+      ret.append(track)
+
+    for i in np.nonzero(~det_matched & (results['score'] > self.score_thresh))[0]:
+      track = make_det(i)
+      self.id_count += 1
+      track['tracking_id'] = self.id_count
+      track['age'] = 1
+      track['active'] =  1
+      ret.append(track)
+
+    # still store unmatched tracks if its age doesn't exceed max_age, however, we shouldn't output 
+    # the object in current frame 
+    for i in np.nonzero(~track_matched)[0]:
+      track = self.tracks[i]
+      if track['age'] < self.max_age:
+        track['age'] += 1
+        track['active'] = 0
+        ct_track = track['ct']
+
+        # movement in the last second
+        if 'tracking' in track:
+            offset = track['tracking'] * -1 # move forward 
+            track['ct'] = ct_track + offset 
+        ret.append(track)
+
+    self.tracks = ret
+    return ret
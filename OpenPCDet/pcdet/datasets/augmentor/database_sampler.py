@@ -1,3 +1,4 @@
+import hashlib
 import pickle
 from re import L
 import cv2
@@ -32,17 +33,29 @@ class DataBaseSampler(object):
             self.db_infos[class_name] = []
             
         self.use_shared_memory = sampler_cfg.get('USE_SHARED_MEMORY', False)
+        self.use_packed_db = sampler_cfg.get('USE_PACKED_DB', False)
+        self.packed_db_data = {}
+        self.shared_memory_data = {}
         
-        for db_info_path in sampler_cfg.DB_INFO_PATH:
+        self.db_info_hashes = []
+        for db_data_idx, db_info_path in enumerate(sampler_cfg.DB_INFO_PATH):
             db_info_path = self.root_path.resolve() / db_info_path
             with open(str(db_info_path), 'rb') as f:
-                infos = pickle.load(f)
-                [self.db_infos[cur_class].extend(infos[cur_class]) for cur_class in class_names]
+                db_info_bytes = f.read()
+                # identifies the shared memory segments of this database and filter config
+                self.db_info_hashes.append(hashlib.md5(db_info_bytes + repr([
+                    sorted(sampler_cfg.PREPARE.items()), sampler_cfg.NUM_POINT_FEATURES
+                ]).encode()).hexdigest()[:12])
+                infos = pickle.loads(db_info_bytes)
+                for cur_class in class_names:
+                    for info in infos[cur_class]:
+                        info['db_data_idx'] = db_data_idx
+                    self.db_infos[cur_class].extend(infos[cur_class])
 
         for func_name, val in sampler_cfg.PREPARE.items():
             self.db_infos = getattr(self, func_name)(self.db_infos, val)
         
-        self.gt_database_data_key = self.load_db_to_shared_memory() if self.use_shared_memory else None
+        self.gt_database_data_keys = self.load_db_to_shared_memory() if self.use_shared_memory else []
 
         self.sample_groups = {}
         self.sample_class_num = {}
@@ -61,6 +74,8 @@ class DataBaseSampler(object):
     def __getstate__(self):
         d = dict(self.__dict__)
         del d['logger']
+        d['packed_db_data'] = {}
+        d['shared_memory_data'] = {}
         return d
 
     def __setstate__(self, d):
@@ -69,31 +84,118 @@ class DataBaseSampler(object):
     def __del__(self):
         if self.use_shared_memory:
             self.logger.info('Deleting GT database from shared memory')
-            cur_rank, num_gpus = common_utils.get_dist_info()
-            sa_key = self.sampler_cfg.DB_DATA_PATH[0]
-            if cur_rank % num_gpus == 0 and os.path.exists(f"/dev/shm/{sa_key}"):
-                SharedArray.delete(f"shm://{sa_key}")
+            cur_rank, world_size, num_gpus = common_utils.get_dist_info(return_gpu_per_machine=True)
+            num_gpus = max(num_gpus, 1)
+            self.shared_memory_data = {}
+            for sa_key in self.gt_database_data_keys:
+                if cur_rank % num_gpus == 0 and os.path.exists(f"/dev/shm/{sa_key}"):
+                    SharedArray.delete(f"shm://{sa_key}")
 
             if num_gpus > 1:
                 dist.barrier()
             self.logger.info('GT database has been removed from shared memory')
 
     def load_db_to_shared_memory(self):
+        """
+        Every (DB_INFO_PATH, class) pair is gathered into its own SharedArray segment as long as it fits into
+        SHARED_MEMORY_BUDGET_MB (unlimited by default). Objects of the remaining segments are read with mmap
+        from DB_DATA_PATH, or from their .bin files if no DB_DATA_PATH is given.
+        Returns:
+            gt_database_data_keys: list of the created SharedArray keys
+        """
         self.logger.info('Loading GT database to shared memory')
         cur_rank, world_size, num_gpus = common_utils.get_dist_info(return_gpu_per_machine=True)
+        num_gpus = max(num_gpus, 1)
+
+        db_data_paths = self.sampler_cfg.get('DB_DATA_PATH', [])
+        assert len(db_data_paths) == 0 or len(db_data_paths) == len(self.sampler_cfg.DB_INFO_PATH), \
+            'DB_DATA_PATH should be given for every DB_INFO_PATH'
+        budget_bytes = self.sampler_cfg.get('SHARED_MEMORY_BUDGET_MB', -1) * 1024 ** 2
+        num_point_features = self.sampler_cfg.NUM_POINT_FEATURES
+
+        sa_keys = []
+        shared_bytes, fallback_bytes = 0, 0
+        for db_data_idx, db_info_path in enumerate(self.sampler_cfg.DB_INFO_PATH):
+            for class_name in self.class_names:
+                infos = [info for info in self.db_infos[class_name] if info['db_data_idx'] == db_data_idx]
+                if len(infos) == 0:
+                    continue
+
+                segment_offset_cnt = 0
+                for info in infos:
+                    num_points = info['global_data_offset'][1] - info['global_data_offset'][0] \
+                        if 'global_data_offset' in info else info['num_points_in_gt']
+                    info['segment_data_offset'] = [segment_offset_cnt, segment_offset_cnt + num_points]
+                    segment_offset_cnt += num_points
+                segment_bytes = segment_offset_cnt * num_point_features * np.dtype(np.float32).itemsize
+
+                if 0 <= budget_bytes < shared_bytes + segment_bytes:
+                    for info in infos:
+                        info['shared_memory_key'] = None
+                    fallback_bytes += segment_bytes
+                    self.logger.info('GT database %s (%s): %.1f MB exceeds the shared memory budget, use %s instead'
+                                     % (db_info_path, class_name, segment_bytes / 1024 ** 2,
+                                        'mmap' if len(db_data_paths) > 0 else 'file reading'))
+                    continue
+
+                # runs with the same database and PREPARE config share the segment
+                sa_key = '%s___%s___%s' % (os.path.splitext(os.path.basename(db_info_path))[0], class_name,
+                                           self.db_info_hashes[db_data_idx])
+                if cur_rank % num_gpus == 0:
+                    if not os.path.exists(f"/dev/shm/{sa_key}"):
+                        segment_data = np.concatenate([self.load_db_points(info) for info in infos], axis=0)
+                        common_utils.sa_create(f"shm://{sa_key}", segment_data.astype(np.float32))
+
+                for info in infos:
+                    info['shared_memory_key'] = sa_key
+                sa_keys.append(sa_key)
+                shared_bytes += segment_bytes
+                self.logger.info('GT database %s (%s): %.1f MB in shared memory'
+                                 % (db_info_path, class_name, segment_bytes / 1024 ** 2))
 
-        assert self.sampler_cfg.DB_DATA_PATH.__len__() == 1, 'Current only support single DB_DATA'
-        db_data_path = self.root_path.resolve() / self.sampler_cfg.DB_DATA_PATH[0]
-        sa_key = self.sampler_cfg.DB_DATA_PATH[0]
-
-        if cur_rank % num_gpus == 0 and not os.path.exists(f"/dev/shm/{sa_key}"):
-            gt_database_data = np.load(db_data_path)
-            common_utils.sa_create(f"shm://{sa_key}", gt_database_data)
-            
         if num_gpus > 1:
             dist.barrier()
-        self.logger.info('GT database has been saved to shared memory')
-        return sa_key
+        self.packed_db_data = {}
+        self.logger.info('GT database has been saved to shared memory: %.1f MB in %d segments, %.1f MB not loaded'
+                         % (shared_bytes / 1024 ** 2, len(sa_keys), fallback_bytes / 1024 ** 2))
+        return sa_keys
+
+    def get_packed_db_data(self, db_data_idx=0):
+        # opened lazily so that every dataloader worker maps the packed database by itself
+        if db_data_idx not in self.packed_db_data:
+            db_data_path = self.root_path.resolve() / self.sampler_cfg.DB_DATA_PATH[db_data_idx]
+            self.packed_db_data[db_data_idx] = np.load(db_data_path, mmap_mode='r')
+        return self.packed_db_data[db_data_idx]
+
+    def load_db_points(self, info):
+        """
+        Args:
+            info: db_info of a single object
+        Returns:
+            obj_points: (N, NUM_POINT_FEATURES), a writable copy of the object points
+        """
+        sa_key = info.get('shared_memory_key', None) if self.use_shared_memory else None
+        if sa_key is not None:
+            if sa_key not in self.shared_memory_data:
+                try:
+                    gt_database_data = SharedArray.attach(f"shm://{sa_key}")
+                    gt_database_data.setflags(write=0)
+                except OSError:
+                    # deleted by another run which shared the segment, read the objects as without shared memory
+                    gt_database_data = None
+                self.shared_memory_data[sa_key] = gt_database_data
+            if self.shared_memory_data[sa_key] is not None:
+                start_offset, end_offset = info['segment_data_offset']
+                return np.array(self.shared_memory_data[sa_key][start_offset:end_offset])
+
+        if (self.use_shared_memory or self.use_packed_db) and 'global_data_offset' in info \
+                and len(self.sampler_cfg.get('DB_DATA_PATH', [])) > 0:
+            start_offset, end_offset = info['global_data_offset']
+            return np.array(self.get_packed_db_data(info.get('db_data_idx', 0))[start_offset:end_offset])
+
+        file_path = self.root_path / info['path']
+        return np.fromfile(str(file_path), dtype=np.float32).reshape(
+            [-1, self.sampler_cfg.NUM_POINT_FEATURES])
 
     def filter_by_difficulty(self, db_infos, removed_difficulty):
         new_db_infos = {}
@@ -167,53 +269,40 @@ class DataBaseSampler(object):
         image = data_dict['images']
         boxes3d = data_dict['gt_boxes']
         boxes2d = data_dict['gt_boxes2d']
-        corners_lidar = box_utils.boxes_to_corners_3d(boxes3d)
         img_aug_type = self.sampler_cfg.IMG_AUG_TYPE
         if 'depth' in img_aug_type:
             paste_order = boxes3d[:,0].argsort()
             paste_order = paste_order[::-1]
         else:
-            paste_order = np.arange(len(boxes3d),dtype=np.int)
+            paste_order = np.arange(len(boxes3d), dtype=np.int64)
 
         if 'reverse' in img_aug_type:
             paste_order = paste_order[::-1]
 
-        paste_mask = -255 * np.ones(image.shape[:2], dtype=np.int)
-        fg_mask = np.zeros(image.shape[:2], dtype=np.int)
-        overlap_mask = np.zeros(image.shape[:2], dtype=np.int)
-        depth_mask = np.zeros((*image.shape[:2], 2), dtype=np.float)
-        points_2d, depth_2d = data_dict['calib'].lidar_to_img(data_dict['points'][:,:3])
-        points_2d[:,0] = np.clip(points_2d[:,0], a_min=0, a_max=image.shape[1]-1)
-        points_2d[:,1] = np.clip(points_2d[:,1], a_min=0, a_max=image.shape[0]-1)
-        points_2d = points_2d.astype(np.int)
+        # index of the box visible at each pixel after pasting, every box only touches its own 2D box region
+        paste_mask = -255 * np.ones(image.shape[:2], dtype=np.int64)
         for _order in paste_order:
             _box2d = boxes2d[_order]
             image[_box2d[1]:_box2d[3],_box2d[0]:_box2d[2]] = crop_feat[_order]
-            overlap_mask[_box2d[1]:_box2d[3],_box2d[0]:_box2d[2]] += \
-                (paste_mask[_box2d[1]:_box2d[3],_box2d[0]:_box2d[2]] > 0).astype(np.int)
             paste_mask[_box2d[1]:_box2d[3],_box2d[0]:_box2d[2]] = _order
-
-            if 'cover' in self.aug_use_type:
-                # HxWx2 for min and max depth of each box region
-                depth_mask[_box2d[1]:_box2d[3],_box2d[0]:_box2d[2],0] = corners_lidar[_order,:,0].min()
-                depth_mask[_box2d[1]:_box2d[3],_box2d[0]:_box2d[2],1] = corners_lidar[_order,:,0].max()
-
-            # foreground area of original point cloud in image plane
-            if _order < gt_number:
-                fg_mask[_box2d[1]:_box2d[3],_box2d[0]:_box2d[2]] = 1
         
         data_dict['images'] = image
 
         if not self.joint_sample:
             return data_dict
-        
-        new_mask = paste_mask[points_2d[:,1], points_2d[:,0]]==(point_idxes+gt_number)
+
+        points_2d, depth_2d = data_dict['calib'].lidar_to_img(data_dict['points'][:,:3])
+        points_2d[:,0] = np.clip(points_2d[:,0], a_min=0, a_max=image.shape[1]-1)
+        points_2d[:,1] = np.clip(points_2d[:,1], a_min=0, a_max=image.shape[0]-1)
+        points_2d = points_2d.astype(np.int64)
+        points_paste_idx = paste_mask[points_2d[:,1], points_2d[:,0]]
+
+        new_mask = points_paste_idx == (point_idxes + gt_number)
         if self.keep_raw:
-            raw_mask = point_idxes==-1
+            raw_mask = point_idxes == -1
         else:
-            raw_fg = (fg_mask == 1) & (paste_mask >= 0) & (paste_mask < gt_number)
-            raw_bg = (fg_mask == 0) & (paste_mask < 0)
-            raw_mask = raw_fg[points_2d[:,1], points_2d[:,0]] | raw_bg[points_2d[:,1], points_2d[:,0]]
+            # raw points are kept where an original gt box or the background is visible
+            raw_mask = points_paste_idx < gt_number
         keep_mask = new_mask | raw_mask
         data_dict['points_2d'] = points_2d
 
@@ -221,18 +310,55 @@ class DataBaseSampler(object):
             data_dict['points'] = data_dict['points'][keep_mask]
             data_dict['points_2d'] = data_dict['points_2d'][keep_mask]
         elif 'projection' in self.aug_use_type:
-            overlap_mask[overlap_mask>=1] = 1
-            data_dict['overlap_mask'] = overlap_mask
+            data_dict['overlap_mask'] = self.get_paste_overlap_mask(boxes2d, paste_order, image.shape[:2])
             if 'cover' in self.aug_use_type:
+                # HxWx2 for min and max depth of the visible box
+                corners_lidar = box_utils.boxes_to_corners_3d(boxes3d)
+                box_depth = np.stack([corners_lidar[:,:,0].min(axis=1), corners_lidar[:,:,0].max(axis=1)], axis=-1)
+                box_depth = box_depth.astype(np.float64)
+                depth_mask = box_depth[np.clip(paste_mask, a_min=0, a_max=None)]
+                depth_mask[paste_mask < 0] = 0
                 data_dict['depth_mask'] = depth_mask
         
         return data_dict
 
+    @staticmethod
+    def get_paste_overlap_mask(boxes2d, paste_order, image_shape):
+        """
+        A pixel is marked once a box is pasted over an already pasted box with index > 0, which holds if the pixel
+        is covered by at least 3 boxes, or by 2 boxes where the first pasted one is not box 0
+        Args:
+            boxes2d: (N, 4) [x1, y1, x2, y2], int
+            paste_order: (N)
+            image_shape: (H, W)
+        Returns:
+            overlap_mask: (H, W), int
+        """
+        x1 = np.clip(boxes2d[:, 0], 0, image_shape[1])
+        y1 = np.clip(boxes2d[:, 1], 0, image_shape[0])
+        x2 = np.clip(boxes2d[:, 2], 0, image_shape[1])
+        y2 = np.clip(boxes2d[:, 3], 0, image_shape[0])
+        valid = (x2 > x1) & (y2 > y1)
+        cover_cnt = np.zeros((image_shape[0] + 1, image_shape[1] + 1), dtype=np.int64)
+        np.add.at(cover_cnt, (y1[valid], x1[valid]), 1)
+        np.add.at(cover_cnt, (y1[valid], x2[valid]), -1)
+        np.add.at(cover_cnt, (y2[valid], x1[valid]), -1)
+        np.add.at(cover_cnt, (y2[valid], x2[valid]), 1)
+        cover_cnt = cover_cnt.cumsum(axis=0).cumsum(axis=1)[:image_shape[0], :image_shape[1]]
+
+        first_paste_mask = -1 * np.ones(image_shape, dtype=np.int64)
+        for _order in paste_order[::-1]:
+            _box2d = boxes2d[_order]
+            first_paste_mask[_box2d[1]:_box2d[3],_box2d[0]:_box2d[2]] = _order
+
+        overlap_mask = (cover_cnt >= 3) | ((cover_cnt == 2) & (first_paste_mask != 0))
+        return overlap_mask.astype(np.int64)
+
     def add_sampled_boxes_to_scene(self, data_dict, sampled_gt_boxes, mv_height, sampled_gt_boxes2d, total_valid_sampled_dict):
         gt_boxes_mask = data_dict['gt_boxes_mask']
         gt_boxes = data_dict['gt_boxes'][gt_boxes_mask]
         gt_names = data_dict['gt_names'][gt_boxes_mask]
-        gt_number = gt_boxes_mask.sum().astype(np.int)
+        gt_number = gt_boxes_mask.sum().astype(np.int64)
         points = data_dict['points']
         if self.sampler_cfg.get('USE_ROAD_PLANE', False) and not self.aug_with_img:
             sampled_gt_boxes, mv_height = self.put_boxes_on_road_planes(
@@ -244,23 +370,11 @@ class DataBaseSampler(object):
         obj_points_list, obj_index_list, crop_boxes2d = [], [], []
         # convert sampled 3D boxes to image plane
         if self.aug_with_img:
-            gt_boxes2d = data_dict['gt_boxes2d'][gt_boxes_mask].astype(np.int)
+            gt_boxes2d = data_dict['gt_boxes2d'][gt_boxes_mask].astype(np.int64)
             gt_crops2d = [data_dict['images'][_x[1]:_x[3],_x[0]:_x[2]] for _x in gt_boxes2d]
-        if self.use_shared_memory:
-            gt_database_data = SharedArray.attach(f"shm://{self.gt_database_data_key}")
-            gt_database_data.setflags(write=0)
-        else:
-            gt_database_data = None 
 
         for idx, info in enumerate(total_valid_sampled_dict):
-            if self.use_shared_memory:
-                start_offset, end_offset = info['global_data_offset']
-                obj_points = copy.deepcopy(gt_database_data[start_offset:end_offset])
-            else:
-                file_path = self.root_path / info['path']
-
-                obj_points = np.fromfile(str(file_path), dtype=np.float32).reshape(
-                    [-1, self.sampler_cfg.NUM_POINT_FEATURES])
+            obj_points = self.load_db_points(info)
 
             obj_points[:, :3] += info['box3d_lidar'][:3]
 
@@ -291,7 +405,7 @@ class DataBaseSampler(object):
                 sampled_gt_boxes2d[idx] = box2d[0]
 
 
-            obj_idx = idx * np.ones(len(obj_points), dtype=np.int)
+            obj_idx = idx * np.ones(len(obj_points), dtype=np.int64)
             obj_points_list.append(obj_points)
             obj_index_list.append(obj_idx)
 
@@ -299,19 +413,21 @@ class DataBaseSampler(object):
             if self.aug_with_img:
                 img_path = self.root_path / self.sampler_cfg.IMG_ROOT_PATH / (info['image_idx']+'.png')
                 raw_image = io.imread(img_path)
-                raw_image = raw_image.astype(np.float32)
                 raw_center = info['bbox'].reshape(2,2).mean(0)
-                new_box = sampled_gt_boxes2d[idx].astype(np.int)
+                new_box = sampled_gt_boxes2d[idx].astype(np.int64)
                 new_shape = np.array([new_box[2]-new_box[0], new_box[3]-new_box[1]])
-                raw_box = np.concatenate([raw_center-new_shape/2, raw_center+new_shape/2]).astype(np.int)
+                raw_box = np.concatenate([raw_center-new_shape/2, raw_center+new_shape/2]).astype(np.int64)
                 raw_box[0::2] = np.clip(raw_box[0::2], a_min=0, a_max=raw_image.shape[1])
                 raw_box[1::2] = np.clip(raw_box[1::2], a_min=0, a_max=raw_image.shape[0])
                 if (raw_box[2]-raw_box[0])!=new_shape[0] or (raw_box[3]-raw_box[1])!=new_shape[1]:
                     new_center = new_box.reshape(2,2).mean(0)
                     new_shape = np.array([raw_box[2]-raw_box[0], raw_box[3]-raw_box[1]])
-                    new_box = np.concatenate([new_center-new_shape/2, new_center+new_shape/2]).astype(np.int)
+                    new_box = np.concatenate([new_center-new_shape/2, new_center+new_shape/2]).astype(np.int64)
 
-                img_crop2d = raw_image[raw_box[1]:raw_box[3],raw_box[0]:raw_box[2]] / 255
+                img_crop2d = raw_image[raw_box[1]:raw_box[3],raw_box[0]:raw_box[2]]
+                if data_dict['images'].dtype != np.uint8:
+                    # only the crop is converted, the images are uint8 for DEFER_IMAGE_NORMALIZATION
+                    img_crop2d = img_crop2d.astype(np.float32) / 255
 
                 crop_boxes2d.append(new_box)
                 gt_crops2d.append(img_crop2d) 
@@ -325,7 +441,7 @@ class DataBaseSampler(object):
             sampled_gt_boxes[:, 0:7], extra_width=self.sampler_cfg.REMOVE_EXTRA_WIDTH
         )
         points = box_utils.remove_points_in_boxes3d(points, large_sampled_gt_boxes)
-        point_idxes = -1 * np.ones(len(points), dtype=np.int)
+        point_idxes = -1 * np.ones(len(points), dtype=np.int64)
         points = np.concatenate([points, obj_points], axis=0)
         point_idxes = np.concatenate([point_idxes, obj_points_idx], axis=0)
         gt_names = np.concatenate([gt_names, sampled_gt_names], axis=0)
@@ -10,6 +10,11 @@ from .processor.data_processor import DataProcessor
 from .processor.point_feature_encoder import PointFeatureEncoder
 import copy
 
+
+class EmptySampleError(Exception):
+    pass
+
+
 class DatasetTemplate(torch_data.Dataset):
     def __init__(self, dataset_cfg=None, class_names=None, training=True, root_path=None, logger=None):
         super().__init__()
@@ -40,6 +45,11 @@ class DatasetTemplate(torch_data.Dataset):
         self.total_epochs = 0
         self._merge_all_iters_to_one_epoch = False
 
+        # skip the defensive copies of infos and raw points which no model consumes
+        self.lean_data_preparation = self.dataset_cfg.get('LEAN_DATA_PREPARATION', False)
+        self.max_resample_times = self.dataset_cfg.get('MAX_RESAMPLE_TIMES', 100)
+        self._resampling = False
+
         if hasattr(self.data_processor, "depth_downsample_factor"):
             self.depth_downsample_factor = self.data_processor.depth_downsample_factor
         else:
@@ -125,8 +135,9 @@ class DatasetTemplate(torch_data.Dataset):
             gt_boxes_mask = np.array([n in self.class_names for n in data_dict['gt_names']], dtype=np.bool_)
 
             calib = data_dict['calib']
-            points_before_aug = copy.deepcopy(data_dict['points'])
-            data_dict['points_before_aug'] = points_before_aug
+            if not self.lean_data_preparation:
+                # the augmentors modify the points in place
+                data_dict['points_before_aug'] = copy.deepcopy(data_dict['points'])
             data_dict = self.data_augmentor.forward(
                 data_dict={
                     **data_dict,
@@ -134,8 +145,6 @@ class DatasetTemplate(torch_data.Dataset):
                 }
             )
             data_dict['calib'] = calib
-            points_after_aug = copy.deepcopy(data_dict['points'])
-            points_before_aug = data_dict['points_before_aug']
         if data_dict.get('gt_boxes', None) is not None:
             selected = common_utils.keep_arrays_by_name(data_dict['gt_names'], self.class_names)
             data_dict['gt_boxes'] = data_dict['gt_boxes'][selected]
@@ -155,13 +164,32 @@ class DatasetTemplate(torch_data.Dataset):
         )
 
         if self.training and len(data_dict['gt_boxes']) == 0:
-            new_index = np.random.randint(self.__len__())
-            return self.__getitem__(new_index)
+            return self.resample_data()
 
         data_dict.pop('gt_names', None)
 
         return data_dict
 
+    def resample_data(self):
+        """
+        Replaces a training sample without gt boxes by a random one. The nested __getitem__ calls stop at the first
+        level by raising EmptySampleError, so the resampling is a bounded loop instead of a recursion.
+        """
+        if self._resampling:
+            raise EmptySampleError
+
+        self._resampling = True
+        try:
+            for _ in range(self.max_resample_times):
+                new_index = np.random.randint(self.__len__())
+                try:
+                    return self.__getitem__(new_index)
+                except EmptySampleError:
+                    continue
+        finally:
+            self._resampling = False
+        raise RuntimeError('No sample with gt boxes is found after %d resampling' % self.max_resample_times)
+
     @staticmethod
     def collate_batch(batch_list, _unused=False):
         data_dict = defaultdict(list)
@@ -1,5 +1,8 @@
 import copy
+import hashlib
 import pickle
+import struct
+from pathlib import Path
 
 import numpy as np
 from skimage import io
@@ -7,6 +10,7 @@ from skimage import io
 from . import kitti_utils
 from ...ops.roiaware_pool3d import roiaware_pool3d_utils
 from ...utils import box_utils, calibration_kitti, common_utils, object3d_kitti
+from ...utils.shared_memory_utils import SharedPointCache
 from ..dataset import DatasetTemplate
 
 
@@ -32,6 +36,21 @@ class KittiDataset(DatasetTemplate):
         self.kitti_infos = []
         self.include_kitti_data(self.mode)
 
+        # images are returned as uint8 and converted to float on the gpu by load_data_to_gpu
+        self.defer_image_normalization = self.dataset_cfg.get('DEFER_IMAGE_NORMALIZATION', False)
+        # the decoded images are the only data of the dataset kept in shared memory
+        self.use_shared_memory = self.dataset_cfg.get('USE_IMAGE_CACHE', False) and self.training
+        self.image_cache = None
+        if self.use_shared_memory:
+            self.image_cache = SharedPointCache(
+                prefix='pcdet_kitti_img_%s' % hashlib.md5(str(self.root_path.resolve()).encode()).hexdigest()[:8],
+                max_bytes=self.dataset_cfg.get('IMAGE_CACHE_SIZE_GB', 4) * 1024 ** 3, logger=self.logger
+            )
+
+    def clean_shared_memory(self):
+        self.image_cache.clean()
+        self.logger.info('Training images have been deleted from shared memory')
+
     def include_kitti_data(self, mode):
         if self.logger is not None:
             self.logger.info('Loading KITTI dataset')
@@ -71,11 +90,17 @@ class KittiDataset(DatasetTemplate):
         Args:
             idx: int, Sample index
         Returns:
-            image: (H, W, 3), RGB Image
+            image: (H, W, 3), RGB Image, float32 in [0, 1] or uint8 for DEFER_IMAGE_NORMALIZATION
         """
         img_file = self.root_split_path / 'image_2' / ('%s.png' % idx)
         assert img_file.exists()
-        image = io.imread(img_file)
+        if self.image_cache is not None:
+            # the cached image is read only, the augmentations modify it in place
+            image = np.array(self.image_cache.get(str(img_file), io.imread))
+        else:
+            image = io.imread(img_file)
+        if self.defer_image_normalization:
+            return image
         image = image.astype(np.float32)
         image /= 255.0
         return image
@@ -83,6 +108,12 @@ class KittiDataset(DatasetTemplate):
     def get_image_shape(self, idx):
         img_file = self.root_split_path / 'image_2' / ('%s.png' % idx)
         assert img_file.exists()
+        with open(img_file, 'rb') as f:
+            header = f.read(24)
+        if header[:8] == b'\x89PNG\r\n\x1a\n':
+            # width and height of the IHDR chunk, no need to decode the image
+            width, height = struct.unpack('>II', header[16:24])
+            return np.array([height, width], dtype=np.int32)
         return np.array(io.imread(img_file).shape[:2], dtype=np.int32)
 
     def get_label(self, idx):
@@ -147,96 +178,208 @@ class KittiDataset(DatasetTemplate):
 
         return pts_valid_flag
 
-    def get_infos(self, num_workers=4, has_label=True, count_inside_pts=True, sample_id_list=None):
-        import concurrent.futures as futures
-
-        def process_single_scene(sample_idx):
-            print('%s sample_idx: %s' % (self.split, sample_idx))
-            info = {}
-            pc_info = {'num_features': 4, 'lidar_idx': sample_idx}
-            info['point_cloud'] = pc_info
-
-            image_info = {'image_idx': sample_idx, 'image_shape': self.get_image_shape(sample_idx)}
-            info['image'] = image_info
-            calib = self.get_calib(sample_idx)
-
-            P2 = np.concatenate([calib.P2, np.array([[0., 0., 0., 1.]])], axis=0)
-            R0_4x4 = np.zeros([4, 4], dtype=calib.R0.dtype)
-            R0_4x4[3, 3] = 1.
-            R0_4x4[:3, :3] = calib.R0
-            V2C_4x4 = np.concatenate([calib.V2C, np.array([[0., 0., 0., 1.]])], axis=0)
-            calib_info = {'P2': P2, 'R0_rect': R0_4x4, 'Tr_velo_to_cam': V2C_4x4}
-
-            info['calib'] = calib_info
-
-            if has_label:
-                obj_list = self.get_label(sample_idx)
-                annotations = {}
-                annotations['name'] = np.array([obj.cls_type for obj in obj_list])
-                annotations['truncated'] = np.array([obj.truncation for obj in obj_list])
-                annotations['occluded'] = np.array([obj.occlusion for obj in obj_list])
-                annotations['alpha'] = np.array([obj.alpha for obj in obj_list])
-                annotations['bbox'] = np.concatenate([obj.box2d.reshape(1, 4) for obj in obj_list], axis=0)
-                annotations['dimensions'] = np.array([[obj.l, obj.h, obj.w] for obj in obj_list])  # lhw(camera) format
-                annotations['location'] = np.concatenate([obj.loc.reshape(1, 3) for obj in obj_list], axis=0)
-                annotations['rotation_y'] = np.array([obj.ry for obj in obj_list])
-                annotations['score'] = np.array([obj.score for obj in obj_list])
-                annotations['difficulty'] = np.array([obj.level for obj in obj_list], np.int32)
-
-                num_objects = len([obj.cls_type for obj in obj_list if obj.cls_type != 'DontCare'])
-                num_gt = len(annotations['name'])
-                index = list(range(num_objects)) + [-1] * (num_gt - num_objects)
-                annotations['index'] = np.array(index, dtype=np.int32)
-
-                loc = annotations['location'][:num_objects]
-                dims = annotations['dimensions'][:num_objects]
-                rots = annotations['rotation_y'][:num_objects]
-                loc_lidar = calib.rect_to_lidar(loc)
-                l, h, w = dims[:, 0:1], dims[:, 1:2], dims[:, 2:3]
-                loc_lidar[:, 2] += h[:, 0] / 2
-                gt_boxes_lidar = np.concatenate([loc_lidar, l, w, h, -(np.pi / 2 + rots[..., np.newaxis])], axis=1)
-                annotations['gt_boxes_lidar'] = gt_boxes_lidar
-
-                info['annos'] = annotations
-
-                if count_inside_pts:
-                    points = self.get_lidar(sample_idx)
-                    calib = self.get_calib(sample_idx)
-                    pts_rect = calib.lidar_to_rect(points[:, 0:3])
-
-                    fov_flag = self.get_fov_flag(pts_rect, info['image']['image_shape'], calib)
-                    pts_fov = points[fov_flag]
-                    corners_lidar = box_utils.boxes_to_corners_3d(gt_boxes_lidar)
-                    num_points_in_gt = -np.ones(num_gt, dtype=np.int32)
-
-                    for k in range(num_objects):
-                        flag = box_utils.in_hull(pts_fov[:, 0:3], corners_lidar[k])
-                        num_points_in_gt[k] = flag.sum()
-                    annotations['num_points_in_gt'] = num_points_in_gt
-
-            return info
+    def get_file_stamps(self, idx, has_label=True):
+        """
+        (size, mtime) of the files an info is generated from, used to skip unchanged frames in get_infos
+        """
+        files = [
+            self.root_split_path / 'velodyne' / ('%s.bin' % idx),
+            self.root_split_path / 'image_2' / ('%s.png' % idx),
+            self.root_split_path / 'calib' / ('%s.txt' % idx),
+        ]
+        if has_label:
+            files.append(self.root_split_path / 'label_2' / ('%s.txt' % idx))
+
+        stamps = {}
+        for file in files:
+            stat = file.stat()
+            stamps[file.parent.name] = (stat.st_size, stat.st_mtime_ns)
+        return stamps
+
+    def get_infos(self, num_workers=4, has_label=True, count_inside_pts=True, sample_id_list=None, prev_infos=None):
+        """
+        Args:
+            num_workers: the frames are processed by a pool of num_workers processes (in process for <= 1)
+            has_label:
+            count_inside_pts:
+            sample_id_list:
+            prev_infos: infos of a previous run, frames whose files are unchanged are reused
+                instead of being generated again
+
+        Returns:
+
+        """
+        import multiprocessing
+        from functools import partial
 
         sample_id_list = sample_id_list if sample_id_list is not None else self.sample_id_list
-        with futures.ThreadPoolExecutor(num_workers) as executor:
-            infos = executor.map(process_single_scene, sample_id_list)
-        return list(infos)
 
-    def create_groundtruth_database(self, info_path=None, used_classes=None, split='train'):
-        import torch
+        reused_infos = {}
+        if prev_infos is not None:
+            for info in prev_infos:
+                if 'file_stamps' not in info or (has_label and 'annos' not in info) or \
+                        (count_inside_pts and 'num_points_in_gt' not in info.get('annos', {})):
+                    continue
+                reused_infos[info['point_cloud']['lidar_idx']] = info
+
+        infos = {}
+        for sample_idx in sample_id_list:
+            info = reused_infos.get(sample_idx, None)
+            if info is not None and info['file_stamps'] == self.get_file_stamps(sample_idx, has_label):
+                infos[sample_idx] = info
+        todo_list = [sample_idx for sample_idx in sample_id_list if sample_idx not in infos]
+        if prev_infos is not None:
+            print('%s infos: %d reused, %d to generate' % (self.split, len(infos), len(todo_list)))
+
+        process_single_scene = partial(
+            self.process_single_scene, has_label=has_label, count_inside_pts=count_inside_pts
+        )
+        if num_workers > 1 and len(todo_list) > 1:
+            with multiprocessing.Pool(num_workers) as p:
+                new_infos = list(p.imap(process_single_scene, todo_list, chunksize=8))
+        else:
+            new_infos = [process_single_scene(sample_idx) for sample_idx in todo_list]
+
+        infos.update(zip(todo_list, new_infos))
+        return [infos[sample_idx] for sample_idx in sample_id_list]
+
+    def process_single_scene(self, sample_idx, has_label=True, count_inside_pts=True):
+        print('%s sample_idx: %s' % (self.split, sample_idx))
+        info = {}
+        pc_info = {'num_features': 4, 'lidar_idx': sample_idx}
+        info['point_cloud'] = pc_info
+        info['file_stamps'] = self.get_file_stamps(sample_idx, has_label)
+
+        image_info = {'image_idx': sample_idx, 'image_shape': self.get_image_shape(sample_idx)}
+        info['image'] = image_info
+        calib = self.get_calib(sample_idx)
+
+        P2 = np.concatenate([calib.P2, np.array([[0., 0., 0., 1.]])], axis=0)
+        R0_4x4 = np.zeros([4, 4], dtype=calib.R0.dtype)
+        R0_4x4[3, 3] = 1.
+        R0_4x4[:3, :3] = calib.R0
+        V2C_4x4 = np.concatenate([calib.V2C, np.array([[0., 0., 0., 1.]])], axis=0)
+        calib_info = {'P2': P2, 'R0_rect': R0_4x4, 'Tr_velo_to_cam': V2C_4x4}
+
+        info['calib'] = calib_info
+
+        if has_label:
+            obj_list = self.get_label(sample_idx)
+            annotations = {}
+            annotations['name'] = np.array([obj.cls_type for obj in obj_list])
+            annotations['truncated'] = np.array([obj.truncation for obj in obj_list])
+            annotations['occluded'] = np.array([obj.occlusion for obj in obj_list])
+            annotations['alpha'] = np.array([obj.alpha for obj in obj_list])
+            annotations['bbox'] = np.concatenate([obj.box2d.reshape(1, 4) for obj in obj_list], axis=0)
+            annotations['dimensions'] = np.array([[obj.l, obj.h, obj.w] for obj in obj_list])  # lhw(camera) format
+            annotations['location'] = np.concatenate([obj.loc.reshape(1, 3) for obj in obj_list], axis=0)
+            annotations['rotation_y'] = np.array([obj.ry for obj in obj_list])
+            annotations['score'] = np.array([obj.score for obj in obj_list])
+            annotations['difficulty'] = np.array([obj.level for obj in obj_list], np.int32)
+
+            num_objects = len([obj.cls_type for obj in obj_list if obj.cls_type != 'DontCare'])
+            num_gt = len(annotations['name'])
+            index = list(range(num_objects)) + [-1] * (num_gt - num_objects)
+            annotations['index'] = np.array(index, dtype=np.int32)
+
+            loc = annotations['location'][:num_objects]
+            dims = annotations['dimensions'][:num_objects]
+            rots = annotations['rotation_y'][:num_objects]
+            loc_lidar = calib.rect_to_lidar(loc)
+            l, h, w = dims[:, 0:1], dims[:, 1:2], dims[:, 2:3]
+            loc_lidar[:, 2] += h[:, 0] / 2
+            gt_boxes_lidar = np.concatenate([loc_lidar, l, w, h, -(np.pi / 2 + rots[..., np.newaxis])], axis=1)
+            annotations['gt_boxes_lidar'] = gt_boxes_lidar
+
+            info['annos'] = annotations
+
+            if count_inside_pts:
+                points = self.get_lidar(sample_idx)
+                pts_rect = calib.lidar_to_rect(points[:, 0:3])
+
+                fov_flag = self.get_fov_flag(pts_rect, info['image']['image_shape'], calib)
+                pts_fov = points[fov_flag]
+                num_points_in_gt = -np.ones(num_gt, dtype=np.int32)
+                num_points_in_gt[:num_objects] = box_utils.points_in_boxes_count(pts_fov[:, 0:3], gt_boxes_lidar)
+                annotations['num_points_in_gt'] = num_points_in_gt
+
+        return info
+
+    def create_groundtruth_database(self, info_path=None, used_classes=None, split='train',
+                                    num_workers=1, save_packed=False):
+        """
+        Args:
+            info_path:
+            used_classes:
+            split:
+            num_workers: frames are sharded over this many processes
+            save_packed: write all objects into a single offset-indexed kitti_gt_database_xxx_global.npy
+                instead of one .bin file per object, see USE_PACKED_DB in DataBaseSampler
+        """
+        import multiprocessing
+        from functools import partial
 
         database_save_path = Path(self.root_path) / ('gt_database' if split == 'train' else ('gt_database_%s' % split))
         db_info_save_path = Path(self.root_path) / ('kitti_dbinfos_%s.pkl' % split)
+        db_data_save_path = Path(self.root_path) / ('kitti_gt_database_%s_global.npy' % split)
 
-        database_save_path.mkdir(parents=True, exist_ok=True)
+        if not save_packed:
+            database_save_path.mkdir(parents=True, exist_ok=True)
         all_db_infos = {}
 
         with open(info_path, 'rb') as f:
             infos = pickle.load(f)
 
+        process_shard = partial(
+            self.process_groundtruth_database_shard, database_save_path=database_save_path,
+            used_classes=used_classes, save_packed=save_packed
+        )
+        # contiguous shards merged in order, so the database keeps the order of the serial creation
+        shard_bounds = np.array_split(np.arange(len(infos)), num_workers * 4)
+        shard_infos = [infos[bounds[0]:bounds[-1] + 1] for bounds in shard_bounds if len(bounds) > 0]
+        if num_workers > 1:
+            with multiprocessing.Pool(num_workers) as p:
+                shard_results = list(p.imap(process_shard, shard_infos))
+        else:
+            shard_results = [process_shard(infos)]
+
+        point_offset_cnt = 0
+        stacked_gt_points = []
+        for shard_db_infos, shard_gt_points in shard_results:
+            for db_info, gt_points in zip(shard_db_infos, shard_gt_points):
+                if save_packed:
+                    stacked_gt_points.append(gt_points)
+                    db_info['global_data_offset'] = [point_offset_cnt, point_offset_cnt + gt_points.shape[0]]
+                    point_offset_cnt += gt_points.shape[0]
+
+                if db_info['name'] in all_db_infos:
+                    all_db_infos[db_info['name']].append(db_info)
+                else:
+                    all_db_infos[db_info['name']] = [db_info]
+        for k, v in all_db_infos.items():
+            print('Database %s: %d' % (k, len(v)))
+
+        with open(db_info_save_path, 'wb') as f:
+            pickle.dump(all_db_infos, f)
+
+        if save_packed:
+            stacked_gt_points = np.concatenate(stacked_gt_points, axis=0) if len(stacked_gt_points) > 0 \
+                else np.zeros((0, 4), dtype=np.float32)
+            np.save(db_data_save_path, stacked_gt_points)
+            print('Packed gt database is saved to %s' % db_data_save_path)
+
+    def process_groundtruth_database_shard(self, infos, database_save_path, used_classes=None, save_packed=False):
+        """
+        Crops the gt points of a list of frames, returns the db_infos of the used objects and their points
+        (only kept in memory for save_packed, otherwise every object is written to its own .bin file)
+        """
+        import torch
+
+        db_infos, gt_points_list = [], []
         for k in range(len(infos)):
-            print('gt_database sample: %d/%d' % (k + 1, len(infos)))
             info = infos[k]
             sample_idx = info['point_cloud']['lidar_idx']
+            print('gt_database sample: %s' % sample_idx)
             points = self.get_lidar(sample_idx)
             annos = info['annos']
             names = annos['name']
@@ -255,23 +398,18 @@ class KittiDataset(DatasetTemplate):
                 gt_points = points[point_indices[i] > 0]
 
                 gt_points[:, :3] -= gt_boxes[i, :3]
-                with open(filepath, 'w') as f:
-                    gt_points.tofile(f)
+                if not save_packed:
+                    with open(filepath, 'w') as f:
+                        gt_points.tofile(f)
 
                 if (used_classes is None) or names[i] in used_classes:
                     db_path = str(filepath.relative_to(self.root_path))  # gt_database/xxxxx.bin
                     db_info = {'name': names[i], 'path': db_path, 'image_idx': sample_idx, 'gt_idx': i,
                                'box3d_lidar': gt_boxes[i], 'num_points_in_gt': gt_points.shape[0],
                                'difficulty': difficulty[i], 'bbox': bbox[i], 'score': annos['score'][i]}
-                    if names[i] in all_db_infos:
-                        all_db_infos[names[i]].append(db_info)
-                    else:
-                        all_db_infos[names[i]] = [db_info]
-        for k, v in all_db_infos.items():
-            print('Database %s: %d' % (k, len(v)))
-
-        with open(db_info_save_path, 'wb') as f:
-            pickle.dump(all_db_infos, f)
+                    db_infos.append(db_info)
+                    gt_points_list.append(gt_points if save_packed else None)
+        return db_infos, gt_points_list
 
     @staticmethod
     def generate_prediction_dicts(batch_dict, pred_dicts, class_names, output_path=None):
@@ -373,7 +511,8 @@ class KittiDataset(DatasetTemplate):
         if self._merge_all_iters_to_one_epoch:
             index = index % len(self.kitti_infos)
 
-        info = copy.deepcopy(self.kitti_infos[index])
+        # the info is only read below, lean mode skips copying it
+        info = self.kitti_infos[index] if self.lean_data_preparation else copy.deepcopy(self.kitti_infos[index])
 
         sample_idx = info['point_cloud']['lidar_idx']
         img_shape = info['image']['image_shape']
@@ -438,7 +577,12 @@ class KittiDataset(DatasetTemplate):
         return data_dict
 
 
-def create_kitti_infos(dataset_cfg, class_names, data_path, save_path, workers=4):
+def create_kitti_infos(dataset_cfg, class_names, data_path, save_path, workers=4, packed_gt_database=False,
+                       incremental=False):
+    """
+    Args:
+        incremental: reuse the infos of the existing info files for the frames whose files did not change
+    """
     dataset = KittiDataset(dataset_cfg=dataset_cfg, class_names=class_names, root_path=data_path, training=False)
     train_split, val_split = 'train', 'val'
 
@@ -447,16 +591,26 @@ def create_kitti_infos(dataset_cfg, class_names, data_path, save_path, workers=4
     trainval_filename = save_path / 'kitti_infos_trainval.pkl'
     test_filename = save_path / 'kitti_infos_test.pkl'
 
+    def load_prev_infos(filename):
+        if not incremental or not filename.exists():
+            return None
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
     print('---------------Start to generate data infos---------------')
 
     dataset.set_split(train_split)
-    kitti_infos_train = dataset.get_infos(num_workers=workers, has_label=True, count_inside_pts=True)
+    kitti_infos_train = dataset.get_infos(
+        num_workers=workers, has_label=True, count_inside_pts=True, prev_infos=load_prev_infos(train_filename)
+    )
     with open(train_filename, 'wb') as f:
         pickle.dump(kitti_infos_train, f)
     print('Kitti info train file is saved to %s' % train_filename)
 
     dataset.set_split(val_split)
-    kitti_infos_val = dataset.get_infos(num_workers=workers, has_label=True, count_inside_pts=True)
+    kitti_infos_val = dataset.get_infos(
+        num_workers=workers, has_label=True, count_inside_pts=True, prev_infos=load_prev_infos(val_filename)
+    )
     with open(val_filename, 'wb') as f:
         pickle.dump(kitti_infos_val, f)
     print('Kitti info val file is saved to %s' % val_filename)
@@ -466,14 +620,18 @@ def create_kitti_infos(dataset_cfg, class_names, data_path, save_path, workers=4
     print('Kitti info trainval file is saved to %s' % trainval_filename)
 
     dataset.set_split('test')
-    kitti_infos_test = dataset.get_infos(num_workers=workers, has_label=False, count_inside_pts=False)
+    kitti_infos_test = dataset.get_infos(
+        num_workers=workers, has_label=False, count_inside_pts=False, prev_infos=load_prev_infos(test_filename)
+    )
     with open(test_filename, 'wb') as f:
         pickle.dump(kitti_infos_test, f)
     print('Kitti info test file is saved to %s' % test_filename)
 
     print('---------------Start create groundtruth database for data augmentation---------------')
     dataset.set_split(train_split)
-    dataset.create_groundtruth_database(train_filename, split=train_split)
+    dataset.create_groundtruth_database(
+        train_filename, split=train_split, num_workers=workers, save_packed=packed_gt_database
+    )
 
     print('---------------Data preparation Done---------------')
 
@@ -490,5 +648,7 @@ if __name__ == '__main__':
             dataset_cfg=dataset_cfg,
             class_names=['Car', 'Pedestrian', 'Cyclist'],
             data_path=ROOT_DIR / 'data' / 'kitti',
-            save_path=ROOT_DIR / 'data' / 'kitti'
+            save_path=ROOT_DIR / 'data' / 'kitti',
+            packed_gt_database='packed' in sys.argv[3:],
+            incremental='incremental' in sys.argv[3:]
         )
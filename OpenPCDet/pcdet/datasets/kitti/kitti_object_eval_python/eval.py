@@ -2,8 +2,20 @@ import io as sysio
 
 import numba
 import numpy as np
+from numba import cuda
 
-from .rotate_iou import rotate_iou_gpu_eval
+from .rotate_iou_cpu import rotate_iou_cpu_eval
+try:
+    from .rotate_iou import rotate_iou_gpu_eval
+except ImportError:
+    rotate_iou_gpu_eval = None
+
+
+def rotate_iou_eval(boxes, query_boxes, criterion=-1):
+    # fall back to the multi-threaded cpu kernel when there is no cuda device
+    if rotate_iou_gpu_eval is not None and cuda.is_available():
+        return rotate_iou_gpu_eval(boxes, query_boxes, criterion)
+    return rotate_iou_cpu_eval(boxes, query_boxes, criterion)
 
 
 @numba.jit
@@ -114,7 +126,7 @@ def image_box_overlap(boxes, query_boxes, criterion=-1):
 
 
 def bev_box_overlap(boxes, qboxes, criterion=-1):
-    riou = rotate_iou_gpu_eval(boxes, qboxes, criterion)
+    riou = rotate_iou_eval(boxes, qboxes, criterion)
     return riou
 
 
@@ -122,7 +134,7 @@ def bev_box_overlap(boxes, qboxes, criterion=-1):
 def d3_box_overlap_kernel(boxes, qboxes, rinc, criterion=-1):
     # ONLY support overlap in CAMERA, not lider.
     N, K = boxes.shape[0], qboxes.shape[0]
-    for i in range(N):
+    for i in numba.prange(N):
         for j in range(K):
             if rinc[i, j] > 0:
                 # iw = (min(boxes[i, 1] + boxes[i, 4], qboxes[j, 1] +
@@ -148,8 +160,8 @@ def d3_box_overlap_kernel(boxes, qboxes, rinc, criterion=-1):
 
 
 def d3_box_overlap(boxes, qboxes, criterion=-1):
-    rinc = rotate_iou_gpu_eval(boxes[:, [0, 2, 3, 5, 6]],
-                               qboxes[:, [0, 2, 3, 5, 6]], 2)
+    rinc = rotate_iou_eval(boxes[:, [0, 2, 3, 5, 6]],
+                           qboxes[:, [0, 2, 3, 5, 6]], 2)
     d3_box_overlap_kernel(boxes, qboxes, rinc, criterion)
     return rinc
 
@@ -287,7 +299,7 @@ def get_split_parts(num, num_part):
         return [same_part] * num_part + [remain_num]
 
 
-@numba.jit(nopython=True)
+@numba.jit(nopython=True, parallel=True)
 def fused_compute_statistics(overlaps,
                              pr,
                              gt_nums,
@@ -302,11 +314,19 @@ def fused_compute_statistics(overlaps,
                              min_overlap,
                              thresholds,
                              compute_aos=False):
-    gt_num = 0
-    dt_num = 0
-    dc_num = 0
-    for i in range(gt_nums.shape[0]):
-        for t, thresh in enumerate(thresholds):
+    num_examples = gt_nums.shape[0]
+    gt_starts = np.zeros((num_examples + 1, ), dtype=np.int64)
+    dt_starts = np.zeros((num_examples + 1, ), dtype=np.int64)
+    dc_starts = np.zeros((num_examples + 1, ), dtype=np.int64)
+    gt_starts[1:] = np.cumsum(gt_nums)
+    dt_starts[1:] = np.cumsum(dt_nums)
+    dc_starts[1:] = np.cumsum(dc_nums)
+    # every threshold only accumulates into its own row of pr, so the
+    # thresholds can be evaluated on all cores without synchronization
+    for t in numba.prange(thresholds.shape[0]):
+        thresh = thresholds[t]
+        for i in range(num_examples):
+            gt_num, dt_num, dc_num = gt_starts[i], dt_starts[i], dc_starts[i]
             overlap = overlaps[dt_num:dt_num + dt_nums[i], gt_num:
                                gt_num + gt_nums[i]]
 
@@ -332,9 +352,6 @@ def fused_compute_statistics(overlaps,
             pr[t, 2] += fn
             if similarity != -1:
                 pr[t, 3] += similarity
-        gt_num += gt_nums[i]
-        dt_num += dt_nums[i]
-        dc_num += dc_nums[i]
 
 
 def calculate_iou_partly(gt_annos, dt_annos, metric, num_parts=50):
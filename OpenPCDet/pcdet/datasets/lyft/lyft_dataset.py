@@ -1,4 +1,5 @@
 import copy
+import hashlib
 import pickle
 from pathlib import Path
 
@@ -7,6 +8,7 @@ from tqdm import tqdm
 
 from ...ops.roiaware_pool3d import roiaware_pool3d_utils
 from ...utils import common_utils, box_utils
+from ...utils.shared_memory_utils import SharedPointCache
 from ..dataset import DatasetTemplate
 
 
@@ -19,6 +21,11 @@ class LyftDataset(DatasetTemplate):
         self.infos = []
         self.include_lyft_data(self.mode)
 
+        self.use_shared_memory = self.dataset_cfg.get('USE_SHARED_MEMORY', False) and self.training
+        self.point_cache = None
+        if self.use_shared_memory:
+            self.init_point_cache()
+
     def include_lyft_data(self, mode):
         self.logger.info('Loading lyft dataset')
         lyft_infos = []
@@ -34,17 +41,48 @@ class LyftDataset(DatasetTemplate):
         self.infos.extend(lyft_infos)
         self.logger.info('Total samples for lyft dataset: %d' % (len(lyft_infos)))
 
+    def init_point_cache(self):
+        """
+        Keyframes and sweeps are cached in shared memory (see SharedPointCache), the cache of a dataset root is
+        shared by all the jobs of a node
+        """
+        self.point_cache = SharedPointCache(
+            prefix='pcdet_lyft_%s' % hashlib.md5(str(self.root_path.resolve()).encode()).hexdigest()[:8],
+            max_bytes=self.dataset_cfg.get('SHARED_MEMORY_SIZE_GB', 16) * 1024 ** 3, logger=self.logger
+        )
+        if self.dataset_cfg.get('SHARED_MEMORY_EAGER', False):
+            lidar_paths = list(dict.fromkeys([info['lidar_path'] for info in self.infos]))
+            sweep_paths = list(dict.fromkeys([
+                sweep['lidar_path'] for info in self.infos for sweep in info['sweeps']
+            ]))
+            self.point_cache.fill(lidar_paths + sweep_paths, self.read_point_file)
+
+    def clean_shared_memory(self):
+        self.point_cache.clean()
+        self.logger.info('Training data has been deleted from shared memory')
+
+    def read_point_file(self, lidar_path):
+        points = np.fromfile(str(self.root_path / lidar_path), dtype=np.float32, count=-1)
+        if points.shape[0] % 5 != 0:
+            points = points[: points.shape[0] - (points.shape[0] % 5)]
+        return points.reshape([-1, 5])
+
+    def get_point_file(self, lidar_path):
+        """
+        Returns:
+            points: (N, 5), read only if it comes from the shared memory cache
+        """
+        if self.point_cache is not None:
+            return self.point_cache.get(lidar_path, self.read_point_file)
+        return self.read_point_file(lidar_path)
+
     @staticmethod
     def remove_ego_points(points, center_radius=1.0):
         mask = ~((np.abs(points[:, 0]) < center_radius*1.5) & (np.abs(points[:, 1]) < center_radius))
         return points[mask]
 
     def get_sweep(self, sweep_info):
-        lidar_path = self.root_path / sweep_info['lidar_path']
-        points_sweep = np.fromfile(str(lidar_path), dtype=np.float32, count=-1)
-        if points_sweep.shape[0] % 5 != 0:
-            points_sweep = points_sweep[: points_sweep.shape[0] - (points_sweep.shape[0] % 5)]
-        points_sweep = points_sweep.reshape([-1, 5])[:, :4]
+        points_sweep = self.get_point_file(sweep_info['lidar_path'])[:, :4]
 
         points_sweep = self.remove_ego_points(points_sweep).T
         if sweep_info['transform_matrix'] is not None:
@@ -57,11 +95,7 @@ class LyftDataset(DatasetTemplate):
 
     def get_lidar_with_sweeps(self, index, max_sweeps=1):
         info = self.infos[index]
-        lidar_path = self.root_path / info['lidar_path']
-        points = np.fromfile(str(lidar_path), dtype=np.float32, count=-1)
-        if points.shape[0] % 5 != 0:
-            points = points[: points.shape[0] - (points.shape[0] % 5)]
-        points = points.reshape([-1, 5])[:, :4]
+        points = self.get_point_file(info['lidar_path'])[:, :4]
 
         sweep_points_list = [points]
         sweep_times_list = [np.zeros((points.shape[0], 1))]
@@ -1,4 +1,5 @@
 import copy
+import hashlib
 import pickle
 from pathlib import Path
 
@@ -7,6 +8,7 @@ from tqdm import tqdm
 
 from ...ops.roiaware_pool3d import roiaware_pool3d_utils
 from ...utils import common_utils
+from ...utils.shared_memory_utils import SharedPointCache
 from ..dataset import DatasetTemplate
 
 
@@ -21,6 +23,43 @@ class NuScenesDataset(DatasetTemplate):
         if self.training and self.dataset_cfg.get('BALANCED_RESAMPLING', False):
             self.infos = self.balanced_infos_resampling(self.infos)
 
+        self.use_shared_memory = self.dataset_cfg.get('USE_SHARED_MEMORY', False) and self.training
+        self.point_cache = None
+        if self.use_shared_memory:
+            self.init_point_cache()
+
+    def init_point_cache(self):
+        """
+        Keyframes and sweeps are cached in shared memory (see SharedPointCache), the cache of a dataset root is
+        shared by all the jobs of a node
+        """
+        self.point_cache = SharedPointCache(
+            prefix='pcdet_nusc_%s' % hashlib.md5(str(self.root_path.resolve()).encode()).hexdigest()[:8],
+            max_bytes=self.dataset_cfg.get('SHARED_MEMORY_SIZE_GB', 16) * 1024 ** 3, logger=self.logger
+        )
+        if self.dataset_cfg.get('SHARED_MEMORY_EAGER', False):
+            lidar_paths = list(dict.fromkeys([info['lidar_path'] for info in self.infos]))
+            sweep_paths = list(dict.fromkeys([
+                sweep['lidar_path'] for info in self.infos for sweep in info['sweeps']
+            ]))
+            self.point_cache.fill(lidar_paths + sweep_paths, self.read_point_file)
+
+    def clean_shared_memory(self):
+        self.point_cache.clean()
+        self.logger.info('Training data has been deleted from shared memory')
+
+    def read_point_file(self, lidar_path):
+        return np.fromfile(str(self.root_path / lidar_path), dtype=np.float32, count=-1).reshape([-1, 5])
+
+    def get_point_file(self, lidar_path):
+        """
+        Returns:
+            points: (N, 5), read only if it comes from the shared memory cache
+        """
+        if self.point_cache is not None:
+            return self.point_cache.get(lidar_path, self.read_point_file)
+        return self.read_point_file(lidar_path)
+
     def include_nuscenes_data(self, mode):
         self.logger.info('Loading NuScenes dataset')
         nuscenes_infos = []
@@ -78,8 +117,7 @@ class NuScenesDataset(DatasetTemplate):
             mask = ~((np.abs(points[:, 0]) < center_radius) & (np.abs(points[:, 1]) < center_radius))
             return points[mask]
 
-        lidar_path = self.root_path / sweep_info['lidar_path']
-        points_sweep = np.fromfile(str(lidar_path), dtype=np.float32, count=-1).reshape([-1, 5])[:, :4]
+        points_sweep = self.get_point_file(sweep_info['lidar_path'])[:, :4]
         points_sweep = remove_ego_points(points_sweep).T
         if sweep_info['transform_matrix'] is not None:
             num_points = points_sweep.shape[1]
@@ -91,8 +129,7 @@ class NuScenesDataset(DatasetTemplate):
 
     def get_lidar_with_sweeps(self, index, max_sweeps=1):
         info = self.infos[index]
-        lidar_path = self.root_path / info['lidar_path']
-        points = np.fromfile(str(lidar_path), dtype=np.float32, count=-1).reshape([-1, 5])[:, :4]
+        points = self.get_point_file(info['lidar_path'])[:, :4]
 
         sweep_points_list = [points]
         sweep_times_list = [np.zeros((points.shape[0], 1))]
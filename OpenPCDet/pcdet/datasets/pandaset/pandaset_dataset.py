@@ -16,6 +16,10 @@ from ...ops.roiaware_pool3d import roiaware_pool3d_utils
 
 import torch
 
+# arrays of a packed sequence, each saved as <PACKED_DATA_PATH>/<sequence>/<key>.npy
+PACKED_SEQUENCE_KEYS = ['points', 'point_offsets', 'boxes', 'box_labels', 'box_sensor_ids', 'box_offsets',
+                        'poses', 'zrot_world_to_ego']
+
 
 def pose_dict_to_numpy(pose):
     """
@@ -69,6 +73,9 @@ class PandasetDataset(DatasetTemplate):
         self.pandaset_infos = []
         self.include_pandaset_infos(self.mode)
 
+        self.use_packed_data = self.dataset_cfg.get('USE_PACKED_DATA', False)
+        self.packed_sequences = {}
+
 
     def include_pandaset_infos(self, mode):
         if self.logger is not None:
@@ -113,10 +120,7 @@ class PandasetDataset(DatasetTemplate):
         info = self.pandaset_infos[index]
         seq_idx = info['sequence']
 
-        pose = self._get_pose(info)
-        points = self._get_lidar_points(info, pose)
-        boxes, labels, zrot_world_to_ego = self._get_annotations(info, pose)
-        pose_np = pose_dict_to_numpy(pose)
+        points, boxes, labels, zrot_world_to_ego, pose_np = self.get_frame(info)
 
         input_dict = {'points': points,
                       'gt_boxes': boxes,
@@ -124,7 +128,7 @@ class PandasetDataset(DatasetTemplate):
                       'sequence': int(seq_idx),
                       'frame_idx': info['frame_idx'],
                       'zrot_world_to_ego': zrot_world_to_ego,
-                      'pose': pose_dict_to_numpy(pose)
+                      'pose': pose_np
                      }
         # seq_idx is converted to int because strings can't be passed to
         # the gpu in pytorch
@@ -136,6 +140,57 @@ class PandasetDataset(DatasetTemplate):
         return data_dict
 
 
+    def get_frame(self, info):
+        """
+        Points, boxes, labels, zrot_world_to_ego and pose of a frame in the unified normative coordinate system,
+        read from the packed sequences (see create_packed_sequences) if USE_PACKED_DATA is set
+        """
+        if self.use_packed_data:
+            return self._get_packed_frame(info)
+
+        pose = self._get_pose(info)
+        points = self._get_lidar_points(info, pose)
+        boxes, labels, zrot_world_to_ego = self._get_annotations(info, pose)
+        return points, boxes, labels, zrot_world_to_ego, pose_dict_to_numpy(pose)
+
+
+    def _get_packed_sequence(self, seq_idx):
+        """
+        The arrays of a packed sequence, memory mapped once per process
+        """
+        if seq_idx not in self.packed_sequences:
+            seq_path = os.path.join(self.root_path, self.dataset_cfg.get('PACKED_DATA_PATH', 'packed'), seq_idx)
+            self.packed_sequences[seq_idx] = {
+                key: np.load(os.path.join(seq_path, '{}.npy'.format(key)), mmap_mode='r')
+                for key in PACKED_SEQUENCE_KEYS
+            }
+        return self.packed_sequences[seq_idx]
+
+
+    def _get_packed_frame(self, info):
+        seq = self._get_packed_sequence(info['sequence'])
+        frame_idx = info['frame_idx']
+        device = self.dataset_cfg.get('LIDAR_DEVICE', 0)
+
+        # the points of a frame are sorted by device: [device 0 start, device 1 start, end]
+        point_offsets = seq['point_offsets'][frame_idx]
+        start, end = (point_offsets[0], point_offsets[2]) if device == -1 \
+            else (point_offsets[device], point_offsets[device + 1])
+        points = np.array(seq['points'][start:end])  # copy, the augmentors work in place
+
+        start, end = seq['box_offsets'][frame_idx], seq['box_offsets'][frame_idx + 1]
+        boxes = np.array(seq['boxes'][start:end])
+        labels = np.array(seq['box_labels'][start:end])
+        if device != -1:
+            # keep cuboids that are seen by a given device
+            mask = seq['box_sensor_ids'][start:end] != 1 - device
+            boxes, labels = boxes[mask], labels[mask]
+        labels = np.array([self.dataset_cfg.TRAINING_CATEGORIES.get(lab, lab) for lab in labels])
+
+        return points, boxes, labels, float(seq['zrot_world_to_ego'][frame_idx]), \
+            np.array(seq['poses'][frame_idx])
+
+
     def _get_pose(self, info):
         seq_idx = info['sequence']
         # get pose for world to ego frame transformation
@@ -162,6 +217,18 @@ class PandasetDataset(DatasetTemplate):
         # There seems to be issues with the automatic deletion of pandas datasets sometimes
         del lidar_frame
 
+        return self._world_points_to_normative(world_points, pose)
+
+
+    @staticmethod
+    def _world_points_to_normative(world_points, pose):
+        """
+        Args:
+            world_points: (N, 4 + C) x, y, z, intensity in world coordinates
+            pose:
+        Returns:
+            points: (N, 4) x, y, z, intensity in normative ego coordinates
+        """
         points_loc = world_points[:, :3]
         points_int = world_points[:, 3]
 
@@ -196,6 +263,19 @@ class PandasetDataset(DatasetTemplate):
             # keep cuboids that are seen by a given device
             cuboids = cuboids[cuboids["cuboids.sensor_id"] != 1 - device]
 
+        ego_boxes, labels, zrot_world_to_ego = self._cuboids_to_normative(cuboids, pose)
+        del cuboids  # There seem to be issues with the automatic deletion of pandas datasets sometimes
+
+        labels = np.array([self.dataset_cfg.TRAINING_CATEGORIES.get(lab, lab)
+                           for lab in labels] )
+
+        return ego_boxes, labels, zrot_world_to_ego
+
+
+    def _cuboids_to_normative(self, cuboids, pose):
+        """
+        Boxes of a cuboids DataFrame in normative ego coordinates, their raw labels and zrot_world_to_ego
+        """
         xs = cuboids['position.x'].to_numpy()
         ys = cuboids['position.y'].to_numpy()
         zs = cuboids['position.z'].to_numpy()
@@ -205,11 +285,6 @@ class PandasetDataset(DatasetTemplate):
         yaws = cuboids['yaw'].to_numpy()
         labels = cuboids['label'].to_numpy()
 
-        del cuboids  # There seem to be issues with the automatic deletion of pandas datasets sometimes
-
-        labels = np.array([self.dataset_cfg.TRAINING_CATEGORIES.get(lab, lab)
-                           for lab in labels] )
-
         # Compute the center points coordinates in ego coordinates
         centers = np.vstack([xs, ys, zs]).T
         ego_centers = ps.geometry.lidar_points_to_ego(centers, pose)
@@ -383,6 +458,64 @@ class PandasetDataset(DatasetTemplate):
         return infos
 
 
+    def create_packed_sequences(self, infos, save_path):
+        """
+        Converts the lidar and cuboids DataFrames of the frames of infos into packed numpy arrays, one directory of
+        PACKED_SEQUENCE_KEYS .npy files per sequence, which are memory mapped when USE_PACKED_DATA is set.
+        The points (normative ego coordinates) of all devices are kept, sorted by device, and the cuboids keep their
+        sensor id and raw label, so LIDAR_DEVICE and TRAINING_CATEGORIES are still applied when loading.
+        """
+        sequences = {}
+        for info in infos:
+            sequences.setdefault(info['sequence'], []).append(info)
+
+        for seq_idx, seq_infos in sequences.items():
+            print('packing sequence {} ({} frames)'.format(seq_idx, len(seq_infos)))
+            seq_infos = sorted(seq_infos, key=lambda x: x['frame_idx'])
+            assert [info['frame_idx'] for info in seq_infos] == list(range(len(seq_infos)))
+
+            points_list, point_offsets, boxes_list, labels_list, sensor_ids_list, box_offsets = [], [], [], [], [], [0]
+            poses, zrots = [], []
+            num_points = 0
+            for info in seq_infos:
+                pose = self._get_pose(info)
+
+                lidar_frame = pd.read_pickle(info['lidar_path'])
+                devices = lidar_frame.d.to_numpy()
+                world_points = lidar_frame.to_numpy()
+                del lidar_frame
+                order = np.argsort(devices, kind='stable')
+                points_list.append(self._world_points_to_normative(world_points[order], pose))
+                point_offsets.append(num_points + np.searchsorted(devices[order], [0, 1, 2]))
+                num_points += len(order)
+
+                cuboids = pd.read_pickle(info['cuboids_path'])
+                boxes, labels, zrot_world_to_ego = self._cuboids_to_normative(cuboids, pose)
+                sensor_ids_list.append(cuboids['cuboids.sensor_id'].to_numpy().astype(np.int8))
+                del cuboids
+                boxes_list.append(boxes)
+                labels_list.append(labels.astype(str))
+                box_offsets.append(box_offsets[-1] + len(boxes))
+
+                poses.append(pose_dict_to_numpy(pose))
+                zrots.append(zrot_world_to_ego)
+
+            packed = {
+                'points': np.concatenate(points_list, axis=0),
+                'point_offsets': np.array(point_offsets, dtype=np.int64),
+                'boxes': np.concatenate(boxes_list, axis=0),
+                'box_labels': np.concatenate(labels_list, axis=0),
+                'box_sensor_ids': np.concatenate(sensor_ids_list, axis=0),
+                'box_offsets': np.array(box_offsets, dtype=np.int64),
+                'poses': np.array(poses, dtype=np.float64),
+                'zrot_world_to_ego': np.array(zrots, dtype=np.float64)
+            }
+            seq_path = os.path.join(save_path, seq_idx)
+            os.makedirs(seq_path, exist_ok=True)
+            for key in PACKED_SEQUENCE_KEYS:
+                np.save(os.path.join(seq_path, '{}.npy'.format(key)), packed[key])
+
+
     def create_groundtruth_database(self, info_path=None, used_classes=None, split='train'):
         database_save_path = os.path.join(self.root_path,
                 'gt_database' if split == 'train' else 'gt_database_{}'.format(split))
@@ -399,9 +532,7 @@ class PandasetDataset(DatasetTemplate):
             print('gt_database sample: %d/%d' % (k + 1, len(infos)))
             info = infos[k]
             sample_idx = info['frame_idx']
-            pose = self._get_pose(info)
-            points = self._get_lidar_points(info, pose)
-            gt_boxes, names, _ = self._get_annotations(info, pose)
+            points, gt_boxes, names, _, _ = self.get_frame(info)
 
             num_obj = gt_boxes.shape[0]
 
@@ -443,22 +574,34 @@ class PandasetDataset(DatasetTemplate):
         return ap_result_str, ap_dict
 
 
-def create_pandaset_infos(dataset_cfg, class_names, data_path, save_path):
+def create_pandaset_infos(dataset_cfg, class_names, data_path, save_path, pack_sequences=False):
     """
     Create dataset_infos files in order not to have it in a preprocessed pickle
     file with the info for each sample
     See PandasetDataset.get_infos for further details.
+    With pack_sequences, the frames are also converted into the packed sequences read with USE_PACKED_DATA
+    (see PandasetDataset.create_packed_sequences)
     """
     dataset = PandasetDataset(dataset_cfg=dataset_cfg, class_names=class_names, root_path=data_path, training=False)
+    all_infos = []
     for split in ["train", "val", "test"]:
         print("---------------- Start to generate {} data infos ---------------".format(split))
         dataset.set_split(split)
         infos = dataset.get_infos()
+        all_infos.extend(infos)
         file_path = os.path.join(save_path, 'pandaset_infos_{}.pkl'.format(split))
         with open(file_path, 'wb') as f:
             pickle.dump(infos, f)
         print("Pandaset info {} file is saved to {}".format(split, file_path))
 
+    if pack_sequences:
+        print('---------------------------Start to pack the sequences-------------------------')
+        # get_infos releases the sequences it has loaded, a new dataset is needed to read them again
+        dataset = PandasetDataset(dataset_cfg=dataset_cfg, class_names=class_names, root_path=data_path, training=False)
+        packed_path = os.path.join(save_path, dataset_cfg.get('PACKED_DATA_PATH', 'packed'))
+        dataset.create_packed_sequences(all_infos, packed_path)
+        print("Pandaset sequences are packed to {}".format(packed_path))
+
     print('------------Start create groundtruth database for data augmentation-----------')
     dataset = PandasetDataset(dataset_cfg=dataset_cfg, class_names=class_names, root_path=data_path, training=False)
     dataset.set_split("train")
@@ -481,7 +624,8 @@ if __name__ == '__main__':
             dataset_cfg=dataset_cfg,
             class_names=['Car', 'Pedestrian', 'Cyclist'],
             data_path=ROOT_DIR / 'data' / 'pandaset',
-            save_path=ROOT_DIR / 'data' / 'pandaset'
+            save_path=ROOT_DIR / 'data' / 'pandaset',
+            pack_sequences=sys.argv.__len__() > 3 and sys.argv[3] == 'packed'
         )
 
 
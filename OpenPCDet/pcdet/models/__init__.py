@@ -27,7 +27,11 @@ def load_data_to_gpu(batch_dict):
         elif key in ['frame_id', 'metadata', 'calib']:
             continue
         elif key in ['images']:
-            batch_dict[key] = kornia.image_to_tensor(val).float().cuda().contiguous()
+            if val.dtype == np.uint8:
+                # images kept as uint8 by the dataloader (DEFER_IMAGE_NORMALIZATION) are copied at a quarter of the size
+                batch_dict[key] = kornia.image_to_tensor(val).cuda().float().div_(255.0).contiguous()
+            else:
+                batch_dict[key] = kornia.image_to_tensor(val).float().cuda().contiguous()
         elif key in ['image_shape']:
             batch_dict[key] = torch.from_numpy(val).int().cuda()
         else:
@@ -14,13 +14,16 @@ from pcdet.utils import transform_utils
 
 class FrustumGridGenerator(nn.Module):
 
-    def __init__(self, grid_size, pc_range, disc_cfg):
+    def __init__(self, grid_size, pc_range, disc_cfg, chunk_size=0, cache_grid=False):
         """
         Initializes Grid Generator for frustum features
         Args:
             grid_size: [X, Y, Z], Voxel grid size
             pc_range: [x_min, y_min, z_min, x_max, y_max, z_max], Voxelization point cloud range (m)
             disc_cfg: EasyDict, Depth discretiziation configuration
+            chunk_size: int, Number of X slices transformed at once, 0 transforms the whole grid at once.
+                Bounds the float32 intermediates of the transform (about ten grid sized tensors) to one chunk
+            cache_grid: bool, Reuse the last sampling grid while the calibration and image shape do not change
         """
         super().__init__()
         try:
@@ -45,17 +48,26 @@ class FrustumGridGenerator(nn.Module):
 
         # Create voxel grid
         self.depth, self.width, self.height = self.grid_size.int()
-        self.voxel_grid = create_meshgrid3d(depth=self.depth,
-                                                         height=self.height,
-                                                         width=self.width,
-                                                         normalized_coordinates=False)
+        voxel_grid = create_meshgrid3d(depth=self.depth,
+                                       height=self.height,
+                                       width=self.width,
+                                       normalized_coordinates=False)
 
-        self.voxel_grid = self.voxel_grid.permute(0, 1, 3, 2, 4)  # XZY-> XYZ
+        voxel_grid = voxel_grid.permute(0, 1, 3, 2, 4).contiguous()  # XZY-> XYZ
 
         # Add offsets to center of voxel
-        self.voxel_grid += 0.5
-        self.grid_to_lidar = self.grid_to_lidar_unproject(pc_min=self.pc_min,
-                                                          voxel_size=self.voxel_size)
+        voxel_grid += 0.5
+        grid_to_lidar = self.grid_to_lidar_unproject(pc_min=self.pc_min,
+                                                     voxel_size=self.voxel_size)
+
+        # Calibration independent, kept on the device of the module instead of being copied at every call
+        self.register_buffer('voxel_grid', voxel_grid, persistent=False)
+        self.register_buffer('grid_to_lidar', grid_to_lidar, persistent=False)
+
+        self.chunk_size = chunk_size
+        self.cache_grid = cache_grid
+        self.cached_inputs = None
+        self.cached_grid = None
 
     def grid_to_lidar_unproject(self, pc_min, voxel_size):
         """
@@ -114,28 +126,67 @@ class FrustumGridGenerator(nn.Module):
         frustum_grid = torch.cat((image_grid, image_depths), dim=-1)
         return frustum_grid
 
-    def forward(self, lidar_to_cam, cam_to_img, image_shape):
+    def forward(self, lidar_to_cam, cam_to_img, image_shape, grid_dtype=torch.float32):
         """
         Generates sampling grid for frustum features
         Args:
             lidar_to_cam: (B, 4, 4), LiDAR to camera frame transformation
             cam_to_img: (B, 3, 4), Camera projection matrix
             image_shape: (B, 2), Image shape [H, W]
+            grid_dtype: torch.dtype, Dtype of the returned grid, the dtype of the sampled features (the transforms
+                always run in float32)
         Returns:
             frustum_grid (B, X, Y, Z, 3), Sampling grids for frustum features
         """
+        inputs = (lidar_to_cam, cam_to_img, image_shape)
+        if self.cache_grid and self.cached_inputs is not None and self.cached_grid.dtype == grid_dtype and \
+                all(a.shape == b.shape and torch.equal(a, b) for a, b in zip(inputs, self.cached_inputs)):
+            return self.cached_grid
 
-        frustum_grid = self.transform_grid(voxel_grid=self.voxel_grid.to(lidar_to_cam.device),
-                                           grid_to_lidar=self.grid_to_lidar.to(lidar_to_cam.device),
-                                           lidar_to_cam=lidar_to_cam,
-                                           cam_to_img=cam_to_img)
-
-        # Normalize grid
+        # Normalization shape
         image_shape, _ = torch.max(image_shape, dim=0)
         image_depth = torch.tensor([self.disc_cfg["num_bins"]],
                                    device=image_shape.device,
                                    dtype=image_shape.dtype)
         frustum_shape = torch.cat((image_depth, image_shape))
+
+        if not self.chunk_size:
+            frustum_grid = self.frustum_grid_from_voxels(self.voxel_grid, lidar_to_cam, cam_to_img, frustum_shape)
+            frustum_grid = frustum_grid.to(grid_dtype)
+        else:
+            # Only the intermediates of one chunk of X slices are alive at a time
+            B = lidar_to_cam.shape[0]
+            X = self.voxel_grid.shape[1]
+            frustum_grid = lidar_to_cam.new_empty((B, ) + tuple(self.voxel_grid.shape[1:]),
+                                                  dtype=grid_dtype)
+            for start in range(0, X, self.chunk_size):
+                end = min(start + self.chunk_size, X)
+                frustum_grid[:, start:end] = self.frustum_grid_from_voxels(
+                    self.voxel_grid[:, start:end], lidar_to_cam, cam_to_img, frustum_shape
+                )
+
+        if self.cache_grid:
+            self.cached_inputs = tuple(x.clone() for x in inputs)
+            self.cached_grid = frustum_grid
+
+        return frustum_grid
+
+    def frustum_grid_from_voxels(self, voxel_grid, lidar_to_cam, cam_to_img, frustum_shape):
+        """
+        Args:
+            voxel_grid: (1, X, Y, Z, 3), Voxel sampling grid or a chunk of it
+            lidar_to_cam: (B, 4, 4), LiDAR to camera frame transformation
+            cam_to_img: (B, 3, 4), Camera projection matrix
+            frustum_shape: (3), Frustum shape [D, H, W]
+        Returns:
+            frustum_grid (B, X, Y, Z, 3), Normalized sampling grid
+        """
+        frustum_grid = self.transform_grid(voxel_grid=voxel_grid,
+                                           grid_to_lidar=self.grid_to_lidar,
+                                           lidar_to_cam=lidar_to_cam,
+                                           cam_to_img=cam_to_img)
+
+        # Normalize grid
         frustum_grid = transform_utils.normalize_coords(coords=frustum_grid, shape=frustum_shape)
 
         # Replace any NaNs or infinites with out of bounds
@@ -23,9 +23,20 @@ class FrustumToVoxel(nn.Module):
         self.disc_cfg = disc_cfg
         self.grid_generator = FrustumGridGenerator(grid_size=grid_size,
                                                    pc_range=pc_range,
-                                                   disc_cfg=disc_cfg)
+                                                   disc_cfg=disc_cfg,
+                                                   chunk_size=model_cfg.get('GRID_CHUNK_SIZE', 0),
+                                                   cache_grid=model_cfg.get('CACHE_GRID', False))
         self.sampler = Sampler(**model_cfg.SAMPLER)
 
+        # Only sample the voxels inside the image view (and above the occupancy prior)
+        self.sparse_sampling = model_cfg.get('SPARSE_SAMPLING', False)
+        self.occupancy_thresh = model_cfg.get('OCCUPANCY_THRESH', 0)
+        self.dense_output = model_cfg.get('DENSE_OUTPUT', True)
+        if self.sparse_sampling:
+            # the skipped voxels are exactly zero only with zero padding
+            assert self.sampler.padding_mode == 'zeros'
+        self.visible_cache = None
+
     def forward(self, batch_dict):
         """
         Generates voxel features via 3D transformation and sampling
@@ -39,16 +50,113 @@ class FrustumToVoxel(nn.Module):
             batch_dict:
                 voxel_features: (B, C, Z, Y, X), Image voxel features
         """
-        # Generate sampling grid for frustum volume
+        # Generate sampling grid for frustum volume, in half precision only when the features are (autocast)
+        frustum_features = batch_dict["frustum_features"]
         grid = self.grid_generator(lidar_to_cam=batch_dict["trans_lidar_to_cam"],
                                    cam_to_img=batch_dict["trans_cam_to_img"],
-                                   image_shape=batch_dict["image_shape"])  # (B, X, Y, Z, 3)
+                                   image_shape=batch_dict["image_shape"],
+                                   grid_dtype=frustum_features.dtype)  # (B, X, Y, Z, 3)
+
+        if self.sparse_sampling:
+            return self.forward_sparse(batch_dict, grid)
 
         # Sample frustum volume to generate voxel volume
-        voxel_features = self.sampler(input_features=batch_dict["frustum_features"],
+        voxel_features = self.sampler(input_features=frustum_features,
                                       grid=grid)  # (B, C, X, Y, Z)
 
         # (B, C, X, Y, Z) -> (B, C, Z, Y, X)
         voxel_features = voxel_features.permute(0, 1, 4, 3, 2)
         batch_dict["voxel_features"] = voxel_features
         return batch_dict
+
+    @staticmethod
+    def compact_indices(mask):
+        """
+        Args:
+            mask: (B, N), Selected elements
+        Returns:
+            indices: (B, K), Indices of the selected elements first, K is the max number of selected elements
+            valid: (B, K), Whether the index is a selected element
+        """
+        counts = mask.sum(dim=1)
+        num = int(counts.max()) if mask.shape[0] > 0 else 0
+        indices = torch.sort((~mask).int(), dim=1, stable=True)[1][:, :num]
+        valid = torch.arange(num, device=mask.device).unsqueeze(0) < counts.unsqueeze(1)
+        return indices, valid
+
+    def get_visible_voxels(self, grid, frustum_shape):
+        """
+        Finds the voxels whose sampling point receives a non-zero bilinear weight from the frustum volume.
+        Cached for the grid, i.e. computed once per calibration when the grid generator caches its grid.
+        Args:
+            grid: (B, X, Y, Z, 3), Sampling grid
+            frustum_shape: [D, H, W], Frustum volume shape
+        Returns:
+            indices: (B, K), Flattened (X, Y, Z) indices of the visible voxels
+            valid: (B, K), Whether the index is a visible voxel
+            points: (B, K, 3), Sampling points of the visible voxels
+        """
+        if self.visible_cache is not None and self.visible_cache[0] is grid and \
+                self.visible_cache[1] == tuple(frustum_shape):
+            return self.visible_cache[2]
+
+        points = grid.view(grid.shape[0], -1, 3)
+        # pixel (x + 1) * size / 2 - 0.5 must be within (-1, size)
+        bound = 1 + 1 / points.new_tensor(list(reversed(frustum_shape)), dtype=torch.float32)
+        visible = (points.abs() < bound).all(dim=-1)
+
+        indices, valid = self.compact_indices(visible)
+        points = torch.gather(points, 1, indices.unsqueeze(-1).repeat(1, 1, 3))
+        if self.grid_generator.cache_grid:
+            self.visible_cache = (grid, tuple(frustum_shape), (indices, valid, points))
+        return indices, valid, points
+
+    def forward_sparse(self, batch_dict, grid):
+        """
+        Samples the frustum features only at the visible voxels
+        Args:
+            batch_dict:
+                frustum_features: (B, C, D, H_image, W_image), Image frustum features
+                frustum_depth_probs: (B, 1, D, H_image, W_image), Depth distributions, for the occupancy prior
+            grid: (B, X, Y, Z, 3), Sampling grid
+        Returns:
+            batch_dict:
+                voxel_features_sparse: (N, C), Features of the sampled voxels
+                voxel_coords: (N, 4), [batch_idx, z_idx, y_idx, x_idx] of the sampled voxels
+                voxel_features: (B, C, Z, Y, X), Image voxel features, zero at the skipped voxels, if DENSE_OUTPUT
+        """
+        frustum_features = batch_dict["frustum_features"]
+        B, C = frustum_features.shape[:2]
+        X, Y, Z = grid.shape[1:4]
+
+        indices, valid, points = self.get_visible_voxels(grid, tuple(frustum_features.shape[2:]))
+        if points.dtype != frustum_features.dtype:
+            points = points.to(frustum_features.dtype)
+
+        if self.occupancy_thresh > 0:
+            # cheap prior: the frustum features are scaled by the depth probability of their bin
+            depth_probs = self.sampler.sample_points(input_features=batch_dict["frustum_depth_probs"],
+                                                     points=points)  # (B, 1, K)
+            occupied, occupied_valid = self.compact_indices(valid & (depth_probs[:, 0] > self.occupancy_thresh))
+            indices = torch.gather(indices, 1, occupied)
+            points = torch.gather(points, 1, occupied.unsqueeze(-1).repeat(1, 1, 3))
+            valid = occupied_valid
+
+        features = self.sampler.sample_points(input_features=frustum_features, points=points)  # (B, C, K)
+        features = features * valid.unsqueeze(1).type_as(features)
+
+        batch_idx, slot = valid.nonzero(as_tuple=True)
+        voxel_idx = indices[batch_idx, slot]
+        batch_dict["voxel_features_sparse"] = features[batch_idx, :, slot]
+        batch_dict["voxel_coords"] = torch.stack(
+            (batch_idx, voxel_idx % Z, (voxel_idx // Z) % Y, voxel_idx // (Y * Z)), dim=-1
+        ).int()
+
+        if self.dense_output:
+            voxel_features = features.new_zeros((B, C, X * Y * Z)).scatter(
+                2, indices.unsqueeze(1).repeat(1, C, 1), features
+            )
+            # (B, C, X, Y, Z) -> (B, C, Z, Y, X)
+            batch_dict["voxel_features"] = voxel_features.view(B, C, X, Y, Z).permute(0, 1, 4, 3, 2)
+
+        return batch_dict
@@ -28,3 +28,16 @@ class Sampler(nn.Module):
         # Sample from grid
         output = F.grid_sample(input=input_features, grid=grid, mode=self.mode, padding_mode=self.padding_mode)
         return output
+
+    def sample_points(self, input_features, points):
+        """
+        Samples input at a set of grid points
+        Args:
+            input_features: (B, C, D, H, W), Input frustum features
+            points: (B, K, 3), Sampling points in normalized grid coordinates
+        Returns
+            output_features: (B, C, K) Output point features
+        """
+        grid = points.view(points.shape[0], 1, 1, points.shape[1], 3)
+        output = F.grid_sample(input=input_features, grid=grid, mode=self.mode, padding_mode=self.padding_mode)
+        return output.view(output.shape[0], output.shape[1], -1)
@@ -57,9 +57,11 @@ class DepthFFN(nn.Module):
             image_features = self.channel_reduce(image_features)
 
         # Create image feature plane-sweep volume
-        frustum_features = self.create_frustum_features(image_features=image_features,
-                                                        depth_logits=depth_logits)
+        frustum_features, depth_probs = self.create_frustum_features(image_features=image_features,
+                                                                     depth_logits=depth_logits,
+                                                                     return_depth_probs=True)
         batch_dict["frustum_features"] = frustum_features
+        batch_dict["frustum_depth_probs"] = depth_probs
 
         if self.training:
             self.forward_ret_dict["depth_maps"] = batch_dict["depth_maps"]
@@ -67,14 +69,16 @@ class DepthFFN(nn.Module):
             self.forward_ret_dict["depth_logits"] = depth_logits
         return batch_dict
 
-    def create_frustum_features(self, image_features, depth_logits):
+    def create_frustum_features(self, image_features, depth_logits, return_depth_probs=False):
         """
         Create image depth feature volume by multiplying image features with depth distributions
         Args:
             image_features: (N, C, H, W), Image features
             depth_logits: (N, D+1, H, W), Depth classification logits
+            return_depth_probs: bool, Also return the depth distributions
         Returns:
             frustum_features: (N, C, D, H, W), Image features
+            depth_probs: (N, 1, D, H, W), Depth distributions, if return_depth_probs
         """
         channel_dim = 1
         depth_dim = 2
@@ -89,6 +93,8 @@ class DepthFFN(nn.Module):
 
         # Multiply to form image depth feature volume
         frustum_features = depth_probs * image_features
+        if return_depth_probs:
+            return frustum_features, depth_probs
         return frustum_features
 
     def get_loss(self):
@@ -170,6 +170,9 @@ class CenterHead(nn.Module):
         target_assigner_cfg = self.model_cfg.TARGET_ASSIGNER_CONFIG
         # feature_map_size = self.grid_size[:2] // target_assigner_cfg.FEATURE_MAP_STRIDE
 
+        if target_assigner_cfg.get('VECTORIZED', False) and hasattr(gt_boxes, 'scatter_reduce_'):
+            return self.assign_targets_vectorized(gt_boxes, feature_map_size=feature_map_size)
+
         batch_size = gt_boxes.shape[0]
         ret_dict = {
             'heatmaps': [],
@@ -218,6 +221,80 @@ class CenterHead(nn.Module):
             ret_dict['masks'].append(torch.stack(masks_list, dim=0))
         return ret_dict
 
+    def assign_targets_vectorized(self, gt_boxes, feature_map_size):
+        """
+        Same targets as assign_targets, but all heads and samples are assigned with batched tensor ops
+        on the device of gt_boxes (the gaussians are merged with scatter_reduce_, torch>=1.12)
+        Args:
+            gt_boxes: (B, M, 8)
+            feature_map_size: (2) [x, y]
+        Returns:
+
+        """
+        target_assigner_cfg = self.model_cfg.TARGET_ASSIGNER_CONFIG
+        feature_map_stride = target_assigner_cfg.FEATURE_MAP_STRIDE
+        num_max_objs = target_assigner_cfg.NUM_MAX_OBJS
+        batch_size = gt_boxes.shape[0]
+        width, height = int(feature_map_size[0]), int(feature_map_size[1])
+
+        x, y, z = gt_boxes[..., 0], gt_boxes[..., 1], gt_boxes[..., 2]
+        coord_x = (x - self.point_cloud_range[0]) / self.voxel_size[0] / feature_map_stride
+        coord_y = (y - self.point_cloud_range[1]) / self.voxel_size[1] / feature_map_stride
+        coord_x = torch.clamp(coord_x, min=0, max=width - 0.5)
+        coord_y = torch.clamp(coord_y, min=0, max=height - 0.5)
+        center = torch.stack((coord_x, coord_y), dim=-1)  # (B, M, 2)
+        center_int = center.int()
+
+        dx = gt_boxes[..., 3] / self.voxel_size[0] / feature_map_stride
+        dy = gt_boxes[..., 4] / self.voxel_size[1] / feature_map_stride
+        radius = centernet_utils.gaussian_radius(dx, dy, min_overlap=target_assigner_cfg.GAUSSIAN_OVERLAP)
+        radius = torch.clamp_min(radius.int(), min=target_assigner_cfg.MIN_RADIUS)
+
+        box_targets = torch.cat((
+            center - center_int.float(), z[..., None], gt_boxes[..., 3:6].log(),
+            torch.cos(gt_boxes[..., 6:7]), torch.sin(gt_boxes[..., 6:7]), gt_boxes[..., 7:-1]
+        ), dim=-1)
+        valid_box = (dx > 0) & (dy > 0) & (center_int[..., 0] >= 0) & (center_int[..., 0] <= width) & \
+                    (center_int[..., 1] >= 0) & (center_int[..., 1] <= height)
+        gt_labels = gt_boxes[..., -1].long()
+
+        ret_dict = {
+            'heatmaps': [],
+            'target_boxes': [],
+            'inds': [],
+            'masks': [],
+            'heatmap_masks': []
+        }
+        for idx, cur_class_names in enumerate(self.class_names_each_head):
+            # global label ==> label inside the head, 0 for padded boxes and boxes of the other heads
+            label_mapping = gt_labels.new_zeros(len(self.class_names) + 1)
+            label_mapping[self.class_id_mapping_each_head[idx].to(gt_labels.device) + 1] = torch.arange(
+                1, len(cur_class_names) + 1, device=gt_labels.device
+            )
+            cur_labels = label_mapping[gt_labels]
+            in_head = cur_labels > 0
+            # boxes of a head are compacted in their original order
+            slots = in_head.long().cumsum(dim=1) - 1
+            bs_idx, box_idx = (in_head & (slots < num_max_objs) & valid_box).nonzero(as_tuple=True)
+            slot_idx = slots[bs_idx, box_idx]
+
+            heatmap = gt_boxes.new_zeros(batch_size, len(cur_class_names), height, width)
+            centernet_utils.draw_gaussians_to_heatmaps(
+                heatmap, bs_idx, cur_labels[bs_idx, box_idx] - 1, center_int[bs_idx, box_idx], radius[bs_idx, box_idx]
+            )
+            ret_boxes = gt_boxes.new_zeros((batch_size, num_max_objs, box_targets.shape[-1]))
+            ret_boxes[bs_idx, slot_idx] = box_targets[bs_idx, box_idx]
+            inds = gt_boxes.new_zeros(batch_size, num_max_objs).long()
+            inds[bs_idx, slot_idx] = (center_int[bs_idx, box_idx, 1] * width + center_int[bs_idx, box_idx, 0]).long()
+            mask = gt_boxes.new_zeros(batch_size, num_max_objs).long()
+            mask[bs_idx, slot_idx] = 1
+
+            ret_dict['heatmaps'].append(heatmap)
+            ret_dict['target_boxes'].append(ret_boxes)
+            ret_dict['inds'].append(inds)
+            ret_dict['masks'].append(mask)
+        return ret_dict
+
     def sigmoid(self, x):
         y = torch.clamp(x.sigmoid(), min=1e-4, max=1 - 1e-4)
         return y
@@ -69,6 +69,41 @@ def draw_gaussian_to_heatmap(heatmap, center, radius, k=1, valid_mask=None):
     return heatmap
 
 
+def draw_gaussians_to_heatmaps(heatmaps, batch_idx, class_idx, centers, radius):
+    """
+    Batched draw_gaussian_to_heatmap, the gaussians of all objects are evaluated in a (2R+1)x(2R+1) window
+    with R the largest radius and merged into the heatmaps with a single scatter max
+    Args:
+        heatmaps: (B, C, H, W)
+        batch_idx: (N)
+        class_idx: (N)
+        centers: (N, 2) int, [x, y]
+        radius: (N) int
+    Returns:
+        heatmaps: (B, C, H, W)
+    """
+    if batch_idx.shape[0] == 0:
+        return heatmaps
+
+    _, num_class, height, width = heatmaps.shape
+    max_radius = int(radius.max())
+    offsets = torch.arange(-max_radius, max_radius + 1, device=heatmaps.device)
+    off_y, off_x = offsets.view(1, -1, 1), offsets.view(1, 1, -1)
+
+    radius = radius.view(-1, 1, 1).long()
+    sigma = (2 * radius + 1).double() / 6
+    gaussian = torch.exp(-(off_x * off_x + off_y * off_y).double() / (2 * sigma * sigma)).float()
+
+    xs = centers[:, 0].view(-1, 1, 1).long() + off_x
+    ys = centers[:, 1].view(-1, 1, 1).long() + off_y
+    valid = (off_x.abs() <= radius) & (off_y.abs() <= radius) & \
+            (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    flat_idx = ((batch_idx.view(-1, 1, 1).long() * num_class + class_idx.view(-1, 1, 1).long()) * height + ys) * width + xs
+
+    heatmaps.view(-1).scatter_reduce_(0, flat_idx[valid], gaussian[valid].to(heatmaps.dtype), reduce='amax')
+    return heatmaps
+
+
 def _nms(heat, kernel=3):
     pad = (kernel - 1) // 2
 
@@ -73,6 +73,9 @@ class ProposalTargetLayer(nn.Module):
         Returns:
 
         """
+        if self.roi_sampler_cfg.get('BATCHED_SAMPLING', False):
+            return self.sample_rois_for_rcnn_batched(batch_dict)
+
         batch_size = batch_dict['batch_size']
         rois = batch_dict['rois']
         roi_scores = batch_dict['roi_scores']
@@ -114,6 +117,104 @@ class ProposalTargetLayer(nn.Module):
 
         return batch_rois, batch_gt_of_rois, batch_roi_ious, batch_roi_scores, batch_roi_labels
 
+    def sample_rois_for_rcnn_batched(self, batch_dict):
+        """
+        Same sampling as sample_rois_for_rcnn for the whole batch at once, without per sample loops and host syncs.
+        Args:
+            batch_dict:
+                batch_size:
+                rois: (B, num_rois, 7 + C)
+                roi_scores: (B, num_rois)
+                gt_boxes: (B, N, 7 + C + 1)
+                roi_labels: (B, num_rois)
+        Returns:
+
+        """
+        rois = batch_dict['rois']
+        roi_scores = batch_dict['roi_scores']
+        roi_labels = batch_dict['roi_labels']
+        gt_boxes = batch_dict['gt_boxes']
+        if gt_boxes.shape[1] == 0:
+            gt_boxes = gt_boxes.new_zeros((gt_boxes.shape[0], 1, gt_boxes.shape[2]))
+
+        # the trailing all zero boxes are padding
+        nonzero = (gt_boxes.sum(dim=-1) != 0).int()
+        gt_valid_mask = nonzero.flip(dims=[1]).cumsum(dim=1).flip(dims=[1]) > 0
+
+        max_overlaps, gt_assignment = self.get_max_iou_batched(
+            rois=rois[..., 0:7], roi_labels=roi_labels, gt_boxes=gt_boxes[..., 0:7],
+            gt_labels=gt_boxes[..., -1].long(), gt_valid_mask=gt_valid_mask,
+            by_class=self.roi_sampler_cfg.get('SAMPLE_ROI_BY_EACH_CLASS', False)
+        )
+
+        sampled_inds = self.subsample_rois_batched(max_overlaps=max_overlaps)  # (B, ROI_PER_IMAGE)
+
+        batch_rois = torch.gather(rois, 1, sampled_inds.unsqueeze(-1).repeat(1, 1, rois.shape[-1]))
+        batch_roi_labels = torch.gather(roi_labels, 1, sampled_inds)
+        batch_roi_ious = torch.gather(max_overlaps, 1, sampled_inds)
+        batch_roi_scores = torch.gather(roi_scores, 1, sampled_inds)
+        batch_gt_assignment = torch.gather(gt_assignment, 1, sampled_inds)
+        batch_gt_of_rois = torch.gather(
+            gt_boxes, 1, batch_gt_assignment.unsqueeze(-1).repeat(1, 1, gt_boxes.shape[-1])
+        )
+
+        return batch_rois, batch_gt_of_rois, batch_roi_ious, batch_roi_scores, batch_roi_labels.long()
+
+    def subsample_rois_batched(self, max_overlaps):
+        """
+        fg / hard bg / easy bg sampling of subsample_rois and sample_bg_inds for all samples: one sort of random keys
+        offset by the category puts the rois of every category in a random order, the fg rois are taken from it
+        without replacement and the bg rois with replacement, as in the per sample version.
+        Args:
+            max_overlaps: (B, M)
+        Returns:
+            sampled_inds: (B, ROI_PER_IMAGE)
+        """
+        roi_per_image = self.roi_sampler_cfg.ROI_PER_IMAGE
+        fg_rois_per_image = int(np.round(self.roi_sampler_cfg.FG_RATIO * roi_per_image))
+        fg_thresh = min(self.roi_sampler_cfg.REG_FG_THRESH, self.roi_sampler_cfg.CLS_FG_THRESH)
+
+        fg_mask = max_overlaps >= fg_thresh
+        easy_bg_mask = (max_overlaps < self.roi_sampler_cfg.CLS_BG_THRESH_LO) & ~fg_mask
+        hard_bg_mask = ~fg_mask & ~easy_bg_mask
+        num_fg, num_hard_bg, num_easy_bg = fg_mask.sum(dim=1), hard_bg_mask.sum(dim=1), easy_bg_mask.sum(dim=1)
+        num_bg = num_hard_bg + num_easy_bg
+
+        # number of sampled rois of every category
+        fg_this_image = torch.where(
+            num_bg > 0, num_fg.clamp(max=fg_rois_per_image), num_fg.new_full(num_fg.shape, roi_per_image)
+        )
+        fg_this_image = torch.where(num_fg > 0, fg_this_image, torch.zeros_like(fg_this_image))
+        bg_this_image = roi_per_image - fg_this_image
+        hard_bg_this_image = torch.min(
+            (bg_this_image.float() * self.roi_sampler_cfg.HARD_BG_RATIO).floor().long(), num_hard_bg
+        )
+        hard_bg_this_image = torch.where(num_easy_bg > 0, hard_bg_this_image, bg_this_image)
+        hard_bg_this_image = torch.where(num_hard_bg > 0, hard_bg_this_image, torch.zeros_like(hard_bg_this_image))
+
+        # fg rois first, then hard bg, then easy bg, every category in a random order
+        category = hard_bg_mask.long() + easy_bg_mask.long() * 2
+        keys = category.float() + torch.rand(max_overlaps.shape, device=max_overlaps.device) * 0.5
+        order = keys.argsort(dim=1)
+
+        slot = torch.arange(roi_per_image, device=max_overlaps.device).unsqueeze(0)  # (1, R)
+        rand = torch.rand((max_overlaps.shape[0], roi_per_image), device=max_overlaps.device)
+        is_fg = slot < fg_this_image.unsqueeze(1)
+        is_hard_bg = ~is_fg & (slot < (fg_this_image + hard_bg_this_image).unsqueeze(1))
+
+        def draw(num):
+            # uniform position in [0, num) with replacement
+            num = num.unsqueeze(1)
+            return torch.min((rand * num.float()).long(), (num - 1).clamp(min=0))
+
+        fg_pos = torch.where((num_bg > 0).unsqueeze(1), slot.expand_as(rand), draw(num_fg))
+        hard_bg_pos = num_fg.unsqueeze(1) + draw(num_hard_bg)
+        easy_bg_pos = (num_fg + num_hard_bg).unsqueeze(1) + draw(num_easy_bg)
+        pos = torch.where(is_fg, fg_pos, torch.where(is_hard_bg, hard_bg_pos, easy_bg_pos))
+
+        sampled_inds = torch.gather(order, 1, pos.clamp(max=max_overlaps.shape[1] - 1))
+        return sampled_inds
+
     def subsample_rois(self, max_overlaps):
         # sample fg, easy_bg, hard_bg
         fg_rois_per_image = int(np.round(self.roi_sampler_cfg.FG_RATIO * self.roi_sampler_cfg.ROI_PER_IMAGE))
@@ -226,3 +327,36 @@ class ProposalTargetLayer(nn.Module):
                 gt_assignment[roi_mask] = original_gt_assignment[cur_gt_assignment]
 
         return max_overlaps, gt_assignment
+
+    @staticmethod
+    def get_max_iou_batched(rois, roi_labels, gt_boxes, gt_labels, gt_valid_mask, by_class=True):
+        """
+        Args:
+            rois: (B, M, 7)
+            roi_labels: (B, M)
+            gt_boxes: (B, N, 7)
+            gt_labels: (B, N)
+            gt_valid_mask: (B, N)
+            by_class: only match the gt boxes of the same class
+
+        Returns:
+            max_overlaps: (B, M), 0 for the rois without a valid gt box
+            gt_assignment: (B, M), 0 for the rois without a valid gt box
+        """
+        batch_size, num_rois, num_gt = rois.shape[0], rois.shape[1], gt_boxes.shape[1]
+
+        # one iou kernel for the whole batch, the pairs of different samples are dropped
+        iou3d = iou3d_nms_utils.boxes_iou3d_gpu(rois.reshape(-1, 7), gt_boxes.reshape(-1, 7))
+        iou3d = iou3d.view(batch_size, num_rois, batch_size, num_gt).diagonal(dim1=0, dim2=2).permute(2, 0, 1)
+
+        mask = gt_valid_mask.unsqueeze(1)  # (B, 1, N)
+        if by_class:
+            mask = mask & (roi_labels.long().unsqueeze(2) == gt_labels.unsqueeze(1))
+        iou3d = iou3d.masked_fill(~mask, -1)
+
+        max_overlaps, gt_assignment = torch.max(iou3d, dim=2)
+        no_gt = max_overlaps < 0
+        max_overlaps = max_overlaps.masked_fill(no_gt, 0)
+        gt_assignment = gt_assignment.masked_fill(no_gt, 0)
+
+        return max_overlaps, gt_assignment
@@ -25,6 +25,37 @@ def in_hull(p, hull):
     return flag
 
 
+def points_in_boxes_count(points, boxes3d, eps=1e-6, max_elements=1 << 22):
+    """
+    Vectorized in_hull(points, boxes_to_corners_3d(boxes3d)[k]).sum() of all the boxes at once
+    Args:
+        points: (N, 3 + C)
+        boxes3d: (M, 7) [x, y, z, dx, dy, dz, heading], (x, y, z) is the box center
+        eps: points on the box surface are inside, as in in_hull
+        max_elements: the boxes are processed in chunks of at most max_elements box-point pairs
+
+    Returns:
+        num_points: (M) int32
+    """
+    points = np.asarray(points)[:, 0:3].astype(np.float64)
+    boxes3d = np.asarray(boxes3d)[:, 0:7].astype(np.float64)
+    num_points = np.zeros(boxes3d.shape[0], dtype=np.int32)
+    chunk = max(1, max_elements // max(points.shape[0], 1))
+
+    for start in range(0, boxes3d.shape[0], chunk):
+        boxes = boxes3d[start:start + chunk]
+        offset = points[np.newaxis, :, :] - boxes[:, np.newaxis, 0:3]  # (M', N, 3)
+        cosa, sina = np.cos(boxes[:, 6:7]), np.sin(boxes[:, 6:7])
+        local_x = offset[:, :, 0] * cosa + offset[:, :, 1] * sina
+        local_y = -offset[:, :, 0] * sina + offset[:, :, 1] * cosa
+        half_size = boxes[:, np.newaxis, 3:6] / 2 + eps
+        inside = (np.abs(local_x) <= half_size[:, :, 0]) & (np.abs(local_y) <= half_size[:, :, 1]) & \
+            (np.abs(offset[:, :, 2]) <= half_size[:, :, 2])
+        num_points[start:start + chunk] = inside.sum(axis=1)
+
+    return num_points
+
+
 def boxes_to_corners_3d(boxes3d):
     """
         7 -------- 4
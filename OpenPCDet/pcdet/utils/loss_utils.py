@@ -243,22 +243,21 @@ def compute_fg_mask(gt_boxes2d, shape, downsample_factor=1, device=torch.device(
     Returns:
         fg_mask (shape), Foreground mask
     """
-    fg_mask = torch.zeros(shape, dtype=torch.bool, device=device)
-
     # Set box corners
-    gt_boxes2d /= downsample_factor
-    gt_boxes2d[:, :, :2] = torch.floor(gt_boxes2d[:, :, :2])
-    gt_boxes2d[:, :, 2:] = torch.ceil(gt_boxes2d[:, :, 2:])
-    gt_boxes2d = gt_boxes2d.long()
-
-    # Set all values within each box to True
-    B, N = gt_boxes2d.shape[:2]
-    for b in range(B):
-        for n in range(N):
-            u1, v1, u2, v2 = gt_boxes2d[b, n]
-            fg_mask[b, v1:v2, u1:u2] = True
-
-    return fg_mask
+    gt_boxes2d = gt_boxes2d.to(device) / downsample_factor
+    gt_boxes2d = torch.cat([torch.floor(gt_boxes2d[:, :, :2]), torch.ceil(gt_boxes2d[:, :, 2:])], dim=-1).long()
+
+    # Set all values within each box to True, the rows and columns covered by every box are rasterized separately
+    # and combined for all boxes with one batched matmul: fg_mask[b, v, u] = any_n(in_v[b, n, v] & in_u[b, n, u])
+    H, W = shape[-2:]
+    u1, v1, u2, v2 = [gt_boxes2d[:, :, k:k + 1].clamp(min=0) for k in range(4)]
+    rows = torch.arange(H, device=device)
+    cols = torch.arange(W, device=device)
+    in_v = ((rows >= v1) & (rows < v2)).float()  # (B, N, H)
+    in_u = ((cols >= u1) & (cols < u2)).float()  # (B, N, W)
+    fg_mask = torch.bmm(in_v.transpose(1, 2), in_u) > 0
+
+    return fg_mask.view(shape)
 
 
 def neg_loss_cornernet(pred, gt, mask=None):
@@ -0,0 +1,208 @@
+import atexit
+import hashlib
+import os
+import time
+
+import SharedArray
+import torch.distributed as dist
+
+from . import common_utils
+
+SHM_DIR = '/dev/shm'
+
+
+class SharedPointCache(object):
+    """
+    LRU cache of point files (or decoded images) in shared memory, shared by the dataloader workers and the ranks
+    of a node.
+
+    Every file is stored as its own SharedArray segment /dev/shm/<prefix>_<md5 of the path>, so a cached file
+    is attached (not copied) by every process. The segment of a file is touched on every hit and the least
+    recently used segments are deleted down to low_water * max_bytes once the segments of the prefix exceed
+    max_bytes, so the scan of /dev/shm is paid once for many new files. The size of the cache is
+    taken from /dev/shm at most every scan_interval seconds (or when a new file would not fit) since the other
+    processes add segments as well. Every process creating the cache registers as a user of the prefix, the
+    segments are deleted by the last user cleaning up (other jobs of the node may share the prefix).
+    """
+
+    def __init__(self, prefix, max_bytes, scan_interval=1.0, low_water=0.9, logger=None):
+        self.prefix = prefix
+        self.max_bytes = int(max_bytes)
+        self.low_water = low_water
+        self.scan_interval = scan_interval
+        self.logger = logger
+        self.used_bytes = None
+        self.last_scan_time = 0
+        self.owner_pid = os.getpid()
+        self.register_user()
+        atexit.register(self.clean_at_exit)
+
+    def get_user_file(self, pid):
+        # not matched by list_segments, the segments of the prefix start with prefix + '_'
+        return os.path.join(SHM_DIR, '%s.user.%d' % (self.prefix, pid))
+
+    def register_user(self):
+        with open(self.get_user_file(self.owner_pid), 'w'):
+            pass
+
+    def get_other_users(self):
+        """
+        Returns:
+            pids: live processes using the prefix besides this one, the files of exited users are removed
+        """
+        pids = []
+        for entry in os.scandir(SHM_DIR):
+            if not entry.name.startswith(self.prefix + '.user.'):
+                continue
+            pid = int(entry.name.rsplit('.', 1)[1])
+            if pid == self.owner_pid:
+                continue
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                # killed without cleaning up
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+                continue
+            except PermissionError:
+                pass  # alive, owned by another user
+            pids.append(pid)
+        return pids
+
+    def get_key(self, path):
+        return '%s_%s' % (self.prefix, hashlib.md5(str(path).encode()).hexdigest())
+
+    def get(self, path, load_func):
+        """
+        Args:
+            path: file to read
+            load_func: path -> np.ndarray, called on a miss
+
+        Returns:
+            points: read only if it comes from the cache
+        """
+        sa_key = self.get_key(path)
+        try:
+            points = SharedArray.attach('shm://%s' % sa_key, ro=True)
+        except OSError:
+            points = load_func(path)
+            self.put(sa_key, points)
+            return points
+
+        try:
+            os.utime(os.path.join(SHM_DIR, sa_key))
+        except OSError:
+            pass  # evicted by another process meanwhile, the attached data stays valid
+        return points
+
+    def put(self, sa_key, points, evict=True):
+        """
+        Returns:
+            cached: False if the points do not fit (without evicting other files for evict=False)
+        """
+        if points.nbytes > self.max_bytes:
+            return False
+
+        if self.used_bytes is None or self.used_bytes + points.nbytes > self.max_bytes or \
+                time.time() - self.last_scan_time > self.scan_interval:
+            if evict:
+                self.used_bytes = self.evict(self.max_bytes - points.nbytes,
+                                             int(self.max_bytes * self.low_water) - points.nbytes)
+            else:
+                self.used_bytes = self.evict(self.max_bytes)
+        if self.used_bytes + points.nbytes > self.max_bytes:
+            return False
+
+        # written under a temporary name and renamed, so other processes never attach a partial segment
+        tmp_key = '%s.%d.tmp' % (sa_key, os.getpid())
+        common_utils.sa_create('shm://%s' % tmp_key, points)
+        try:
+            os.rename(os.path.join(SHM_DIR, tmp_key), os.path.join(SHM_DIR, sa_key))
+            self.used_bytes += os.stat(os.path.join(SHM_DIR, sa_key)).st_size  # data and SharedArray header
+        except OSError:
+            return False  # deleted by clean in another process
+        return True
+
+    def list_segments(self, with_tmp=False):
+        """
+        Returns:
+            segments: [(mtime, size, name)] of the segments of the prefix (and the ones being written for with_tmp)
+        """
+        segments = []
+        for entry in os.scandir(SHM_DIR):
+            if not entry.name.startswith(self.prefix + '_') or (not with_tmp and entry.name.endswith('.tmp')):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            segments.append((stat.st_mtime, stat.st_size, entry.name))
+        return segments
+
+    def evict(self, max_bytes, target_bytes=None):
+        """
+        Deletes the least recently used segments down to target_bytes (max_bytes by default) once more than
+        max_bytes are used
+
+        Returns:
+            used_bytes:
+        """
+        segments = sorted(self.list_segments())
+        used_bytes = sum([size for _, size, _ in segments])
+        if target_bytes is None or used_bytes <= max_bytes:
+            target_bytes = max_bytes
+        for _, size, name in segments:
+            if used_bytes <= target_bytes:
+                break
+            try:
+                os.remove(os.path.join(SHM_DIR, name))
+            except OSError:
+                pass
+            used_bytes -= size
+
+        self.last_scan_time = time.time()
+        return used_bytes
+
+    def fill(self, paths, load_func):
+        """
+        Eagerly loads the files of paths (split over the ranks) until the cache is full
+        """
+        cur_rank, num_gpus = common_utils.get_dist_info()
+        num_cached = 0
+        for path in paths[cur_rank::num_gpus]:
+            sa_key = self.get_key(path)
+            if os.path.exists(os.path.join(SHM_DIR, sa_key)):
+                continue
+            if not self.put(sa_key, load_func(path), evict=False):
+                break
+            num_cached += 1
+
+        if num_gpus > 1:
+            dist.barrier()
+        if self.logger is not None:
+            self.logger.info('%d point files have been loaded to shared memory (%s, %.2f GB)' % (
+                num_cached, self.prefix, self.evict(self.max_bytes) / 1024 ** 3))
+
+    def clean(self):
+        """
+        Unregisters this process, the segments are deleted when no other process uses the prefix anymore
+        """
+        try:
+            os.remove(self.get_user_file(self.owner_pid))
+        except OSError:
+            pass  # already cleaned
+        if len(self.get_other_users()) > 0:
+            return
+
+        for _, _, name in self.list_segments(with_tmp=True):
+            try:
+                SharedArray.delete('shm://%s' % name)
+            except OSError:
+                pass
+
+    def clean_at_exit(self):
+        # the forked dataloader workers share the atexit handlers of the main process
+        if os.getpid() == self.owner_pid:
+            self.clean()
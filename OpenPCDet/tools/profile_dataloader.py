@@ -0,0 +1,289 @@
+"""
+Measures the throughput of the training dataloader and the cost of every data preparation stage
+(loading, each augmentor, point feature encoding, each data processor, collate), and how long the
+training loop waits for the workers.
+
+    python profile_dataloader.py --cfg_file cfgs/kitti_models/pv_rcnn.yaml --workers 4 --batch_size 4
+    python profile_dataloader.py --cfg_file cfgs/kitti_models/pv_rcnn.yaml --synthetic 64 --model_time 100
+
+With --synthetic N a small KITTI format dataset of N frames (points, labels, calibs, images, infos and
+gt database) is generated in a temporary directory first, so no dataset is needed.
+"""
+import _init_path
+import argparse
+import functools
+import json
+import shutil
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from pcdet.config import cfg, cfg_from_list, cfg_from_yaml_file
+from pcdet.datasets import __all__ as dataset_classes
+from pcdet.utils import common_utils
+
+KITTI_CALIB = """P0: 7.215377e+02 0.000000e+00 6.095593e+02 0.000000e+00 0.000000e+00 7.215377e+02 1.728540e+02 0.000000e+00 0.000000e+00 0.000000e+00 1.000000e+00 0.000000e+00
+P1: 7.215377e+02 0.000000e+00 6.095593e+02 -3.875744e+02 0.000000e+00 7.215377e+02 1.728540e+02 0.000000e+00 0.000000e+00 0.000000e+00 1.000000e+00 0.000000e+00
+P2: 7.215377e+02 0.000000e+00 6.095593e+02 4.485728e+01 0.000000e+00 7.215377e+02 1.728540e+02 2.163791e-01 0.000000e+00 0.000000e+00 1.000000e+00 2.745884e-03
+P3: 7.215377e+02 0.000000e+00 6.095593e+02 -3.395242e+02 0.000000e+00 7.215377e+02 1.728540e+02 2.199936e+00 0.000000e+00 0.000000e+00 1.000000e+00 2.729905e-03
+R0_rect: 9.999239e-01 9.837760e-03 -7.445048e-03 -9.869795e-03 9.999421e-01 -4.278459e-03 7.402527e-03 4.351614e-03 9.999631e-01
+Tr_velo_to_cam: 7.533745e-03 -9.999714e-01 -6.166020e-04 -4.069766e-03 1.480249e-02 7.280733e-04 -9.998902e-01 -7.631618e-02 9.998621e-01 7.523790e-03 1.480755e-02 -2.717806e-01
+Tr_imu_to_velo: 9.999976e-01 7.553071e-04 -2.035826e-03 -8.086759e-01 -7.854027e-04 9.998898e-01 -1.482298e-02 3.195559e-01 2.024406e-03 1.482454e-02 9.998881e-01 -7.997231e-01
+"""
+
+KITTI_PLANE = """# Matrix
+WIDTH 4
+HEIGHT 1
+-7.051729e-03 -9.997791e-01 -1.980151e-02 1.680367e+00
+"""
+
+# (dx, dy, dz) of the synthetic objects
+SYNTHETIC_OBJECTS = {
+    'Car': (3.9, 1.6, 1.56),
+    'Pedestrian': (0.8, 0.6, 1.73),
+    'Cyclist': (1.76, 0.6, 1.73),
+}
+
+# durations of the current process, drained into every batch by ProfiledDataset.collate_batch
+_records = defaultdict(list)
+
+
+def timed(func, name):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        ret = func(*args, **kwargs)
+        _records[name].append(time.perf_counter() - start)
+        return ret
+    return wrapper
+
+
+def stage_name(func):
+    if isinstance(func, functools.partial):
+        func = func.func
+    return getattr(func, '__name__', func.__class__.__name__)
+
+
+class ProfiledDataset(Dataset):
+    """
+    Times the stages of a DatasetTemplate by wrapping its loaders and the queues of the data augmentor
+    and processor. The timings are collected in the worker processes and travel back with the batches.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+        for attr in ['get_lidar', 'get_calib', 'get_image', 'get_road_plane', 'prepare_data']:
+            if hasattr(dataset, attr):
+                setattr(dataset, attr, timed(getattr(dataset, attr), attr))
+
+        if dataset.data_augmentor is not None:
+            queue = dataset.data_augmentor.data_augmentor_queue
+            queue[:] = [timed(cur, 'augmentor/' + stage_name(cur)) for cur in queue]
+        dataset.point_feature_encoder.forward = timed(dataset.point_feature_encoder.forward, 'point_feature_encoder')
+        queue = dataset.data_processor.data_processor_queue
+        queue[:] = [timed(cur, 'processor/' + stage_name(cur)) for cur in queue]
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        data_dict = self.dataset[index]
+        _records['getitem'].append(time.perf_counter() - start)
+        return data_dict
+
+    def collate_batch(self, batch_list):
+        start = time.perf_counter()
+        batch_dict = self.dataset.collate_batch(batch_list)
+        _records['collate'].append(time.perf_counter() - start)
+
+        batch_dict['profile'] = {name: list(val) for name, val in _records.items()}
+        _records.clear()
+        return batch_dict
+
+
+def create_synthetic_kitti(data_path, num_frames, dataset_cfg, class_names, num_points=20000, seed=0):
+    """writes a KITTI format dataset of num_frames train / val / test frames and creates its infos"""
+    from skimage import io
+    from pcdet.datasets.kitti.kitti_dataset import create_kitti_infos
+    from pcdet.utils import box_utils, calibration_kitti
+
+    rng = np.random.RandomState(seed)
+    calib = None
+    for split, folder in [('train', 'training'), ('val', 'training'), ('test', 'testing')]:
+        ids = ['%06d' % (k + {'train': 0, 'val': num_frames, 'test': 0}[split]) for k in range(num_frames)]
+        (data_path / 'ImageSets').mkdir(parents=True, exist_ok=True)
+        (data_path / 'ImageSets' / ('%s.txt' % split)).write_text('\n'.join(ids) + '\n')
+
+        for sub in ['velodyne', 'calib', 'image_2', 'label_2', 'planes']:
+            (data_path / folder / sub).mkdir(parents=True, exist_ok=True)
+
+        for idx in ids:
+            (data_path / folder / 'calib' / ('%s.txt' % idx)).write_text(KITTI_CALIB)
+            (data_path / folder / 'planes' / ('%s.txt' % idx)).write_text(KITTI_PLANE)
+            io.imsave(str(data_path / folder / 'image_2' / ('%s.png' % idx)), np.zeros((375, 1242, 3), dtype=np.uint8),
+                      check_contrast=False)
+            if calib is None:
+                calib = calibration_kitti.Calibration(data_path / folder / 'calib' / ('%s.txt' % idx))
+
+            # ground + clutter inside the camera view, plus points on the surface of every object
+            points = rng.rand(num_points, 4).astype(np.float32)
+            points[:, 0] = points[:, 0] * 69 + 1
+            points[:, 1] = (points[:, 1] - 0.5) * points[:, 0] * 1.2
+            points[:, 2] = -1.7 + (points[:, 2] ** 4) * 3
+
+            names = rng.choice(class_names, rng.randint(3, 12))
+            boxes = np.zeros((len(names), 7), dtype=np.float32)
+            boxes[:, 0] = rng.uniform(8, 45, len(names))
+            boxes[:, 1] = rng.uniform(-0.4, 0.4, len(names)) * boxes[:, 0]
+            boxes[:, 3:6] = np.array([SYNTHETIC_OBJECTS.get(name, (1.0, 1.0, 1.0)) for name in names])
+            boxes[:, 2] = -1.7 + boxes[:, 5] / 2
+            boxes[:, 6] = rng.uniform(-np.pi, np.pi, len(names))
+
+            object_points = []
+            for box in boxes:
+                local = (rng.rand(150, 3) - 0.5) * box[3:6]
+                cosa, sina = np.cos(box[6]), np.sin(box[6])
+                xyz = np.stack([local[:, 0] * cosa - local[:, 1] * sina, local[:, 0] * sina + local[:, 1] * cosa,
+                                local[:, 2]], axis=-1) + box[0:3]
+                object_points.append(np.concatenate([xyz, rng.rand(len(xyz), 1)], axis=-1))
+            points = np.concatenate([points] + object_points, axis=0).astype(np.float32)
+            points.tofile(str(data_path / folder / 'velodyne' / ('%s.bin' % idx)))
+
+            if split != 'test':
+                boxes_camera = box_utils.boxes3d_lidar_to_kitti_camera(boxes, calib)
+                lines = []
+                for name, box in zip(names, boxes_camera):
+                    # fully visible, 50 pixels high 2d box, so every object is Easy
+                    lines.append('%s 0.00 0 0.00 500.00 150.00 600.00 200.00 %.2f %.2f %.2f %.2f %.2f %.2f %.2f' % (
+                        name, box[4], box[5], box[3], box[0], box[1], box[2], box[6]))
+                (data_path / folder / 'label_2' / ('%s.txt' % idx)).write_text('\n'.join(lines) + '\n')
+
+    create_kitti_infos(dataset_cfg, class_names, data_path, data_path, workers=1)
+
+
+def summarize(values, bins):
+    values = np.array(values) * 1000
+    hist, _ = np.histogram(values, bins=bins)
+    return {
+        'count': int(len(values)),
+        'mean': float(values.mean()),
+        'p50': float(np.percentile(values, 50)),
+        'p90': float(np.percentile(values, 90)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max()),
+        'hist': hist.tolist(),
+    }
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='dataloader profiler')
+    parser.add_argument('--cfg_file', type=str, default=None, help='model config, its DATA_CONFIG is profiled')
+    parser.add_argument('--batch_size', type=int, default=4, help='batch size of the dataloader')
+    parser.add_argument('--workers', type=int, default=4, help='number of workers for dataloader')
+    parser.add_argument('--iters', type=int, default=200, help='number of batches to profile')
+    parser.add_argument('--warmup', type=int, default=5, help='batches skipped while the workers start')
+    parser.add_argument('--model_time', type=float, default=0, help='emulated training step in ms')
+    parser.add_argument('--starvation_ms', type=float, default=1.0, help='a batch waited longer is a starved step')
+    parser.add_argument('--synthetic', type=int, default=0, help='profile on N generated KITTI frames')
+    parser.add_argument('--json', type=str, default=None, help='save the report to this file')
+    parser.add_argument('--set', dest='set_cfgs', default=None, nargs=argparse.REMAINDER,
+                        help='set extra config keys if needed')
+    args = parser.parse_args()
+
+    cfg_from_yaml_file(args.cfg_file, cfg)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs, cfg)
+
+    return args, cfg
+
+
+def main():
+    args, cfg = parse_config()
+    logger = common_utils.create_logger()
+    dataset_cfg = cfg.DATA_CONFIG
+
+    tmp_dir = None
+    if args.synthetic > 0:
+        assert dataset_cfg.DATASET == 'KittiDataset', 'synthetic data is only available in the KITTI format'
+        tmp_dir = Path(tempfile.mkdtemp(prefix='synthetic_kitti_'))
+        dataset_cfg.DATA_PATH = str(tmp_dir)
+        logger.info('Generating %d synthetic KITTI frames in %s' % (args.synthetic, tmp_dir))
+        create_synthetic_kitti(tmp_dir, args.synthetic, dataset_cfg, cfg.CLASS_NAMES)
+
+    try:
+        dataset = dataset_classes[dataset_cfg.DATASET](
+            dataset_cfg=dataset_cfg, class_names=cfg.CLASS_NAMES, root_path=None, training=True, logger=logger
+        )
+        profiled_dataset = ProfiledDataset(dataset)
+        dataloader = DataLoader(
+            profiled_dataset, batch_size=args.batch_size, pin_memory=True, num_workers=args.workers,
+            shuffle=True, collate_fn=profiled_dataset.collate_batch, drop_last=False, timeout=0
+        )
+
+        stages = defaultdict(list)
+        waits = []
+        num_samples = 0
+        start_time = None
+        dataloader_iter = iter(dataloader)
+        for it in range(args.warmup + args.iters):
+            if it == args.warmup:
+                start_time = time.perf_counter()
+
+            wait_start = time.perf_counter()
+            try:
+                batch = next(dataloader_iter)
+            except StopIteration:
+                dataloader_iter = iter(dataloader)
+                batch = next(dataloader_iter)
+            wait = time.perf_counter() - wait_start
+
+            if it >= args.warmup:
+                waits.append(wait)
+                num_samples += batch['batch_size']
+                for name, val in batch['profile'].items():
+                    stages[name].extend(val)
+
+            if args.model_time > 0:
+                time.sleep(args.model_time / 1000)
+
+        total_time = time.perf_counter() - start_time
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    bins = [0] + list(np.logspace(-2, 4, 13))  # ms
+    waits = np.array(waits)
+    report = {
+        'cfg_file': args.cfg_file,
+        'batch_size': args.batch_size,
+        'workers': args.workers,
+        'model_time_ms': args.model_time,
+        'samples_per_second': num_samples / total_time,
+        'batches_per_second': len(waits) / total_time,
+        'starved_steps': float((waits * 1000 > args.starvation_ms).mean()),
+        'wait_time_ratio': float(waits.sum() / total_time),
+        'hist_bins_ms': [float(b) for b in bins],
+        'wait': summarize(waits, bins),
+        'stages': {name: summarize(val, bins) for name, val in sorted(stages.items())},
+    }
+
+    logger.info('%-48s %8s %9s %9s %9s %9s' % ('stage (ms)', 'count', 'mean', 'p50', 'p90', 'p99'))
+    for name, val in list(report['stages'].items()) + [('dataloader wait (main process)', report['wait'])]:
+        logger.info('%-48s %8d %9.2f %9.2f %9.2f %9.2f' % (name, val['count'], val['mean'], val['p50'], val['p90'], val['p99']))
+    logger.info('%.1f samples/s, %.1f%% of the steps waited more than %.1fms, %.1f%% of the time spent waiting' % (
+        report['samples_per_second'], report['starved_steps'] * 100, args.starvation_ms, report['wait_time_ratio'] * 100))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info('Report saved to %s' % args.json)
+
+
+if __name__ == '__main__':
+    main()
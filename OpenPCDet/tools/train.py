@@ -36,6 +36,10 @@ def parse_config():
     parser.add_argument('--local_rank', type=int, default=0, help='local rank for distributed training')
     parser.add_argument('--max_ckpt_save_num', type=int, default=30, help='max number of saved checkpoint')
     parser.add_argument('--merge_all_iters_to_one_epoch', action='store_true', default=False, help='')
+    parser.add_argument('--async_ckpt_save', action='store_true', default=False,
+                        help='save the checkpoints on a background thread')
+    parser.add_argument('--telemetry_interval', type=int, default=0,
+                        help='reduce and log the losses and timings every N iterations instead of every iteration')
     parser.add_argument('--set', dest='set_cfgs', default=None, nargs=argparse.REMAINDER,
                         help='set extra config keys if needed')
 
@@ -167,7 +171,9 @@ def main():
         lr_warmup_scheduler=lr_warmup_scheduler,
         ckpt_save_interval=args.ckpt_save_interval,
         max_ckpt_save_num=args.max_ckpt_save_num,
-        merge_all_iters_to_one_epoch=args.merge_all_iters_to_one_epoch
+        merge_all_iters_to_one_epoch=args.merge_all_iters_to_one_epoch,
+        async_ckpt_save=args.async_ckpt_save,
+        telemetry_interval=args.telemetry_interval
     )
 
     if hasattr(train_set, 'use_shared_memory') and train_set.use_shared_memory:
@@ -1,5 +1,6 @@
 import glob
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import tqdm
@@ -8,11 +9,65 @@ from torch.nn.utils import clip_grad_norm_
 from pcdet.utils import common_utils, commu_utils
 
 
+class TrainTelemetry(object):
+    """
+    Accumulates the loss (on its device, no sync) and the data wait / batch timings of every iteration locally,
+    they are averaged over the iterations and the ranks with a single all_reduce when reduce is called.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = None
+        self.tb_sum = {}
+        self.data_time = 0.0
+        self.count = 0
+        self.start = time.time()
+
+    def update(self, loss, tb_dict, data_time):
+        loss = loss.detach().float()
+        self.loss_sum = loss.clone() if self.loss_sum is None else self.loss_sum + loss
+        for key, val in tb_dict.items():
+            val = val.detach() if isinstance(val, torch.Tensor) else val
+            self.tb_sum[key] = self.tb_sum.get(key, 0) + val
+        self.data_time += data_time
+        self.count += 1
+
+    def reduce(self):
+        """
+        Returns:
+            stats: loss, tb_dict, data / compute / batch time per iteration and data_wait_ratio, averaged since the
+                last reduce. Must be called by all ranks.
+        """
+        if self.loss_sum.is_cuda:
+            torch.cuda.synchronize()  # the wall time covers the queued kernels
+        batch_time = time.time() - self.start
+
+        values = torch.cat([self.loss_sum.view(1), self.loss_sum.new_tensor([self.data_time, batch_time])]) / self.count
+        loss, data_time, batch_time = commu_utils.all_reduce(values, op='sum', average=True).tolist()
+        stats = {
+            'loss': loss,
+            'tb_dict': {key: float(val) / self.count for key, val in self.tb_sum.items()},
+            'data_time': data_time,
+            'compute_time': batch_time - data_time,
+            'batch_time': batch_time,
+            'data_wait_ratio': data_time / max(batch_time, 1e-9),
+            'num_iters': self.count,
+        }
+        self.reset()
+        return stats
+
+
 def train_one_epoch(model, optimizer, train_loader, model_func, lr_scheduler, accumulated_iter, optim_cfg,
-                    rank, tbar, total_it_each_epoch, dataloader_iter, tb_log=None, leave_pbar=False):
+                    rank, tbar, total_it_each_epoch, dataloader_iter, tb_log=None, leave_pbar=False,
+                    telemetry_interval=0):
     if total_it_each_epoch == len(train_loader):
         dataloader_iter = iter(train_loader)
 
+    # telemetry_interval > 0: the timings and losses are reduced and logged every telemetry_interval iterations
+    # instead of three all_gathers and a loss.item() every iteration
+    telemetry = TrainTelemetry() if telemetry_interval > 0 else None
+
     if rank == 0:
         pbar = tqdm.tqdm(total=total_it_each_epoch, leave=leave_pbar, desc='train', dynamic_ncols=True)
         data_time = common_utils.AverageMeter()
@@ -55,6 +110,30 @@ def train_one_epoch(model, optimizer, train_loader, model_func, lr_scheduler, ac
 
         accumulated_iter += 1
 
+        if telemetry is not None:
+            telemetry.update(loss, tb_dict, cur_data_time)
+            if telemetry.count >= telemetry_interval or cur_it + 1 == total_it_each_epoch:
+                stats = telemetry.reduce()
+                if rank == 0:
+                    disp_dict.update({
+                        'loss': stats['loss'], 'lr': cur_lr, 'd_time': f'{stats["data_time"]:.2f}',
+                        'c_time': f'{stats["compute_time"]:.2f}', 'b_time': f'{stats["batch_time"]:.2f}'
+                    })
+                    tbar.set_postfix(disp_dict)
+                    tbar.refresh()
+
+                    if tb_log is not None:
+                        tb_log.add_scalar('train/loss', stats['loss'], accumulated_iter)
+                        for key, val in stats['tb_dict'].items():
+                            tb_log.add_scalar('train/' + key, val, accumulated_iter)
+                        for key in ['data_time', 'compute_time', 'batch_time', 'data_wait_ratio']:
+                            tb_log.add_scalar('meta_data/' + key, stats[key], accumulated_iter)
+
+            if rank == 0:
+                pbar.update()
+                pbar.set_postfix(dict(total_it=accumulated_iter))
+            continue
+
         cur_batch_time = time.time() - end
         # average reduce
         avg_data_time = commu_utils.average_reduce_value(cur_data_time)
@@ -89,8 +168,9 @@ def train_one_epoch(model, optimizer, train_loader, model_func, lr_scheduler, ac
 def train_model(model, optimizer, train_loader, model_func, lr_scheduler, optim_cfg,
                 start_epoch, total_epochs, start_iter, rank, tb_log, ckpt_save_dir, train_sampler=None,
                 lr_warmup_scheduler=None, ckpt_save_interval=1, max_ckpt_save_num=50,
-                merge_all_iters_to_one_epoch=False):
+                merge_all_iters_to_one_epoch=False, async_ckpt_save=False, telemetry_interval=0):
     accumulated_iter = start_iter
+    ckpt_saver = CheckpointSaver(ckpt_save_dir, max_ckpt_save_num, async_save=async_ckpt_save) if rank == 0 else None
     with tqdm.trange(start_epoch, total_epochs, desc='epochs', dynamic_ncols=True, leave=(rank == 0)) as tbar:
         total_it_each_epoch = len(train_loader)
         if merge_all_iters_to_one_epoch:
@@ -115,25 +195,21 @@ def train_model(model, optimizer, train_loader, model_func, lr_scheduler, optim_
                 rank=rank, tbar=tbar, tb_log=tb_log,
                 leave_pbar=(cur_epoch + 1 == total_epochs),
                 total_it_each_epoch=total_it_each_epoch,
-                dataloader_iter=dataloader_iter
+                dataloader_iter=dataloader_iter,
+                telemetry_interval=telemetry_interval
             )
 
             # save trained model
             trained_epoch = cur_epoch + 1
             if trained_epoch % ckpt_save_interval == 0 and rank == 0:
-
-                ckpt_list = glob.glob(str(ckpt_save_dir / 'checkpoint_epoch_*.pth'))
-                ckpt_list.sort(key=os.path.getmtime)
-
-                if ckpt_list.__len__() >= max_ckpt_save_num:
-                    for cur_file_idx in range(0, len(ckpt_list) - max_ckpt_save_num + 1):
-                        os.remove(ckpt_list[cur_file_idx])
-
                 ckpt_name = ckpt_save_dir / ('checkpoint_epoch_%d' % trained_epoch)
-                save_checkpoint(
+                ckpt_saver.save(
                     checkpoint_state(model, optimizer, trained_epoch, accumulated_iter), filename=ckpt_name,
                 )
 
+    if ckpt_saver is not None:
+        ckpt_saver.close()
+
 
 def model_state_to_cpu(model_state):
     model_state_cpu = type(model_state)()  # ordered dict
@@ -168,5 +244,64 @@ def save_checkpoint(state, filename='checkpoint'):
         optimizer_filename = '{}_optim.pth'.format(filename)
         torch.save({'optimizer_state': optimizer_state}, optimizer_filename)
 
+    # write to a temporary file first, an interrupted save never leaves a truncated checkpoint
     filename = '{}.pth'.format(filename)
-    torch.save(state, filename)
+    torch.save(state, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+
+
+def state_to_cpu(state):
+    """copies every tensor of a (nested) checkpoint state to cpu memory, unaffected by the next training steps"""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        state_cpu = type(state)((key, state_to_cpu(val)) for key, val in state.items())
+        if hasattr(state, '_metadata'):
+            state_cpu._metadata = state._metadata
+        return state_cpu
+    elif isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(val) for val in state)
+    return state
+
+
+class CheckpointSaver(object):
+    """
+    Saves the checkpoints of train_model and keeps the newest max_ckpt_save_num of them. The checkpoint directory
+    is only globbed once, to pick up the checkpoints of a resumed training.
+    With async_save the state is snapshotted to cpu memory and serialized by a background thread, at most one
+    checkpoint is in flight.
+    """
+    def __init__(self, ckpt_save_dir, max_ckpt_save_num, async_save=False):
+        self.ckpt_list = glob.glob(str(ckpt_save_dir / 'checkpoint_epoch_*.pth'))
+        self.ckpt_list.sort(key=os.path.getmtime)
+        self.max_ckpt_save_num = max_ckpt_save_num
+        self.executor = ThreadPoolExecutor(max_workers=1) if async_save else None
+        self.pending = None
+
+    def save(self, state, filename):
+        self.wait()
+        while len(self.ckpt_list) > 0 and len(self.ckpt_list) >= self.max_ckpt_save_num:
+            ckpt = self.ckpt_list.pop(0)
+            if os.path.exists(ckpt):
+                os.remove(ckpt)
+
+        ckpt_file = '{}.pth'.format(filename)
+        if ckpt_file in self.ckpt_list:
+            self.ckpt_list.remove(ckpt_file)
+        self.ckpt_list.append(ckpt_file)
+
+        if self.executor is None:
+            save_checkpoint(state, filename=filename)
+        else:
+            self.pending = self.executor.submit(save_checkpoint, state_to_cpu(state), filename)
+
+    def wait(self):
+        # errors of the background thread are raised here
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()